@@ -19,9 +19,21 @@ module purge
 
 source $SRCDIR/bin/miniconda/bin/activate
 
-EVAL_PATH="$DATADIR/eval_segments.csv.$(printf '%02d' $SLURM_ARRAY_TASK_ID)";
-BALANCED_TRAIN_PATH="$DATADIR/balanced_train_segments.csv.$(printf '%02d' $SLURM_ARRAY_TASK_ID)";
-UNBALANCED_TRAIN_PATH="$DATADIR/unbalanced_train_segments.csv.$(printf '%02d' $SLURM_ARRAY_TASK_ID)";
+# With COORDINATE=1, every task claims videos of the whole subsets from the
+# manifest in $DATADIR, so the subset files do not need to be split
+COORDINATE=${COORDINATE:-0}
+
+if [ "$COORDINATE" = "1" ]; then
+    EVAL_PATH="$DATADIR/eval_segments.csv";
+    BALANCED_TRAIN_PATH="$DATADIR/balanced_train_segments.csv";
+    UNBALANCED_TRAIN_PATH="$DATADIR/unbalanced_train_segments.csv";
+    COORDINATE_ARGS="--coordinate";
+else
+    EVAL_PATH="$DATADIR/eval_segments.csv.$(printf '%02d' $SLURM_ARRAY_TASK_ID)";
+    BALANCED_TRAIN_PATH="$DATADIR/balanced_train_segments.csv.$(printf '%02d' $SLURM_ARRAY_TASK_ID)";
+    UNBALANCED_TRAIN_PATH="$DATADIR/unbalanced_train_segments.csv.$(printf '%02d' $SLURM_ARRAY_TASK_ID)";
+    COORDINATE_ARGS="";
+fi
 
 python $SRCDIR/download_audioset.py \
     -f $FFMPEG_PATH \
@@ -40,4 +52,5 @@ python $SRCDIR/download_audioset.py \
     --num-retries 10 \
     --no-logging \
     --verbose \
+    $COORDINATE_ARGS \
     $DATADIR
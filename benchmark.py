@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of the download pipeline on synthetic media served
+locally, without network access
+"""
+import argparse
+import collections
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from download_audioset import LOGGER
+from log import init_console_logger
+from subsets import download_subset_videos, init_subset_data_dir
+from utils import run_command
+
+
+def parse_arguments():
+    """
+    Parse arguments from the command line
+
+
+    Returns:
+        args:  Argument dictionary
+               (Type: dict[str, str])
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the AudioSet download pipeline')
+
+    parser.add_argument('-f',
+                        '--ffmpeg',
+                        dest='ffmpeg_path',
+                        action='store',
+                        type=str,
+                        default='./bin/ffmpeg/ffmpeg',
+                        help='Path to ffmpeg executable')
+
+    parser.add_argument('-fp',
+                        '--ffprobe',
+                        dest='ffprobe_path',
+                        action='store',
+                        type=str,
+                        default='./bin/ffmpeg/ffprobe',
+                        help='Path to ffprobe executable')
+
+    parser.add_argument('-ns',
+                        '--num-segments',
+                        dest='num_segments',
+                        action='store',
+                        type=int,
+                        default=100,
+                        help='Number of segments downloaded in each run')
+
+    parser.add_argument('-nv',
+                        '--num-videos',
+                        dest='num_videos',
+                        action='store',
+                        type=int,
+                        default=10,
+                        help='Number of synthetic source videos shared by the segments')
+
+    parser.add_argument('-vl',
+                        '--video-length',
+                        dest='video_length',
+                        action='store',
+                        type=float,
+                        default=60.0,
+                        help='Length of the synthetic source videos (in seconds)')
+
+    parser.add_argument('-sl',
+                        '--segment-length',
+                        dest='segment_length',
+                        action='store',
+                        type=float,
+                        default=10.0,
+                        help='Length of the segments (in seconds)')
+
+    parser.add_argument('-vm',
+                        '--video-modes',
+                        dest='video_modes',
+                        nargs='+',
+                        default=['novideo', 'bestvideoaudio', 'bestvideowithaudio'],
+                        help='Video modes that are benchmarked')
+
+    parser.add_argument('-n',
+                        '--num-workers',
+                        dest='num_workers',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='Number of multiprocessing workers used to download videos')
+
+    parser.add_argument('-nres',
+                        '--num-resolvers',
+                        dest='num_resolvers',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Number of threads resolving stream URLs ahead of the workers')
+
+    parser.add_argument('-nr',
+                        '--num-retries',
+                        dest='num_retries',
+                        action='store',
+                        type=int,
+                        default=10,
+                        help='Number of retries when ffmpeg fails')
+
+    parser.add_argument('-nfo',
+                        '--no-fuse-outputs',
+                        dest='fuse_outputs',
+                        action='store_false',
+                        default=True,
+                        help='Extract audio and video with separate ffmpeg processes')
+
+    parser.add_argument('-her',
+                        '--http-error-rate',
+                        dest='http_error_rate',
+                        action='store',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of media requests answered with HTTP 503')
+
+    parser.add_argument('-wdr',
+                        '--wrong-duration-rate',
+                        dest='wrong_duration_rate',
+                        action='store',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of videos whose reported duration is longer '
+                             'than their actual duration')
+
+    parser.add_argument('-o',
+                        '--output-json',
+                        dest='output_json',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='Path where the benchmark results are saved as JSON')
+
+    parser.add_argument('-k',
+                        '--keep-files',
+                        dest='keep_files',
+                        action='store_true',
+                        default=False,
+                        help='Do not delete the generated media and outputs')
+
+    parser.add_argument('-v',
+                        '--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        default=False,
+                        help='Prints verbose info to stdout')
+
+    return vars(parser.parse_args())
+
+
+class FaultyRangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files with support for byte range requests, so that ffmpeg can
+    seek, and answers a fraction of media requests with HTTP 503.
+    """
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        if not self.path.endswith('.json') and random.random() < self.error_rate:
+            self.send_error(503, 'Injected failure')
+            return None
+
+        path = self.translate_path(self.path)
+        range_header = self.headers.get('Range')
+        if not range_header or not os.path.isfile(path):
+            return super(FaultyRangeRequestHandler, self).send_head()
+
+        file_size = os.path.getsize(path)
+        start_str, end_str = range_header.replace('bytes=', '').split('-')[:2]
+        start = int(start_str) if start_str else 0
+        end = int(end_str) if end_str else file_size - 1
+        if start >= file_size:
+            self.send_error(416, 'Requested range not satisfiable')
+            return None
+        end = min(end, file_size - 1)
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, file_size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.range_remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, 'range_remaining', None)
+        if remaining is None:
+            return super(FaultyRangeRequestHandler, self).copyfile(source, outputfile)
+        while remaining > 0:
+            buf = source.read(min(remaining, 64 * 1024))
+            if not buf:
+                break
+            outputfile.write(buf)
+            remaining -= len(buf)
+
+
+def generate_media(ffmpeg_path, media_dir, num_videos, video_length):
+    """
+    Generate synthetic source videos with audio
+
+    Args:
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        media_dir:     Directory where the media will be saved
+                       (Type: str)
+
+        num_videos:    Number of videos
+                       (Type: int)
+
+        video_length:  Length of the videos (in seconds)
+                       (Type: float)
+
+    Returns:
+        media_filenames:  Filenames of the videos
+                          (Type: list[str])
+    """
+    media_filenames = []
+    for idx in range(num_videos):
+        media_filename = 'media{:04d}.mp4'.format(idx)
+        run_command([ffmpeg_path, '-y',
+                     '-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=30',
+                     '-f', 'lavfi', '-i', 'sine=frequency={}:sample_rate=44100'.format(220 + idx),
+                     '-t', str(video_length),
+                     '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                     '-c:a', 'aac', '-movflags', '+faststart',
+                     os.path.join(media_dir, media_filename),
+                     '-loglevel', 'error'])
+        media_filenames.append(media_filename)
+
+    return media_filenames
+
+
+def write_segments(subset_path, media_dir, media_filenames, video_length,
+                   num_segments, segment_length, wrong_duration_rate):
+    """
+    Write a segments file with one random segment for each of `num_segments`
+    synthetic YouTube IDs, along with the sidecars that map each ID to one
+    of the generated videos.
+
+    The sidecars in `media_dir` report the actual duration of each video.
+    The sidecars in `media_dir/faulty` map to the same videos, but a fraction
+    of them report a duration longer than the actual duration. The segments
+    of those run past the end of the video, where they are only clipped with
+    the actual duration.
+
+    Args:
+        subset_path:          Path to segments file
+                              (Type: str)
+
+        media_dir:            Directory with the media
+                              (Type: str)
+
+        media_filenames:      Filenames of the videos
+                              (Type: list[str])
+
+        video_length:         Length of the videos (in seconds)
+                              (Type: float)
+
+        num_segments:         Number of segments
+                              (Type: int)
+
+        segment_length:       Length of the segments (in seconds)
+                              (Type: float)
+
+        wrong_duration_rate:  Fraction of sidecars in `media_dir/faulty` that
+                              report a wrong duration
+                              (Type: float)
+    """
+    faulty_dir = os.path.join(media_dir, 'faulty')
+    os.makedirs(faulty_dir, exist_ok=True)
+    for media_filename in media_filenames:
+        os.symlink(os.path.join('..', media_filename), os.path.join(faulty_dir, media_filename))
+
+    with open(subset_path, 'w') as f:
+        f.write('# Synthetic segments generated by benchmark.py\n')
+        f.write('# YTID, start_seconds, end_seconds, positive_labels\n')
+        for idx in range(num_segments):
+            ytid = 'bench{:06d}'.format(idx)
+            media_filename = media_filenames[idx % len(media_filenames)]
+
+            duration = video_length
+            if random.random() < wrong_duration_rate:
+                duration += video_length / 2
+            for sidecar_dir, sidecar_duration in ((media_dir, video_length),
+                                                  (faulty_dir, duration)):
+                with open(os.path.join(sidecar_dir, ytid + '.json'), 'w') as sidecar_file:
+                    json.dump({'duration': sidecar_duration, 'video': media_filename,
+                               'video_has_audio': True}, sidecar_file)
+
+            # Both runs share the segments, so they are drawn from the actual
+            # duration of the video
+            if duration > video_length:
+                ts_start = max(video_length - segment_length / 2, 0.0)
+            else:
+                ts_start = float(random.randrange(int(max(video_length - segment_length, 0)) + 1))
+            f.write('{},{:.3f},{:.3f},"/m/0"\n'.format(ytid, ts_start, ts_start + segment_length))
+
+
+def percentile(values, q):
+    """
+    Compute a percentile of a list of values with the nearest-rank method
+
+    Args:
+        values:  Values
+                 (Type: list[float])
+
+        q:       Percentile, between 0 and 100
+                 (Type: float)
+
+    Returns:
+        value:  Percentile of the values, or None if there are no values
+                (Type: float or None)
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(q / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_benchmark(subset_path, output_dir, source, ffmpeg_path, ffprobe_path,
+                  num_workers, **ffmpeg_cfg):
+    """
+    Download all segments of a segments file and measure the pipeline
+
+    Args:
+        subset_path:   Path to segments file
+                       (Type: str)
+
+        output_dir:    Dataset directory where outputs are saved
+                       (Type: str)
+
+        source:        Source of the media
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+        num_workers:   Number of multiprocessing workers used to download videos
+                       (Type: int)
+
+    Keyword Args:
+        **ffmpeg_cfg:  Configuration for audio and video
+                       downloading and decoding done by ffmpeg
+                       (Type: dict[str, *])
+
+    Returns:
+        report:  Benchmark measurements
+                 (Type: dict[str, *])
+    """
+    results = []
+    data_dir = init_subset_data_dir(output_dir, 'benchmark')
+
+    rusage_start = [resource.getrusage(who) for who in
+                    (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    start_time = time.time()
+    download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
+                           num_workers, None, result_callback=results.append,
+                           source=source, **ffmpeg_cfg)
+    wall_time = time.time() - start_time
+    rusage_end = [resource.getrusage(who) for who in
+                  (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+
+    cpu_time = sum((end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+                   for start, end in zip(rusage_start, rusage_end))
+
+    stage_times = collections.defaultdict(list)
+    for result in results:
+        if result.elapsed is not None:
+            stage_times['total'].append(result.elapsed)
+        for stage, seconds in (result.timings or {}).items():
+            stage_times[stage].append(seconds)
+
+    num_succeeded = sum(1 for result in results if result.succeeded)
+    return {
+        'num_segments': len(results),
+        'num_succeeded': num_succeeded,
+        'num_failed': len(results) - num_succeeded,
+        'errors': dict(collections.Counter(result.error_class for result in results
+                                           if not result.succeeded)),
+        'wall_time': wall_time,
+        'segments_per_second': num_succeeded / wall_time if wall_time else None,
+        'cpu_utilization': cpu_time / (wall_time * mp.cpu_count()) if wall_time else None,
+        'bytes_written': sum(result.num_bytes or 0 for result in results),
+        'latency': {stage: {'p50': percentile(times, 50), 'p95': percentile(times, 95)}
+                    for stage, times in stage_times.items()},
+    }
+
+
+def print_report(name, report):
+    """
+    Print the measurements of a benchmark run
+
+    Args:
+        name:    Name of the benchmark run
+                 (Type: str)
+
+        report:  Benchmark measurements
+                 (Type: dict[str, *])
+    """
+    print('== {} =='.format(name))
+    print('  segments:     {} succeeded, {} failed {}'.format(
+        report['num_succeeded'], report['num_failed'], report['errors'] or ''))
+    print('  wall time:    {:.2f} s'.format(report['wall_time']))
+    print('  throughput:   {:.3f} segments/s'.format(report['segments_per_second'] or 0))
+    print('  CPU usage:    {:.1%} of {} cores'.format(report['cpu_utilization'] or 0,
+                                                     mp.cpu_count()))
+    print('  bytes out:    {}'.format(report['bytes_written']))
+    print('  latency (s):  {:<14} {:>8} {:>8}'.format('stage', 'p50', 'p95'))
+    for stage, latency in sorted(report['latency'].items()):
+        print('                {:<14} {:>8.3f} {:>8.3f}'.format(stage, latency['p50'],
+                                                              latency['p95']))
+
+
+def benchmark(ffmpeg_path, ffprobe_path, num_segments=100, num_videos=10,
+              video_length=60.0, segment_length=10.0, video_modes=('bestvideoaudio',),
+              num_workers=4, num_resolvers=0, num_retries=10, fuse_outputs=True,
+              http_error_rate=0.0, wrong_duration_rate=0.0, output_json=None,
+              keep_files=False, verbose=False):
+    """
+    Benchmark the download pipeline in each of the given video modes.
+
+    Synthetic media are generated with ffmpeg and served by a local HTTP
+    server, which also stands in for the stream resolver through the sidecar
+    of each video. If failures are injected, each video mode is run both
+    without and with failures, so that the cost of retries can be compared.
+
+    Args:
+        ffmpeg_path:          Path to ffmpeg executable
+                              (Type: str)
+
+        ffprobe_path:         Path to ffprobe executable
+                              (Type: str)
+
+    Keyword Args:
+        num_segments:         Number of segments downloaded in each run
+                              (Type: int)
+
+        num_videos:           Number of synthetic source videos
+                              (Type: int)
+
+        video_length:         Length of the source videos (in seconds)
+                              (Type: float)
+
+        segment_length:       Length of the segments (in seconds)
+                              (Type: float)
+
+        video_modes:          Video modes that are benchmarked
+                              (Type: iterable[str])
+
+        num_workers:          Number of multiprocessing workers
+                              (Type: int)
+
+        num_resolvers:        Number of threads resolving stream URLs
+                              (Type: int)
+
+        num_retries:          Number of retries when ffmpeg fails
+                              (Type: int)
+
+        fuse_outputs:         Extract audio and video with a single process
+                              (Type: bool)
+
+        http_error_rate:      Fraction of media requests answered with HTTP 503
+                              (Type: float)
+
+        wrong_duration_rate:  Fraction of videos with a wrong reported duration
+                              (Type: float)
+
+        output_json:          Path where the results are saved as JSON
+                              (Type: str or None)
+
+        keep_files:           If True, do not delete generated files
+                              (Type: bool)
+
+        verbose:              Prints verbose information to stdout if True
+                              (Type: bool)
+
+    Returns:
+        reports:  Benchmark measurements, by run name
+                  (Type: dict[str, dict[str, *]])
+    """
+    init_console_logger(LOGGER, verbose=verbose)
+
+    work_dir = tempfile.mkdtemp(prefix='audiosetdl-bench-')
+    media_dir = os.path.join(work_dir, 'media')
+    os.makedirs(media_dir)
+
+    class Handler(FaultyRangeRequestHandler):
+        error_rate = 0.0
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(Handler, directory=media_dir))
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    source = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    reports = collections.OrderedDict()
+    try:
+        print('Generating {} synthetic videos in {}'.format(num_videos, media_dir))
+        media_filenames = generate_media(ffmpeg_path, media_dir, num_videos, video_length)
+        subset_path = os.path.join(work_dir, 'benchmark_segments.csv')
+        write_segments(subset_path, media_dir, media_filenames, video_length,
+                       num_segments, segment_length, wrong_duration_rate)
+
+        runs = [('', 0.0, source)]
+        if http_error_rate > 0 or wrong_duration_rate > 0:
+            runs.append((' (with injected failures)', http_error_rate, source + '/faulty'))
+
+        for video_mode in video_modes:
+            for suffix, error_rate, run_source in runs:
+                name = video_mode + suffix
+                Handler.error_rate = error_rate
+
+                output_dir = tempfile.mkdtemp(prefix='out-', dir=work_dir)
+                reports[name] = run_benchmark(subset_path, output_dir, run_source,
+                                              ffmpeg_path, ffprobe_path, num_workers,
+                                              video_mode=video_mode,
+                                              num_resolvers=num_resolvers,
+                                              num_retries=num_retries,
+                                              fuse_outputs=fuse_outputs)
+                print_report(name, reports[name])
+                if not keep_files:
+                    shutil.rmtree(output_dir)
+
+        if output_json:
+            with open(output_json, 'w') as f:
+                json.dump(reports, f, indent=2)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if not keep_files:
+            shutil.rmtree(work_dir)
+
+    return reports
+
+
+if __name__ == '__main__':
+    benchmark(**parse_arguments())
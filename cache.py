@@ -0,0 +1,338 @@
+"""
+On-disk caches shared by the download worker processes and across runs
+"""
+import collections
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+URL_EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+
+# Stream URLs are not used once they are this close to their expiry time
+URL_EXPIRE_MARGIN = 300
+
+# Minimum number of seconds between updates of the last use of a cache entry
+TOUCH_INTERVAL = 60.0
+
+ResolvedStreams = collections.namedtuple(
+    'ResolvedStreams', ['ytid', 'duration', 'video_url', 'audio_url',
+                        'video_has_audio'])
+
+STREAM_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS streams (
+    ytid             TEXT NOT NULL,
+    video_mode       TEXT NOT NULL,
+    duration         REAL NOT NULL,
+    video_url        TEXT NOT NULL,
+    audio_url        TEXT NOT NULL,
+    video_has_audio  INTEGER NOT NULL,
+    expires_at       REAL NOT NULL,
+    last_used        REAL NOT NULL,
+    PRIMARY KEY (ytid, video_mode)
+);
+CREATE INDEX IF NOT EXISTS streams_last_used_idx ON streams (last_used);
+"""
+
+NEGATIVE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_videos (
+    ytid          TEXT PRIMARY KEY,
+    error_class   TEXT,
+    error_msg     TEXT,
+    first_failed  REAL NOT NULL,
+    last_failed   REAL NOT NULL,
+    num_failures  INTEGER NOT NULL DEFAULT 1
+);
+"""
+
+_CACHES = {}
+_NEGATIVE_CACHES = {}
+
+
+def get_url_expiry(url):
+    """
+    Get the expiry time encoded in a signed stream URL
+
+    Args:
+        url:  Stream URL
+              (Type: str)
+
+    Returns:
+        expiry:  Expiry time (in seconds since the epoch), or None if the URL
+                 does not specify one
+                 (Type: float or None)
+    """
+    match = URL_EXPIRE_PATTERN.search(url)
+    if not match:
+        return None
+    return float(match.group(1))
+
+
+class StreamCache(object):
+    """
+    Cache of resolved stream URLs, stored in an SQLite database so that it
+    can be shared by all worker processes and across runs.
+
+    Entries expire after a TTL, or earlier if the URLs themselves expire.
+    When the cache grows past its maximum size, the least recently used
+    entries are evicted. The last use of an entry is only updated once every
+    `touch_interval` seconds, so that lookups from many workers do not all
+    wait for the write lock of the database.
+    """
+
+    def __init__(self, path, ttl=14400, max_entries=100000, evict_every=100,
+                 touch_interval=TOUCH_INTERVAL):
+        """
+        Args:
+            path:         Path to SQLite database file
+                          (Type: str)
+
+        Keyword Args:
+            ttl:          Maximum number of seconds an entry is kept
+                          (Type: float)
+
+            max_entries:  Maximum number of entries in the cache
+                          (Type: int)
+
+            evict_every:  Number of insertions between evictions
+                          (Type: int)
+
+            touch_interval:
+                          Minimum number of seconds between updates of the
+                          last use of an entry
+                          (Type: float)
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.touch_interval = touch_interval
+        self._num_puts = 0
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.executescript(STREAM_CACHE_SCHEMA)
+
+    def get(self, ytid, video_mode):
+        """
+        Get the resolved streams of a video
+
+        Args:
+            ytid:        YouTube ID of a video
+                         (Type: str)
+
+            video_mode:  Video mode that the streams were selected for
+                         (Type: str)
+
+        Returns:
+            streams:  Cached streams, or None if not cached or expired
+                      (Type: cache.ResolvedStreams or None)
+        """
+        now = time.time()
+        row = self.conn.execute(
+            'SELECT duration, video_url, audio_url, video_has_audio, last_used FROM streams '
+            'WHERE ytid = ? AND video_mode = ? AND expires_at > ?',
+            (ytid, video_mode, now)).fetchone()
+        if row is None:
+            return None
+
+        duration, video_url, audio_url, video_has_audio, last_used = row
+        # Reads do not take the write lock unless the entry was last used long
+        # enough ago for eviction to tell the difference
+        if now - last_used >= self.touch_interval:
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE streams SET last_used = ? '
+                    'WHERE ytid = ? AND video_mode = ? AND last_used <= ?',
+                    (now, ytid, video_mode, now - self.touch_interval))
+        return ResolvedStreams(ytid, duration, video_url, audio_url, bool(video_has_audio))
+
+    def put(self, video_mode, streams):
+        """
+        Add the resolved streams of a video to the cache
+
+        Args:
+            video_mode:  Video mode that the streams were selected for
+                         (Type: str)
+
+            streams:     Resolved streams
+                         (Type: cache.ResolvedStreams)
+        """
+        now = time.time()
+        expires_at = now + self.ttl
+        for url in (streams.video_url, streams.audio_url):
+            url_expiry = get_url_expiry(url)
+            if url_expiry is not None:
+                expires_at = min(expires_at, url_expiry - URL_EXPIRE_MARGIN)
+
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (streams.ytid, video_mode, streams.duration, streams.video_url,
+                 streams.audio_url, int(streams.video_has_audio), expires_at, now))
+
+        self._num_puts += 1
+        if self._num_puts % self.evict_every == 0:
+            self.evict()
+
+    def invalidate(self, ytid):
+        """
+        Remove the cached streams of a video, e.g. when its URLs were rejected
+
+        Args:
+            ytid:  YouTube ID of a video
+                   (Type: str)
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM streams WHERE ytid = ?', (ytid,))
+
+    def evict(self):
+        """
+        Remove expired entries and the least recently used entries beyond
+        the maximum size of the cache
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM streams WHERE expires_at <= ?', (time.time(),))
+            num_entries = self.conn.execute('SELECT COUNT(*) FROM streams').fetchone()[0]
+            if num_entries > self.max_entries:
+                self.conn.execute(
+                    'DELETE FROM streams WHERE rowid IN '
+                    '(SELECT rowid FROM streams ORDER BY last_used LIMIT ?)',
+                    (num_entries - self.max_entries,))
+
+
+def get_stream_cache(path, ttl=14400, max_entries=100000):
+    """
+    Get the stream cache at the given path for the current process.
+
+    Each process and thread opens its own connection to the cache database,
+    since SQLite connections cannot be shared across a fork or between
+    threads.
+
+    Args:
+        path:         Path to SQLite database file
+                      (Type: str)
+
+    Keyword Args:
+        ttl:          Maximum number of seconds an entry is kept
+                      (Type: float)
+
+        max_entries:  Maximum number of entries in the cache
+                      (Type: int)
+
+    Returns:
+        cache:  Stream cache
+                (Type: cache.StreamCache)
+    """
+    key = (os.getpid(), threading.get_ident(), path)
+    if key not in _CACHES:
+        _CACHES[key] = StreamCache(path, ttl=ttl, max_entries=max_entries)
+    return _CACHES[key]
+
+
+class NegativeCache(object):
+    """
+    Persistent record of videos that failed with a permanent error, e.g.
+    because they were removed or are blocked, so that they are skipped by
+    later runs instead of being resolved again.
+
+    If a re-check TTL is set, a video is tried again once that many seconds
+    passed since it last failed.
+    """
+
+    def __init__(self, path, ttl=None):
+        """
+        Args:
+            path:  Path to SQLite database file
+                   (Type: str)
+
+        Keyword Args:
+            ttl:   Number of seconds after which a dead video is tried
+                   again. If None, it is never tried again.
+                   (Type: float or None)
+        """
+        self.path = path
+        self.ttl = ttl
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.executescript(NEGATIVE_CACHE_SCHEMA)
+
+    def is_dead(self, ytid):
+        """
+        Check whether a video is known to be unavailable
+
+        Args:
+            ytid:  YouTube ID of a video
+                   (Type: str)
+
+        Returns:
+            is_dead:  True if the video failed with a permanent error and is
+                      not due for a re-check
+                      (Type: bool)
+        """
+        min_last_failed = time.time() - self.ttl if self.ttl else float('-inf')
+        row = self.conn.execute(
+            'SELECT 1 FROM dead_videos WHERE ytid = ? AND last_failed > ?',
+            (ytid, min_last_failed)).fetchone()
+        return row is not None
+
+    def add(self, ytid, error_class, error_msg):
+        """
+        Record that a video failed with a permanent error
+
+        Args:
+            ytid:         YouTube ID of a video
+                          (Type: str)
+
+            error_class:  Name of the exception class of the error
+                          (Type: str)
+
+            error_msg:    Error message
+                          (Type: str)
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO dead_videos VALUES (?, ?, ?, ?, ?, 1) '
+                'ON CONFLICT (ytid) DO UPDATE SET error_class = excluded.error_class, '
+                'error_msg = excluded.error_msg, last_failed = excluded.last_failed, '
+                'num_failures = num_failures + 1',
+                (ytid, error_class, error_msg, now, now))
+
+    def remove(self, ytid):
+        """
+        Forget that a video failed, e.g. when it was downloaded after a re-check
+
+        Args:
+            ytid:  YouTube ID of a video
+                   (Type: str)
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM dead_videos WHERE ytid = ?', (ytid,))
+
+
+def get_negative_cache(path, ttl=None):
+    """
+    Get the negative cache at the given path for the current process and
+    thread, since SQLite connections cannot be shared between threads.
+
+    Args:
+        path:  Path to SQLite database file
+               (Type: str)
+
+    Keyword Args:
+        ttl:   Number of seconds after which a dead video is tried again. If
+               None, it is never tried again.
+               (Type: float or None)
+
+    Returns:
+        cache:  Negative cache
+                (Type: cache.NegativeCache)
+    """
+    key = (os.getpid(), threading.get_ident(), path)
+    if key not in _NEGATIVE_CACHES:
+        _NEGATIVE_CACHES[key] = NegativeCache(path, ttl=ttl)
+    return _NEGATIVE_CACHES[key]
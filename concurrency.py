@@ -0,0 +1,157 @@
+"""
+Adaptive control of the number of concurrent download jobs
+"""
+import logging
+import os
+import statistics
+
+LOGGER = logging.getLogger('audiosetdl')
+
+
+def get_cpu_load():
+    """
+    Get the load of the host, relative to its number of cores
+
+    Returns:
+        load:  One-minute load average divided by the number of cores, or
+               None if the platform does not report load averages
+               (Type: float or None)
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class AdaptiveConcurrency(object):
+    """
+    AIMD (additive increase, multiplicative decrease) controller of the
+    number of download jobs that run at the same time.
+
+    Results of completed jobs are observed in windows of at least
+    `min_window` results. At the end of each window, the limit is cut by
+    `decrease_factor` if the fraction of segments that hit HTTP errors is
+    above `max_error_rate`, if the median segment latency grew by more than
+    `max_latency_factor` relative to the best median seen so far, or if the
+    CPU load of the host is above `max_load`. Otherwise, the limit grows by
+    one, up to `max_limit`.
+    """
+
+    def __init__(self, min_limit, max_limit, initial_limit=None, min_window=8,
+                 max_error_rate=0.05, max_latency_factor=2.0, max_load=1.0,
+                 decrease_factor=0.5, load_func=get_cpu_load):
+        """
+        Args:
+            min_limit:           Minimum number of concurrent jobs
+                                 (Type: int)
+
+            max_limit:           Maximum number of concurrent jobs
+                                 (Type: int)
+
+        Keyword Args:
+            initial_limit:       Initial number of concurrent jobs. If None,
+                                 `min_limit`.
+                                 (Type: int or None)
+
+            min_window:          Minimum number of results between adjustments
+                                 (Type: int)
+
+            max_error_rate:      Maximum fraction of segments with HTTP errors
+                                 (Type: float)
+
+            max_latency_factor:  Maximum ratio between the median latency of
+                                 a window and the best median latency so far
+                                 (Type: float)
+
+            max_load:            Maximum load average per core
+                                 (Type: float)
+
+            decrease_factor:     Factor applied to the limit on a decrease
+                                 (Type: float)
+
+            load_func:           Function that returns the load average per
+                                 core, or None if unknown
+                                 (Type: callable[[], float or None])
+        """
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError('Invalid concurrency bounds: {} - {}'.format(min_limit, max_limit))
+        if initial_limit is None:
+            initial_limit = min_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.min_window = min_window
+        self.max_error_rate = max_error_rate
+        self.max_latency_factor = max_latency_factor
+        self.max_load = max_load
+        self.decrease_factor = decrease_factor
+        self.load_func = load_func
+
+        self.best_latency = None
+        self._num_results = 0
+        self._num_http_errors = 0
+        self._latencies = []
+
+    def current_limit(self):
+        """
+        Get the current number of concurrent jobs
+
+        Returns:
+            limit:  Number of concurrent jobs
+                    (Type: int)
+        """
+        return self.limit
+
+    def observe(self, result):
+        """
+        Record the result of a job, and adjust the limit at the end of a window
+
+        Args:
+            result:  Download status of a segment
+                     (Type: scheduler.SegmentResult)
+        """
+        self._num_results += 1
+        if result.http_errors:
+            self._num_http_errors += 1
+        # Only count jobs that got to download something, so that failures to
+        # resolve do not make the latency look better than it is
+        if result.succeeded and result.elapsed is not None:
+            self._latencies.append(result.elapsed)
+
+        if self._num_results >= max(self.min_window, self.limit):
+            self._adjust()
+
+    def _adjust(self):
+        error_rate = self._num_http_errors / self._num_results
+        latency = statistics.median(self._latencies) if self._latencies else None
+        load = self.load_func()
+
+        reason = None
+        if error_rate > self.max_error_rate:
+            reason = 'HTTP error rate {:.1%}'.format(error_rate)
+        elif load is not None and load > self.max_load:
+            reason = 'CPU load {:.2f} per core'.format(load)
+        elif latency is not None and self.best_latency is not None \
+                and latency > self.max_latency_factor * self.best_latency:
+            reason = 'median latency {:.1f}s (best {:.1f}s)'.format(latency, self.best_latency)
+
+        if latency is not None and (self.best_latency is None or latency < self.best_latency):
+            self.best_latency = latency
+
+        if reason is not None:
+            new_limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        else:
+            new_limit = min(self.max_limit, self.limit + 1)
+            reason = 'HTTP error rate {:.1%}, median latency {}, CPU load {}'.format(
+                error_rate,
+                '{:.1f}s'.format(latency) if latency is not None else 'unknown',
+                '{:.2f} per core'.format(load) if load is not None else 'unknown')
+
+        if new_limit != self.limit:
+            LOGGER.info('Changing number of concurrent jobs from {} to {}: {}'.format(
+                self.limit, new_limit, reason))
+            self.limit = new_limit
+
+        self._num_results = 0
+        self._num_http_errors = 0
+        self._latencies = []
@@ -3,28 +3,20 @@
 Downloads Google's AudioSet dataset locally
 """
 import argparse
-import atexit
-import collections
-import csv
 import logging.handlers
-import multiprocessing as mp
 import os
-import random
-import shutil
+import signal
 import sys
-import traceback as tb
-import urllib.request
-from functools import partial
 
 import multiprocessing_logging
-import pafy
 
-from errors import SubprocessError, FfmpegValidationError, \
-                   FfmpegIncorrectDurationError, FfmpegUnopenableFileError
+from concurrency import AdaptiveConcurrency
+from executor import CommandExecutor
 from log import init_file_logger, init_console_logger
-from utils import run_command, is_url, get_filename, \
-    get_subset_name, get_media_filename, HTTP_ERR_PATTERN
-from validation import validate_audio, validate_video
+from manifest import Manifest, LeaseHeartbeat, get_lease_owner
+from metrics import Metrics, MetricsReporter
+from scheduler import ShutdownHandler
+from subsets import download_subset
 
 LOGGER = logging.getLogger('audiosetdl')
 LOGGER.setLevel(logging.DEBUG)
@@ -93,6 +85,16 @@ def parse_arguments():
                         default=UNBALANCED_TRAIN_URL,
                         help='Path to unbalanced train segments file')
 
+    parser.add_argument('-src',
+                        '--source',
+                        dest='source',
+                        action='store',
+                        type=str,
+                        default='pafy',
+                        help="Source of the media. 'pafy' resolves videos on YouTube. "
+                             "Otherwise, a local directory or HTTP base URL serving "
+                             "pre-staged media files named by YouTube ID.")
+
     parser.add_argument('-ac',
                         '--audio-codec',
                         dest='audio_codec',
@@ -155,6 +157,63 @@ def parse_arguments():
                              "best quality video without an audio stream and " \
                              " merges it with audio stream")
 
+    parser.add_argument('-nfo',
+                        '--no-fuse-outputs',
+                        dest='fuse_outputs',
+                        action='store_false',
+                        default=True,
+                        help="Extract the audio and the video of a segment with "
+                             "separate ffmpeg processes. By default, a single ffmpeg "
+                             "process reads the best audio stream and the video "
+                             "stream and writes both outputs, except in the "
+                             "'bestvideowithaudio' mode.")
+
+    parser.add_argument('-mg',
+                        '--merge-gap',
+                        dest='merge_gap',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='Segments of the same video that overlap or are at most '
+                             'this many seconds apart are fetched once as a single span '
+                             'and cut locally (default = fetch each segment separately)')
+
+    parser.add_argument('-et',
+                        '--exact-trim',
+                        dest='exact_trim',
+                        action='store_true',
+                        default=False,
+                        help='Cut the outputs after the number of audio samples and '
+                             'video frames in each segment, so that their duration is '
+                             'right on the first attempt')
+
+    parser.add_argument('-sv',
+                        '--strict-validation',
+                        dest='strict_validation',
+                        action='store_true',
+                        default=False,
+                        help='Validate the audio of each segment by decoding the whole '
+                             'file and getting its info with sox, instead of reading '
+                             'its header and decoding a few blocks at its start and end')
+
+    parser.add_argument('-vfs',
+                        '--validate-from-stats',
+                        dest='validate_from_stats',
+                        action='store_true',
+                        default=False,
+                        help='Validate the duration of outputs from the number of frames '
+                             'and samples that ffmpeg reports encoding, instead of '
+                             'opening the outputs after ffmpeg is done')
+
+    parser.add_argument('-scr',
+                        '--spot-check-rate',
+                        dest='spot_check_rate',
+                        action='store',
+                        type=float,
+                        default=0.1,
+                        help='With --validate-from-stats, fraction of the outputs that '
+                             'are also opened and fully validated')
+
     parser.add_argument('-vfr',
                         '--video-frame-rate',
                         dest='video_frame_rate',
@@ -177,691 +236,398 @@ def parse_arguments():
                         action='store',
                         type=int,
                         default=4,
-                        help='Number of multiprocessing workers used to download videos')
+                        help='Number of multiprocessing workers used to download videos. '
+                             'When resolver threads are used, the workers only run ffmpeg, '
+                             'so this is best set to the number of cores.')
 
-    parser.add_argument('-nb',
-                        '--num-buckets',
-                        dest='num_buckets',
+    parser.add_argument('-nres',
+                        '--num-resolvers',
+                        dest='num_resolvers',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Number of threads resolving stream URLs ahead of the '
+                             'workers (default = 0, workers resolve stream URLs themselves)')
+
+    parser.add_argument('-rqs',
+                        '--resolve-queue-size',
+                        dest='resolve_queue_size',
                         action='store',
                         type=int,
                         default=None,
-                        help="Number of buckets to store the downloaded files"
-                             " into (default = no bucketing)")
+                        help='Maximum number of resolved segments waiting for a worker '
+                             '(default = 2 * maximum number of jobs in flight)')
 
-    parser.add_argument('-nl',
-                        '--no-logging',
-                        dest='disable_logging',
-                        action='store_true',
-                        default=False,
-                        help='Disables logging if flag enabled')
+    parser.add_argument('-mif',
+                        '--max-in-flight',
+                        dest='max_in_flight',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Maximum number of download jobs submitted to the worker pool '
+                             'at any time (default = 2 * number of workers)')
 
-    parser.add_argument('-lp',
-                        '--log-path',
-                        dest='log_path',
+    parser.add_argument('-ce',
+                        '--command-engine',
+                        dest='command_engine',
                         action='store',
+                        choices=['processes', 'asyncio'],
+                        default='processes',
+                        help='How jobs run ffmpeg and ffprobe: "processes" runs jobs in '
+                             'worker processes that each wait for one command at a time, '
+                             'and "asyncio" runs jobs in threads of a single process, '
+                             'whose commands are all run by one asyncio event loop')
+
+    parser.add_argument('-msp',
+                        '--max-subprocesses',
+                        dest='max_subprocesses',
+                        action='store',
+                        type=int,
                         default=None,
-                        help='Path to log file generated by this script. ' \
-                             'By default, the path is "./audiosetdl.log".')
+                        help='Maximum number of ffmpeg and ffprobe commands running at '
+                             'a time with --command-engine asyncio (default = number of '
+                             'CPU cores)')
 
-    parser.add_argument('-v',
-                        '--verbose',
-                        dest='verbose',
+    parser.add_argument('-cto',
+                        '--command-timeout',
+                        dest='command_timeout',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='Number of seconds after which an ffmpeg or ffprobe command '
+                             'is killed, as if it failed (default = no timeout)')
+
+    parser.add_argument('-sto',
+                        '--shutdown-timeout',
+                        dest='shutdown_timeout',
+                        action='store',
+                        type=float,
+                        default=5.0,
+                        help='Number of seconds that running jobs are given to complete '
+                             'after a SIGTERM or Ctrl-C, after which they are killed and '
+                             'their segments are left pending for the next run')
+
+    parser.add_argument('-adc',
+                        '--adaptive-concurrency',
+                        dest='adaptive_concurrency',
                         action='store_true',
                         default=False,
-                        help='Prints verbose info to stdout')
-
-    parser.add_argument('data_dir',
+                        help='Adjusts the number of concurrent jobs at runtime, '
+                             'starting from the number of workers, depending on '
+                             'the rate of HTTP errors, the latency of segments '
+                             'and the CPU load')
+
+    parser.add_argument('-minw',
+                        '--min-workers',
+                        dest='min_workers',
                         action='store',
-                        type=str,
-                        help='Path to directory where AudioSet data will be stored')
-
-
-    return vars(parser.parse_args())
-
-
-def ffmpeg(ffmpeg_path, input_path, output_path, input_args=None,
-           output_args=None, log_level='error', num_retries=10,
-           validation_callback=None, validation_args=None):
-    """
-    Transform an input file using `ffmpeg`
-
-    Args:
-        ffmpeg_path:  Path to ffmpeg executable
-                      (Type: str)
-
-        input_path:   Path/URL to input file(s)
-                      (Type: str or iterable)
-
-        output_path:  Path/URL to output file
-                      (Type: str)
-
-        input_args:   Options/flags for input files
-                      (Type: list[str])
-
-        output_args:  Options/flags for output files
-                      (Type: list[str])
-
-        log_level:    ffmpeg logging level
-                      (Type: str)
-
-        num_retries:  Number of retries if ffmpeg encounters an HTTP issue
-                      (Type: int)
-    """
-
-    if type(input_path) == str:
-        inputs = ['-i', input_path]
-    elif isinstance(input_path, collections.Iterable):
-        inputs = []
-        for path in input_path:
-            inputs.append('-i')
-            inputs.append(path)
-    else:
-        error_msg = '"input_path" must be a str or an iterable, but got type {}'
-        raise ValueError(error_msg.format(str(type(input_path))))
-
-    if not input_args:
-        input_args = []
-    if not output_args:
-        output_args = []
-
-    last_err = None
-    for attempt in range(num_retries):
-        try:
-            args = [ffmpeg_path] + input_args + inputs + output_args + [output_path, '-loglevel', log_level]
-            run_command(args)
-
-            # Validate if a callback was passed in
-            if validation_callback is not None:
-                validation_args = validation_args or {}
-                validation_callback(output_path, **validation_args)
-            break
-        except SubprocessError as e:
-            last_err = e
-            stderr = e.cmd_stderr.rstrip()
-            if stderr.endswith('already exists. Exiting.'):
-                LOGGER.info('ffmpeg output file "{}" already exists.'.format(output_path))
-                break
-            elif HTTP_ERR_PATTERN.match(stderr):
-                # Retry if we got a 4XX or 5XX, in case it was just a network issue
-                continue
-
-            LOGGER.error(str(e) + '. Retrying...')
-            if os.path.exists(output_path):
-                os.remove(output_path)
-
-        except FfmpegIncorrectDurationError as e:
-            last_err = e
-            if attempt < num_retries - 1 and os.path.exists(output_path):
-                os.remove(output_path)
-            # If the duration of the output audio is different, alter the
-            # duration argument to account for this difference and try again
-            duration_diff = e.target_duration - e.actual_duration
-            try:
-                duration_idx = input_args.index('-t') + 1
-                input_args[duration_idx] = str(float(input_args[duration_idx]) + duration_diff)
-            except ValueError:
-                duration_idx = output_args.index('-t') + 1
-                output_args[duration_idx] = str(float(output_args[duration_idx]) + duration_diff)
-
-            LOGGER.warning(str(e) +'; Retrying...')
-            continue
-
-        except FfmpegUnopenableFileError as e:
-            last_err = e
-            # Always remove unopenable files
-            if os.path.exists(output_path):
-                os.remove(output_path)
-            # Retry if the output did not validate
-            LOGGER.info('ffmpeg output file "{}" could not be opened: {}. Retrying...'.format(output_path, e.open_error))
-            continue
-
-        except FfmpegValidationError as e:
-            last_err = e
-            if attempt < num_retries - 1 and os.path.exists(output_path):
-                os.remove(output_path)
-            # Retry if the output did not validate
-            LOGGER.info('ffmpeg output file "{}" did not validate: {}. Retrying...'.format(output_path, e))
-            continue
-    else:
-        error_msg = 'Maximum number of retries ({}) reached. Could not obtain inputs at {}. Error: {}'
-        LOGGER.error(error_msg.format(num_retries, input_path, str(last_err)))
-
-
-def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_path, num_buckets,
-                      audio_codec='flac', audio_format='flac',
-                      audio_sample_rate=48000, audio_bit_depth=16,
-                      video_codec='h264', video_format='mp4',
-                      video_mode='bestvideoaudio', video_frame_rate=30,
-                      num_retries=10):
-    """
-    Download a Youtube video (with the audio and video separated).
-
-    The audio will be saved in <output_dir>/audio and the video will be saved in
-    <output_dir>/video.
-
-    The output filename is of the format:
-        <YouTube ID>_<start time in ms>_<end time in ms>.<extension>
-
-    Args:
-        ytid:          Youtube ID string
-                       (Type: str)
-
-        ts_start:      Segment start time (in seconds)
-                       (Type: float)
-
-        ts_start:      Segment end time (in seconds)
-                       (Type: float)
-
-        output_dir:    Output directory where video will be saved
-                       (Type: str)
-
-        ffmpeg_path:   Path to ffmpeg executable
-                       (Type: str)
-
-        ffprobe_path:  Path to ffprobe executable
-                       (Type: str)
-
-    Keyword Args:
-        audio_codec:        Name of audio codec used by ffmpeg to encode
-                            output audio
-                            (Type: str)
-
-        audio_format:       Name of audio container format used for output audio
-                            (Type: str)
-
-        audio_sample_rate:  Target audio sample rate (in Hz)
-                            (Type: int)
-
-        audio_bit_depth:    Target audio sample bit depth
-                            (Type: int)
-
-        video_codec:        Name of video codec used by ffmpeg to encode
-                            output video
-                            (Type: str)
-
-        video_format:       Name of video container format used for output video
-                            (Type: str)
-
-        video_mode:         Name of the method in which video is downloaded.
-                            'bestvideo' obtains the best quality video that does not
-                            contain an audio stream. 'bestvideoaudio' obtains the
-                            best quality video that contains an audio stream.
-                            'bestvideowithaudio' obtains the best quality video
-                            without an audio stream and merges it with audio stream.
-                            (Type: bool)
-
-        video_frame_rate:   Target video frame rate (in fps)
-                            (Type: int)
-
-        num_retries:        Number of attempts to download and process an audio
-                            or video file with ffmpeg
-                            (Type: int)
-
-
-    Returns:
-        video_filepath:  Filepath to video file
-                         (Type: str)
-
-        audio_filepath:  Filepath to audio file
-                         (Type: str)
-    """
-    # Compute some things from the segment boundaries
-    duration = ts_end - ts_start
-
-    # Make the output format and video URL
-    # Output format is in the format:
-    #   <YouTube ID>_<start time in ms>_<end time in ms>.<extension>
-    media_filename = get_media_filename(ytid, ts_start, ts_end, num_buckets)
-    video_filepath = os.path.join(output_dir, 'video', media_filename + '.' + video_format)
-    audio_filepath = os.path.join(output_dir, 'audio', media_filename + '.' + audio_format)
-    video_page_url = 'https://www.youtube.com/watch?v={}'.format(ytid)
-
-    # Get the direct URLs to the videos with best audio and with best video (with audio)
-
-    video = pafy.new(video_page_url)
-    video_duration = video.length
-    end_past_video_end = False
-    if ts_end > video_duration:
-        warn_msg = "End time for segment ({} - {}) of video {} extends past end of video (length {} sec)"
-        LOGGER.warning(warn_msg.format(ts_start, ts_end, ytid, video_duration))
-        duration = video_duration - ts_start
-        ts_end = ts_start + duration
-        end_past_video_end = True
-
-    if video_mode in ('bestvideo', 'bestvideowithaudio', 'novideo'):
-        best_video = video.getbestvideo()
-        # If there isn't a video only option, go with best video with audio
-        if best_video is None:
-            best_video = video.getbest()
-    elif video_mode in ('bestvideoaudio', 'bestvideoaudionoaudio'):
-        best_video = video.getbest()
-    else:
-        raise ValueError('Invalid video mode: {}'.format(video_mode))
-    best_audio = video.getbestaudio()
-    best_video_url = best_video.url
-    best_audio_url = best_audio.url
-
-    audio_info = {
-        'sample_rate': audio_sample_rate,
-        'channels': 1,  # 2,
-        'bitrate': audio_bit_depth,
-        'encoding': audio_codec.upper(),
-        'duration': duration
-    }
-    video_info = {
-        "r_frame_rate": "{}/1".format(video_frame_rate),
-        "avg_frame_rate": "{}/1".format(video_frame_rate),
-        'codec_name': video_codec.lower(),
-        'duration': duration
-    }
-    # Download the audio
-    audio_input_args = ['-n', '-ss', str(ts_start)]
-    audio_output_args = ['-t', str(duration),
-                         '-ar', str(audio_sample_rate),
-                         '-vn',
-                         '-ac', str(audio_info['channels']),
-                         # '-sample_fmt', 's{}'.format(audio_bit_depth),
-                         '-f', audio_format,
-                         '-acodec', audio_codec]
-    ffmpeg(ffmpeg_path, best_audio_url, audio_filepath,
-           input_args=audio_input_args, output_args=audio_output_args,
-           num_retries=num_retries, # validation_callback=validate_audio,
-           validation_args={'audio_info': audio_info,
-                            'end_past_video_end': end_past_video_end})
-
-    if video_mode == 'novideo':
-        video_filepath = None
-    elif video_mode != 'bestvideowithaudio':
-        # Download the video
-        video_input_args = ['-n', '-ss', str(ts_start)]
-        video_output_args = ['-t', str(duration),
-                             '-f', video_format,
-                             '-r', str(video_frame_rate),
-                             '-vcodec', video_codec]
-        # Suppress audio stream if we don't want to audio in the video
-        if video_mode in ('bestvideo', 'bestvideoaudionoaudio'):
-            video_output_args.append('-an')
-
-        ffmpeg(ffmpeg_path, best_video_url, video_filepath,
-               input_args=video_input_args, output_args=video_output_args,
-               num_retries=num_retries, validation_callback=validate_video,
-               validation_args={'ffprobe_path': ffprobe_path,
-                                'video_info': video_info,
-                                'end_past_video_end': end_past_video_end})
-    else:
-        # Download the best quality video, in lossless encoding
-        if video_codec != 'h264':
-            error_msg = 'Not currently supporting merging of best quality video with video for codec: {}'
-            raise NotImplementedError(error_msg.format(video_codec))
-        video_input_args = ['-n', '-ss', str(ts_start)]
-        video_output_args = ['-t', str(duration),
-                             '-f', video_format,
-                             '-crf', '0',
-                             '-preset', 'medium',
-                             '-r', str(video_frame_rate),
-                             '-an',
-                             '-vcodec', video_codec]
-
-        ffmpeg(ffmpeg_path, best_video_url, video_filepath,
-               input_args=video_input_args, output_args=video_output_args,
-               num_retries=num_retries)
-
-        # Merge the best lossless video with the lossless audio, and compress
-        merge_video_filepath = os.path.splitext(video_filepath)[0] \
-                               + '_merge.' + video_format
-        video_input_args = ['-n']
-        video_output_args = ['-f', video_format,
-                             '-r', str(video_frame_rate),
-                             '-vcodec', video_codec,
-                             '-acodec', 'aac',
-                             '-ar', str(audio_sample_rate),
-                             '-ac', str(audio_info['channels']),
-                             '-strict', 'experimental']
-
-        ffmpeg(ffmpeg_path, [video_filepath, audio_filepath], merge_video_filepath,
-               input_args=video_input_args, output_args=video_output_args,
-               num_retries=num_retries, validation_callback=validate_video,
-               validation_args={'ffprobe_path': ffprobe_path,
-                                'video_info': video_info,
-                                'end_past_video_end': end_past_video_end})
-
-        # Remove the original video file and replace with the merged version
-        if os.path.exists(merge_video_filepath):
-            os.remove(video_filepath)
-            shutil.move(merge_video_filepath, video_filepath)
-        else:
-            error_msg = 'Cannot find merged video for {} ({} - {}) at {}'
-            LOGGER.error(error_msg.format(ytid, ts_start, ts_end, merge_video_filepath))
-
-    LOGGER.info('Downloaded video {} ({} - {})'.format(ytid, ts_start, ts_end))
-
-    return video_filepath, audio_filepath
-
-
-def segment_mp_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
-                      ffprobe_path, num_buckets, **ffmpeg_cfg):
-    """
-    Pool worker that downloads video segments.o
-
-    Wraps around the download_yt_video function to catch errors and log them.
-
-    Args:
-
-        ytid:          Youtube ID string
-                       (Type: str)
-
-        ts_start:      Segment start time (in seconds)
-                       (Type: float)
-
-        ts_end:        Segment end time (in seconds)
-                       (Type: float)
-
-        data_dir:      Directory where videos will be saved
-                       (Type: str)
-
-        ffmpeg_path:   Path to ffmpeg executable
-                       (Type: str)
-
-        ffprobe_path:  Path to ffprobe executable
-                       (Type: str)
-
-    Keyword Args:
-        **ffmpeg_cfg:  Configuration for audio and video
-                       downloading and decoding done by ffmpeg
-                       (Type: dict[str, *])
-    """
-    LOGGER.info('Attempting to download video {} ({} - {})'.format(ytid, ts_start, ts_end))
-
-    # Download the video
-    try:
-        download_yt_video(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
-                          ffprobe_path, num_buckets, **ffmpeg_cfg)
-    except SubprocessError as e:
-        err_msg = 'Error while downloading video {}: {}; {}'.format(ytid, e, tb.format_exc())
-        LOGGER.error(err_msg)
-    except Exception as e:
-        err_msg = 'Error while processing video {}: {}; {}'.format(ytid, e, tb.format_exc())
-        LOGGER.error(err_msg)
-
-
-def init_subset_data_dir(dataset_dir, subset_name, num_buckets=None):
-    """
-    Creates the data directories for the given subset
-
-    Args:
-        dataset_dir:  Path to dataset directory
-                      (Type: str)
-
-        subset_name:  Name of subset
-                      (Type: str)
-
-    Returns:
-        data_dir:  Path to subset data dir
-                   (Type: str)
-    """
-    # Derive audio and video directory names for this subset
-    data_dir = os.path.join(dataset_dir, 'data', subset_name)
-    audio_dir = os.path.join(data_dir, 'audio')
-    video_dir = os.path.join(data_dir, 'video')
-    os.makedirs(audio_dir, exist_ok=True)
-    os.makedirs(video_dir, exist_ok=True)
-    if num_buckets:
-        for i in range(num_buckets):
-            os.makedirs("%s/%03d" % (audio_dir, i), exist_ok=True)
-
-    return data_dir
-
-
-def download_subset_file(subset_url, dataset_dir):
-    """
-    Download a subset segments file from the given url to the given directory.
-
-    Args:
-        subset_url:   URL to subset segments file
-                      (Type: str)
-
-        dataset_dir:  Dataset directory where subset segment file will be stored
-                      (Type: str)
-
-    Returns:
-        subset_path:  Path to subset segments file
-                      (Type: str)
-
-    """
-    # Get filename of the subset file
-    subset_filename = get_filename(subset_url)
-    subset_name = get_subset_name(subset_url)
-    subset_path = os.path.join(dataset_dir, subset_filename)
-
-    os.makedirs(dataset_dir, exist_ok=True)
-
-    # Open subset file as a CSV
-    if not os.path.exists(subset_path):
-        LOGGER.info('Downloading subset file for "{}"'.format(subset_name))
-        with open(subset_path, 'w') as f:
-            subset_data = urllib.request.urlopen(subset_url).read().decode()
-            f.write(subset_data)
-
-    return subset_path
-
+                        type=int,
+                        default=1,
+                        help='Minimum number of concurrent jobs with adaptive concurrency')
 
-def download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
-                           num_workers, num_buckets, **ffmpeg_cfg):
-    """
-    Download subset segment file and videos
+    parser.add_argument('-maxw',
+                        '--max-workers',
+                        dest='max_workers',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Maximum number of concurrent jobs with adaptive '
+                             'concurrency (default = twice the number of workers)')
 
-    Args:
-        subset_path:   Path to subset segments file
-                       (Type: str)
+    parser.add_argument('-mer',
+                        '--max-error-rate',
+                        dest='max_error_rate',
+                        action='store',
+                        type=float,
+                        default=0.05,
+                        help='Fraction of segments with HTTP errors above which '
+                             'adaptive concurrency backs off')
+
+    parser.add_argument('-ml',
+                        '--max-load',
+                        dest='max_load',
+                        action='store',
+                        type=float,
+                        default=1.0,
+                        help='Load average per core above which adaptive '
+                             'concurrency backs off')
 
-        data_dir:      Directory where dataset files will be saved
-                       (Type: str)
+    parser.add_argument('-nb',
+                        '--num-buckets',
+                        dest='num_buckets',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help="Number of buckets to store the downloaded files"
+                             " into (default = no bucketing)")
 
-        ffmpeg_path:   Path to ffmpeg executable
-                       (Type: str)
+    parser.add_argument('-bl',
+                        '--bucket-levels',
+                        dest='bucket_levels',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='Number of levels of nested buckets to store the '
+                             'downloaded files into, each with --num-buckets '
+                             'buckets')
+
+    parser.add_argument('-shs',
+                        '--shard-size',
+                        dest='shard_size',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='Pack the outputs into tar shards of about this many '
+                             'megabytes in the "shards" directory of each subset, '
+                             'instead of keeping them as separate files')
 
-        ffprobe_path:  Path to ffprobe executable
-                       (Type: str)
+    parser.add_argument('-pcm',
+                        '--export-pcm-rate',
+                        dest='export_pcm_rate',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Once a subset is downloaded, export its audio as 16-bit '
+                             'PCM at this sample rate in a single file in the "pcm" '
+                             'directory of the subset (see export_pcm.py)')
 
-        num_workers:   Number of multiprocessing workers used to download videos
-                       (Type: int)
+    parser.add_argument('-ft',
+                        '--features',
+                        dest='features',
+                        action='store',
+                        choices=['logmel', 'stft'],
+                        default=None,
+                        help='Compute log-mel or log-magnitude STFT features of the '
+                             'audio of each segment, stored next to the audio as '
+                             '<ytid>.<features>.npy in float16')
 
-    Keyword Args:
-        **ffmpeg_cfg:  Configuration for audio and video
-                       downloading and decoding done by ffmpeg
-                       (Type: dict[str, *])
-    """
-    subset_name = get_subset_name(subset_path)
-
-    LOGGER.info('Starting download jobs for subset "{}"'.format(subset_name))
-    with open(subset_path, 'r') as f:
-        subset_data = csv.reader(f)
-
-        # Set up multiprocessing pool
-        pool = mp.Pool(num_workers)
-        try:
-            for row_idx, row in enumerate(subset_data):
-                # Skip commented lines
-                if row[0][0] == '#':
-                    continue
-                ytid, ts_start, ts_end = row[0], float(row[1]), float(row[2])
-
-                # Skip files that already have been downloaded
-                media_filename = get_media_filename(ytid, ts_start, ts_end, num_buckets)
-                video_filepath = os.path.join(data_dir, 'video', media_filename + '.' + ffmpeg_cfg.get('video_format', 'mp4'))
-                audio_filepath = os.path.join(data_dir, 'audio', media_filename + '.' + ffmpeg_cfg.get('audio_format', 'flac'))
-                if os.path.exists(audio_filepath):
-                    info_msg = 'Already downloaded audio {} ({} - {}). Skipping.'
-                    LOGGER.info(info_msg.format(ytid, ts_start, ts_end))
-                    continue
-                # if os.path.exists(video_filepath) and os.path.exists(audio_filepath):
-                #     info_msg = 'Already downloaded video {} ({} - {}). Skipping.'
-                #     LOGGER.info(info_msg.format(ytid, ts_start, ts_end))
-                #     continue
-
-                worker_args = [ytid, ts_start, ts_end, data_dir, ffmpeg_path, ffprobe_path, num_buckets]
-                pool.apply_async(partial(segment_mp_worker, **ffmpeg_cfg), worker_args)
-                # Run serially
-                #segment_mp_worker(*worker_args, **ffmpeg_cfg)
-
-        except csv.Error as e:
-            err_msg = 'Encountered error in {} at line {}: {}'
-            LOGGER.error(err_msg)
-            sys.exit(err_msg.format(subset_path, row_idx+1, e))
-        except KeyboardInterrupt:
-            LOGGER.info("Forcing exit.")
-            exit()
-        finally:
-            try:
-                pool.close()
-                pool.join()
-            except KeyboardInterrupt:
-                LOGGER.info("Forcing exit.")
-                exit()
-
-    LOGGER.info('Finished download jobs for subset "{}"'.format(subset_name))
-
-
-def download_random_subset_files(subset_url, dataset_dir, ffmpeg_path, ffprobe_path,
-                                 num_workers, num_buckets, max_videos=None,  **ffmpeg_cfg):
-    """
-    Download a a random subset (of size `max_videos`) of subset segment file and videos
+    parser.add_argument('-fsr',
+                        '--feature-sample-rate',
+                        dest='feature_sample_rate',
+                        action='store',
+                        type=int,
+                        default=16000,
+                        help='Sample rate (in Hz) at which features are computed')
 
-    Args:
-        subset_path:   Path to subset segments file
-                       (Type: str)
+    parser.add_argument('-fwd',
+                        '--feature-window',
+                        dest='feature_window',
+                        action='store',
+                        type=float,
+                        default=0.025,
+                        help='Duration (in seconds) of the analysis window of features')
 
-        dataset_dir:   Directory where dataset files will be saved
-                       (Type: str)
+    parser.add_argument('-fhd',
+                        '--feature-hop',
+                        dest='feature_hop',
+                        action='store',
+                        type=float,
+                        default=0.010,
+                        help='Time (in seconds) between consecutive feature frames')
 
-        ffmpeg_path:   Path to ffmpeg executable
-                       (Type: str)
+    parser.add_argument('-nmel',
+                        '--num-mels',
+                        dest='num_mels',
+                        action='store',
+                        type=int,
+                        default=64,
+                        help='Number of mel bands of log-mel features')
 
-        ffprobe_path:  Path to ffprobe executable
-                       (Type: str)
+    parser.add_argument('-sa',
+                        '--stream-audio',
+                        dest='stream_audio',
+                        action='store_true',
+                        default=False,
+                        help='Decode the audio of segments from the output of ffmpeg '
+                             'into memory and hand it to --stream-sink, instead of '
+                             'writing audio files. The video is not downloaded.')
 
-        num_workers:   Number of multiprocessing workers used to download videos
-                       (Type: int)
+    parser.add_argument('-ssk',
+                        '--stream-sink',
+                        dest='stream_sink',
+                        action='store',
+                        choices=['pcm', 'shards', 'features'],
+                        default='pcm',
+                        help='Where the streamed audio is stored: "pcm" appends it to '
+                             'the PCM export of each subset (see export_pcm.py), '
+                             '"shards" packs it into tar shards of --shard-size '
+                             'megabytes and "features" only keeps its --features')
+
+    parser.add_argument('-nm',
+                        '--no-manifest',
+                        dest='disable_manifest',
+                        action='store_true',
+                        default=False,
+                        help='Disables the segment manifest database and checks for '
+                             'existing output files instead')
 
-    Keyword Args:
-        max_videos:    Maximum number of videos to download in this subset. If
-                       None, download all files in this subset.
-                       (Type int or None)
+    parser.add_argument('-ma',
+                        '--max-attempts',
+                        dest='max_attempts',
+                        action='store',
+                        type=int,
+                        default=3,
+                        help='Maximum number of attempts for a segment tracked '
+                             'in the manifest')
 
-        **ffmpeg_cfg:  Configuration for audio and video
-                       downloading and decoding done by ffmpeg
-                       (Type: dict[str, *])
-    """
-    # FIXME: This code is outdated and shouldn't be used
-    # Validate max_videos
-    if max_videos is not None and (max_videos < 1 or type(max_videos) != int):
-        err_msg = 'max_videos must be a positive integer, or None'
-        LOGGER.error(err_msg)
-        raise ValueError(err_msg)
-
-    # Get filename of the subset file
-    subset_filename = get_filename(subset_url)
-    subset_name = get_subset_name(subset_url)
-    subset_path = os.path.join(dataset_dir, subset_filename)
-    data_dir = init_subset_data_dir(dataset_dir, subset_name, num_buckets)
-
-    # Open subset file as a CSV
-    if not os.path.exists(subset_path):
-        LOGGER.info('Downloading subset file for "{}"'.format(subset_name))
-        with open(subset_path, 'w') as f:
-            subset_data = urllib.request.urlopen(subset_url).read().decode()
-            f.write(subset_data)
-
-    subset_data = []
-    LOGGER.info('Starting download jobs for random subset (of size {}) of subset "{}"'.format(max_videos, subset_name))
-    with open(subset_path, 'r') as f:
-        subset_data_reader = csv.reader(f)
-        try:
-            for row_idx, row in enumerate(subset_data_reader):
-                # Skip commented lines
-                if row[0][0] == '#':
-                    continue
-
-                subset_data.append(row[:3])
-        except csv.Error as e:
-            err_msg = 'Encountered error in {} at line {}: {}'
-            LOGGER.error(err_msg)
-            sys.exit(err_msg.format(subset_filename, row_idx+1, e))
+    parser.add_argument('-co',
+                        '--coordinate',
+                        dest='coordinate',
+                        action='store_true',
+                        default=False,
+                        help='Claim batches of videos from the manifest, shared with '
+                             'any number of other processes using the same data '
+                             'directory, e.g. on other nodes, instead of downloading '
+                             'every segment of the subsets')
+
+    parser.add_argument('-lbs',
+                        '--lease-batch-size',
+                        dest='lease_batch_size',
+                        action='store',
+                        type=int,
+                        default=16,
+                        help='Number of videos claimed at a time with --coordinate')
 
-    # Shuffle data
-    random.shuffle(subset_data)
+    parser.add_argument('-lt',
+                        '--lease-timeout',
+                        dest='lease_timeout',
+                        action='store',
+                        type=float,
+                        default=300.0,
+                        help='Number of seconds after which the videos claimed by a '
+                             'process that stopped renewing its leases are claimed by '
+                             'other processes, with --coordinate, and after which the '
+                             'temporary files of processes of other hosts are removed')
+
+    parser.add_argument('-nsc',
+                        '--no-stream-cache',
+                        dest='disable_stream_cache',
+                        action='store_true',
+                        default=False,
+                        help='Disables caching of resolved stream URLs')
 
-    # Set up multiprocessing pool
-    pool = mp.Pool(num_workers)
-    try:
-        for idx, row in enumerate(subset_data):
-            worker_args = [row[0], float(row[1]), float(row[2]), data_dir, ffmpeg_path, ffprobe_path, num_buckets]
-            pool.apply_async(partial(segment_mp_worker, **ffmpeg_cfg), worker_args)
-            # Run serially
-            #segment_mp_worker(*worker_args, **ffmpeg_cfg)
-
-            if max_videos is not None:
-                if idx + 1 >= max_videos:
-                    info_msg = 'Reached maximum ({}) for subset {}'
-                    LOGGER.info(info_msg.format(max_videos, subset_name))
-                    break
-    except KeyboardInterrupt:
-        LOGGER.info("Forcing exit.")
-        exit()
-    finally:
-        try:
-            pool.close()
-            pool.join()
-        except KeyboardInterrupt:
-            LOGGER.info("Forcing exit.")
-            exit()
+    parser.add_argument('-sct',
+                        '--stream-cache-ttl',
+                        dest='stream_cache_ttl',
+                        action='store',
+                        type=float,
+                        default=14400,
+                        help='Maximum number of seconds resolved stream URLs are cached')
 
-    LOGGER.info('Finished download jobs for subset "{}"'.format(subset_name))
+    parser.add_argument('-scs',
+                        '--stream-cache-size',
+                        dest='stream_cache_size',
+                        action='store',
+                        type=int,
+                        default=100000,
+                        help='Maximum number of videos in the stream cache')
 
+    parser.add_argument('-mp',
+                        '--metrics-path',
+                        dest='metrics_path',
+                        action='store',
+                        default=None,
+                        help='Path to a file where metrics are periodically written '
+                             'in the Prometheus text format, e.g. for the textfile '
+                             'collector of the node exporter')
 
-def download_subset(subset_path, dataset_dir, ffmpeg_path, ffprobe_path,
-                    num_workers, num_buckets, **ffmpeg_cfg):
-    """
-    Download all files for a subset, including the segment file, and the audio and video files.
+    parser.add_argument('-mi',
+                        '--metrics-interval',
+                        dest='metrics_interval',
+                        action='store',
+                        type=float,
+                        default=15.0,
+                        help='Number of seconds between rewrites of the metrics file')
 
-    Args:
-        subset_path:    Path to subset segments file
-                        (Type: str)
+    parser.add_argument('-sp',
+                        '--summary-path',
+                        dest='summary_path',
+                        action='store',
+                        default=None,
+                        help='Path to a file where a JSON summary of the metrics '
+                             'is written at the end of the run')
 
-        dataset_dir:    Path to dataset directory where files are saved
-                        (Type: str)
+    parser.add_argument('-nnc',
+                        '--no-negative-cache',
+                        dest='disable_negative_cache',
+                        action='store_true',
+                        default=False,
+                        help='Disables the cache of videos that failed with a permanent '
+                             'error (e.g. removed or blocked), which are otherwise '
+                             'skipped by later runs')
 
-        ffmpeg_path:    Path to ffmpeg executable
-                        (Type: str)
+    parser.add_argument('-nct',
+                        '--negative-cache-ttl',
+                        dest='negative_cache_ttl',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='Number of seconds after which a video that failed with a '
+                             'permanent error is tried again (default = never)')
 
-        ffprobe_path:   Path to ffprobe executable
-                        (Type: str)
+    parser.add_argument('-rb',
+                        '--retry-backoff',
+                        dest='retry_backoff',
+                        action='store',
+                        type=float,
+                        default=1.0,
+                        help='Maximum delay (in seconds) before retrying after the first '
+                             'transient failure, which doubles after every failure '
+                             '(0 = retry right away)')
+
+    parser.add_argument('-rbm',
+                        '--retry-backoff-max',
+                        dest='retry_backoff_max',
+                        action='store',
+                        type=float,
+                        default=60.0,
+                        help='Maximum delay (in seconds) before any retry')
 
-        num_workers:    Number of workers to download and process videos
-                        (Type: int)
+    parser.add_argument('-nl',
+                        '--no-logging',
+                        dest='disable_logging',
+                        action='store_true',
+                        default=False,
+                        help='Disables logging if flag enabled')
 
-    Keyword Args:
-        **ffmpeg_cfg:                   Configuration for audio and video
-                                        downloading and decoding done by ffmpeg
-                                        (Type: dict[str, *])
+    parser.add_argument('-lp',
+                        '--log-path',
+                        dest='log_path',
+                        action='store',
+                        default=None,
+                        help='Path to log file generated by this script. ' \
+                             'By default, the path is "./audiosetdl.log".')
 
-    Returns:
+    parser.add_argument('-v',
+                        '--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        default=False,
+                        help='Prints verbose info to stdout')
 
-    """
-    if is_url(subset_path):
-        subset_path = download_subset_file(subset_path, dataset_dir)
+    parser.add_argument('data_dir',
+                        action='store',
+                        type=str,
+                        help='Path to directory where AudioSet data will be stored')
 
-    subset_name = get_subset_name(subset_path)
-    data_dir = init_subset_data_dir(dataset_dir, subset_name, num_buckets)
 
-    download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
-                           num_workers, num_buckets, **ffmpeg_cfg)
+    return vars(parser.parse_args())
 
 
 def download_audioset(data_dir, ffmpeg_path, ffprobe_path, eval_segments_path,
                       balanced_train_segments_path, unbalanced_train_segments_path,
                       disable_logging=False, verbose=False, num_workers=4,
-                      num_buckets=None, log_path=None, **ffmpeg_cfg):
+                      num_buckets=None, max_in_flight=None, disable_manifest=False,
+                      max_attempts=3, disable_stream_cache=False, num_resolvers=0,
+                      resolve_queue_size=None, metrics_path=None, summary_path=None,
+                      metrics_interval=15.0, adaptive_concurrency=False,
+                      min_workers=1, max_workers=None, max_error_rate=0.05,
+                      max_load=1.0, disable_negative_cache=False,
+                      negative_cache_ttl=None, coordinate=False, lease_batch_size=16,
+                      lease_timeout=300.0, shard_size=None, export_pcm_rate=None,
+                      stream_sink='pcm', command_engine='processes', max_subprocesses=None,
+                      command_timeout=None, shutdown_timeout=5.0, log_path=None,
+                      **ffmpeg_cfg):
     """
     Download AudioSet files
 
@@ -897,6 +663,147 @@ def download_audioset(data_dir, ffmpeg_path, ffprobe_path, eval_segments_path,
                                         to download videos
                                         (Type: int)
 
+        max_in_flight:                  Maximum number of jobs submitted to
+                                        the worker pool at any time. If None,
+                                        twice the number of workers.
+                                        (Type: int or None)
+
+        disable_manifest:               If True, do not keep track of segments
+                                        in '<data_dir>/manifest.db' and check
+                                        for existing outputs instead
+                                        (Type: bool)
+
+        max_attempts:                   Maximum number of attempts for a
+                                        segment tracked in the manifest
+                                        (Type: int or None)
+
+        disable_stream_cache:           If True, do not cache resolved stream
+                                        URLs in '<data_dir>/stream_cache.db'
+                                        (Type: bool)
+
+        num_resolvers:                  Number of threads resolving streams.
+                                        If 0, streams are resolved by the
+                                        worker processes.
+                                        (Type: int)
+
+        resolve_queue_size:             Maximum number of resolved segments
+                                        waiting for a worker process. If None,
+                                        twice the maximum number of jobs in
+                                        flight.
+                                        (Type: int or None)
+
+        metrics_path:                   Path of the file where metrics are
+                                        periodically written in the Prometheus
+                                        text format. If None, not written.
+                                        (Type: str or None)
+
+        summary_path:                   Path of the file where a JSON summary
+                                        of the metrics is written at the end
+                                        of the run. If None, not written.
+                                        (Type: str or None)
+
+        metrics_interval:               Number of seconds between rewrites of
+                                        the metrics file
+                                        (Type: float)
+
+        adaptive_concurrency:           If True, the number of concurrent jobs
+                                        starts at `num_workers` and is adjusted
+                                        between `min_workers` and `max_workers`
+                                        depending on the rate of HTTP errors,
+                                        the latency of segments and the CPU
+                                        load
+                                        (Type: bool)
+
+        min_workers:                    Minimum number of concurrent jobs with
+                                        adaptive concurrency
+                                        (Type: int)
+
+        max_workers:                    Maximum number of concurrent jobs with
+                                        adaptive concurrency. If None, twice
+                                        the number of workers.
+                                        (Type: int or None)
+
+        max_error_rate:                 Fraction of segments with HTTP errors
+                                        above which adaptive concurrency backs
+                                        off
+                                        (Type: float)
+
+        max_load:                       Load average per core above which
+                                        adaptive concurrency backs off
+                                        (Type: float)
+
+        disable_negative_cache:         If True, do not keep track of videos
+                                        that failed permanently in
+                                        '<data_dir>/negative_cache.db', and
+                                        try them again on every run
+                                        (Type: bool)
+
+        negative_cache_ttl:             Number of seconds after which a video
+                                        that failed permanently is tried
+                                        again. If None, never.
+                                        (Type: float or None)
+
+        coordinate:                     If True, claim batches of videos from
+                                        the manifest, which is shared with the
+                                        other processes that use the same data
+                                        directory
+                                        (Type: bool)
+
+        lease_batch_size:               Number of videos claimed at a time
+                                        (Type: int)
+
+        lease_timeout:                  Number of seconds after which the
+                                        videos claimed by a process that
+                                        stopped renewing its leases can be
+                                        claimed by other processes, and after
+                                        which temporary files of processes of
+                                        other hosts are removed
+                                        (Type: float)
+
+        shard_size:                     If given, the outputs are packed into
+                                        tar shards of about this many
+                                        megabytes, with an index of the
+                                        offsets of their samples
+                                        (Type: float or None)
+
+        export_pcm_rate:                If given, the audio of each subset is
+                                        exported as 16-bit PCM at this sample
+                                        rate once the subset is downloaded
+                                        (Type: int or None)
+
+        stream_sink:                    Where the audio is stored if it is
+                                        streamed (`stream_audio` in
+                                        `ffmpeg_cfg`): 'pcm' for the PCM
+                                        export of each subset, 'shards' for
+                                        tar shards, or 'features' to only keep
+                                        the features of the segments
+                                        (Type: str)
+
+        command_engine:                 How the download jobs run ffmpeg and
+                                        ffprobe: 'processes' runs the jobs in
+                                        worker processes, and 'asyncio' runs
+                                        them in threads of this process,
+                                        whose commands are all run by a
+                                        `executor.CommandExecutor`
+                                        (Type: str)
+
+        max_subprocesses:               Maximum number of commands running
+                                        at a time with the 'asyncio' engine.
+                                        If None, the number of CPU cores.
+                                        (Type: int or None)
+
+        command_timeout:                Number of seconds after which a
+                                        command is killed. If None, no
+                                        timeout.
+                                        (Type: float or None)
+
+        shutdown_timeout:               Number of seconds that running jobs
+                                        are given to complete after SIGTERM
+                                        or SIGINT, after which they are
+                                        killed and their segments are left
+                                        pending in the manifest
+                                        (Type: float)
+
         log_path:                       Path where log file will be saved. If
                                         None, saved to './audiosetdl.log'
                                         (Type: str or None)
@@ -911,21 +818,114 @@ def download_audioset(data_dir, ffmpeg_path, ffprobe_path, eval_segments_path,
     multiprocessing_logging.install_mp_handler()
     LOGGER.debug('Initialized logging.')
 
-    if eval_segments_path:
-        download_subset(eval_segments_path, data_dir, ffmpeg_path, ffprobe_path,
-                        num_workers, num_buckets, **ffmpeg_cfg)
+    # Stream URLs are only worth caching when they come from YouTube
+    if not disable_stream_cache and ffmpeg_cfg.get('source', 'pafy') == 'pafy':
+        os.makedirs(data_dir, exist_ok=True)
+        ffmpeg_cfg['stream_cache_path'] = os.path.join(data_dir, 'stream_cache.db')
+
+    negative_cache_path = None
+    if not disable_negative_cache:
+        os.makedirs(data_dir, exist_ok=True)
+        negative_cache_path = os.path.join(data_dir, 'negative_cache.db')
+
+    manifest = None
+    if not disable_manifest:
+        manifest = Manifest(os.path.join(data_dir, 'manifest.db'))
+
+    stream_audio = ffmpeg_cfg.get('stream_audio', False)
+    if stream_audio:
+        if stream_sink == 'shards':
+            shard_size = shard_size or 1024
+        else:
+            shard_size = None
+
+    if (shard_size or stream_audio) and manifest is None:
+        err_msg = 'Packing outputs into shards or streaming audio requires the manifest'
+        LOGGER.error(err_msg)
+        sys.exit(err_msg)
+
+    if (export_pcm_rate or (stream_audio and stream_sink == 'pcm')) \
+            and (shard_size or coordinate):
+        err_msg = 'Exporting audio as PCM cannot be combined with shards or coordinated runs'
+        LOGGER.error(err_msg)
+        sys.exit(err_msg)
 
-    if balanced_train_segments_path:
-        download_subset(balanced_train_segments_path, data_dir, ffmpeg_path, ffprobe_path,
-                        num_workers, num_buckets, **ffmpeg_cfg)
+    if stream_audio and stream_sink == 'features' and not ffmpeg_cfg.get('features'):
+        err_msg = 'Keeping only the features of streamed audio requires --features'
+        LOGGER.error(err_msg)
+        sys.exit(err_msg)
 
-    if unbalanced_train_segments_path:
-        download_subset(unbalanced_train_segments_path, data_dir, ffmpeg_path, ffprobe_path,
-                        num_workers, num_buckets, **ffmpeg_cfg)
+    if export_pcm_rate and stream_audio:
+        err_msg = 'Streamed audio is not written to files that can be exported as PCM'
+        LOGGER.error(err_msg)
+        sys.exit(err_msg)
+
+    lease_owner = None
+    heartbeat = None
+    if coordinate:
+        if manifest is None:
+            err_msg = 'Coordination with other processes requires the manifest'
+            LOGGER.error(err_msg)
+            sys.exit(err_msg)
+        lease_owner = get_lease_owner()
+        heartbeat = LeaseHeartbeat(manifest.path, lease_owner, lease_timeout=lease_timeout)
+        heartbeat.start()
+        LOGGER.info('Claiming videos from {} as {}'.format(manifest.path, lease_owner))
+
+    metrics = Metrics()
+    reporter = MetricsReporter(metrics, metrics_path=metrics_path,
+                               summary_path=summary_path, interval=metrics_interval)
+    reporter.start()
+
+    concurrency = None
+    if adaptive_concurrency:
+        concurrency = AdaptiveConcurrency(min_workers, max_workers or 2 * num_workers,
+                                          initial_limit=num_workers,
+                                          max_error_rate=max_error_rate, max_load=max_load)
+
+    command_executor = None
+    if command_engine == 'asyncio':
+        command_executor = CommandExecutor(max_subprocesses or os.cpu_count())
+
+    # A preempted job is sent SIGTERM, and is then expected to exit quickly
+    shutdown = ShutdownHandler()
+    shutdown.install()
+    try:
+        for subset_path in (eval_segments_path, balanced_train_segments_path,
+                            unbalanced_train_segments_path):
+            if shutdown.requested:
+                break
+            if subset_path:
+                download_subset(subset_path, data_dir, ffmpeg_path, ffprobe_path,
+                                num_workers, num_buckets, max_in_flight=max_in_flight,
+                                manifest=manifest, max_attempts=max_attempts,
+                                num_resolvers=num_resolvers,
+                                resolve_queue_size=resolve_queue_size, metrics=metrics,
+                                concurrency=concurrency,
+                                negative_cache_path=negative_cache_path,
+                                negative_cache_ttl=negative_cache_ttl,
+                                lease_owner=lease_owner, lease_batch_size=lease_batch_size,
+                                lease_timeout=lease_timeout,
+                                shard_size=int(shard_size * 1024 * 1024) if shard_size else None,
+                                export_pcm_rate=export_pcm_rate, stream_sink=stream_sink,
+                                command_executor=command_executor,
+                                command_timeout=command_timeout, stop_event=shutdown.event,
+                                stop_timeout=shutdown_timeout, **ffmpeg_cfg)
+    finally:
+        shutdown.restore()
+        if command_executor is not None:
+            command_executor.close()
+        reporter.stop()
+        if manifest is not None:
+            manifest.close()
+        if heartbeat is not None:
+            heartbeat.stop()
+
+    if shutdown.requested:
+        err_msg = 'Stopped by {}'.format(signal.Signals(shutdown.signum).name)
+        LOGGER.error(err_msg)
+        sys.exit(err_msg)
 
 
 if __name__ == '__main__':
-    # TODO: Handle killing of ffmpeg (https://stackoverflow.com/questions/6488275/terminal-text-becomes-invisible-after-terminating-subprocess)
-    #       so we don't have to use this hack
-    atexit.register(lambda: os.system('stty sane') if sys.stdin.isatty() else None)
     download_audioset(**parse_arguments())
@@ -17,6 +17,19 @@ class SubprocessError(Exception):
         super(SubprocessError, self).__init__(msg, *args)
 
 
+class CommandTimeoutError(SubprocessError):
+    """
+    Exception object that is raised when a command line command is killed
+    because it did not complete within its timeout.
+    """
+    def __init__(self, cmd, timeout, stdout, stderr, *args):
+        # The command is killed with SIGKILL
+        super(CommandTimeoutError, self).__init__(cmd, -9, stdout, stderr, *args)
+        self.timeout = timeout
+        self.args = ('Command "{}" did not complete within {} seconds'.format(cmd[0], timeout),) \
+            + args
+
+
 class FfmpegValidationError(Exception):
     """
     Exception object that is raised when `ffmpeg` output does not validate.
@@ -46,3 +59,15 @@ class FfmpegUnopenableFileError(FfmpegValidationError):
         self.open_error = e
         msg = "Output at {} could not be opened: {}".format(filepath, str(e))
         super(FfmpegValidationError, self).__init__( msg, *args)
+
+
+class SourceUnavailableError(Exception):
+    """
+    Exception object that is raised when a source backend cannot provide media for a video
+    """
+    def __init__(self, ytid, reason, *args, permanent=True):
+        self.ytid = ytid
+        self.reason = reason
+        self.permanent = permanent
+        msg = "Media for video {} is not available: {}".format(ytid, reason)
+        super(SourceUnavailableError, self).__init__(msg, *args)
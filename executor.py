@@ -0,0 +1,177 @@
+"""
+Execution of ffmpeg and ffprobe commands as subprocesses of a single asyncio
+event loop
+"""
+import asyncio
+import os
+import signal
+import subprocess as sp
+import threading
+
+from errors import SubprocessError, CommandTimeoutError
+
+# Number of bytes read from the pipes of a command at a time
+READ_CHUNK_SIZE = 1 << 16
+
+
+async def _read_pipe(stream, callback, chunk_size=READ_CHUNK_SIZE):
+    """
+    Read a pipe of a subprocess incrementally until it is closed, and hand
+    every chunk to a callback
+    """
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        callback(chunk)
+
+
+def _kill(proc):
+    # Every command leads its own process group, which is killed as a whole
+    if proc.returncode is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class CommandExecutor(object):
+    """
+    Runs commands as subprocesses of an asyncio event loop that runs in a
+    background thread, so that any number of threads can wait for commands
+    without tying up a process each.
+
+    At most `max_concurrency` commands run at a time. The standard output and
+    error of every command are read as they are written, so that no command
+    blocks on a full pipe. A command that does not complete within its
+    timeout, or whose call is interrupted, is killed. Commands run in their
+    own process group, so that they never receive the signals of the
+    terminal, and are only stopped by the executor.
+    """
+
+    def __init__(self, max_concurrency):
+        """
+        Args:
+            max_concurrency:  Maximum number of commands running at a time
+                              (Type: int)
+        """
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._procs = set()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run_loop, name='CommandExecutor')
+        self._thread.daemon = True
+        self._thread.start()
+        self._semaphore = self._wait(self._create_semaphore())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _create_semaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    def _wait(self, coro):
+        with self._lock:
+            # Coroutines submitted once the loop is stopped would never run
+            if self._closed:
+                coro.close()
+                raise RuntimeError('The command executor is closed')
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            # Kills the command if the calling thread is interrupted
+            future.cancel()
+            raise
+
+    async def _run(self, cmd, timeout, on_stdout):
+        async with self._semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE,
+                start_new_session=True)
+            self._procs.add(proc)
+            stdout_chunks = []
+            stderr_chunks = []
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(_read_pipe(proc.stdout, on_stdout or stdout_chunks.append),
+                                   _read_pipe(proc.stderr, stderr_chunks.append),
+                                   proc.wait()),
+                    timeout)
+            except asyncio.TimeoutError:
+                _kill(proc)
+                await proc.wait()
+                raise CommandTimeoutError(cmd, timeout, b''.join(stdout_chunks).decode(),
+                                          b''.join(stderr_chunks).decode())
+            except BaseException:
+                _kill(proc)
+                await proc.wait()
+                raise
+            finally:
+                self._procs.discard(proc)
+
+        stdout = b''.join(stdout_chunks)
+        stderr = b''.join(stderr_chunks)
+        if proc.returncode != 0:
+            raise SubprocessError(cmd, proc.returncode, stdout.decode(), stderr.decode())
+        return stdout, stderr, proc.returncode
+
+    def run(self, cmd, timeout=None, on_stdout=None):
+        """
+        Run a command and wait for it to complete
+
+        Args:
+            cmd:        List of strings used in the command
+                        (Type: list[str])
+
+        Keyword Args:
+            timeout:    Number of seconds after which the command is killed.
+                        If None, no timeout.
+                        (Type: float or None)
+
+            on_stdout:  Function called from the event loop with every chunk
+                        of the standard output, which is then not returned
+                        (Type: callable[[bytes], None] or None)
+
+        Returns:
+            stdout:       stdout string produced by running command
+                          (Type: bytes)
+
+            stderr:       stderr string produced by running command
+                          (Type: bytes)
+
+            return_code:  Exit/return code from running command
+                          (Type: int)
+        """
+        return self._wait(self._run(cmd, timeout, on_stdout))
+
+    def kill_all(self):
+        """
+        Kill all the commands that are running. Their calls raise a
+        `SubprocessError`.
+        """
+        def kill_all():
+            for proc in list(self._procs):
+                _kill(proc)
+        self.loop.call_soon_threadsafe(kill_all)
+
+    def close(self):
+        """
+        Kill all the commands that are running, and stop the event loop
+        """
+        async def cancel_all():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        asyncio.run_coroutine_threadsafe(cancel_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
@@ -0,0 +1,657 @@
+#!/usr/bin/env python
+"""
+Exports the downloaded audio of AudioSet subsets as decoded PCM in a single
+contiguous file per subset, with an index of the offset of every segment, so
+that clips can be read as memory-mapped slices instead of being decoded again
+"""
+import argparse
+import collections
+import fcntl
+import json
+import logging
+import multiprocessing as mp
+import os
+import sys
+
+import numpy as np
+import soundfile as sf
+
+from errors import SubprocessError
+from log import init_console_logger
+from scheduler import init_pool_worker, imap_bounded, read_segments, get_row_labels
+from utils import run_command, get_temp_path, publish_file, get_media_filename, \
+    read_layout, get_subset_name, write_atomic
+
+LOGGER = logging.getLogger('audiosetdl')
+LOGGER.setLevel(logging.DEBUG)
+
+# Directory of the export in the data directory of a subset
+PCM_DIRNAME = 'pcm'
+PCM_FILENAME = 'audio.pcm'
+INDEX_FILENAME = 'index.npy'
+JOURNAL_FILENAME = 'index.journal'
+INFO_FILENAME = 'info.json'
+
+PCM_DTYPE = np.dtype('<i2')
+
+ONTOLOGY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ontology.json')
+
+
+def parse_arguments():
+    """
+    Parse arguments from the command line
+
+
+    Returns:
+        args:  Argument dictionary
+               (Type: dict[str, str])
+    """
+    parser = argparse.ArgumentParser(description='Export the downloaded audio of AudioSet '
+                                                 'subsets as memory-mappable PCM')
+
+    parser.add_argument('-f',
+                        '--ffmpeg',
+                        dest='ffmpeg_path',
+                        action='store',
+                        type=str,
+                        default='./bin/ffmpeg/ffmpeg',
+                        help='Path to ffmpeg executable')
+
+    parser.add_argument('-sr',
+                        '--sample-rate',
+                        dest='sample_rate',
+                        action='store',
+                        type=int,
+                        default=16000,
+                        help='Sample rate of the exported audio, in Hz')
+
+    parser.add_argument('-af',
+                        '--audio-format',
+                        dest='audio_format',
+                        action='store',
+                        type=str,
+                        default='flac',
+                        help='Extension of the downloaded audio files')
+
+    parser.add_argument('-s',
+                        '--subset',
+                        dest='subsets',
+                        action='append',
+                        default=None,
+                        help='Name of a subset to export, e.g. eval_segments, or '
+                             'path to its segments file if it is not in the data '
+                             'directory. Can be given multiple times (default = all '
+                             'subsets)')
+
+    parser.add_argument('-n',
+                        '--num-workers',
+                        dest='num_workers',
+                        action='store',
+                        type=int,
+                        default=mp.cpu_count(),
+                        help='Number of processes that decode audio in parallel')
+
+    parser.add_argument('-ci',
+                        '--checkpoint-interval',
+                        dest='checkpoint_interval',
+                        action='store',
+                        type=int,
+                        default=256,
+                        help='Number of exported segments between checkpoints, '
+                             'from which an interrupted export is resumed')
+
+    parser.add_argument('-v',
+                        '--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        default=False,
+                        help='If True, prints detailed information about the export')
+
+    parser.add_argument('data_dir',
+                        action='store',
+                        type=str,
+                        help='Path to directory where AudioSet data is stored')
+
+    return vars(parser.parse_args())
+
+
+def get_label_vocabulary(ontology_path=ONTOLOGY_PATH):
+    """
+    Get the label IDs of the AudioSet ontology, in the order of the bits of
+    the label bitmasks
+
+    Keyword Args:
+        ontology_path:  Path to the ontology JSON file
+                        (Type: str)
+
+    Returns:
+        label_ids:  Label IDs
+                    (Type: list[str])
+    """
+    with open(ontology_path, 'r') as f:
+        return [node['id'] for node in json.load(f)]
+
+
+def get_index_dtype(num_labels):
+    """
+    Get the NumPy dtype of the records of the index of an export
+
+    Args:
+        num_labels:  Number of labels in the vocabulary
+                     (Type: int)
+
+    Returns:
+        dtype:  Structured dtype with the fields ytid, ts_start, offset (in
+                samples), num_samples and labels (bitmask packed into bytes)
+                (Type: numpy.dtype)
+    """
+    return np.dtype([('ytid', 'S16'),
+                     ('ts_start', '<f8'),
+                     ('offset', '<i8'),
+                     ('num_samples', '<i8'),
+                     ('labels', 'u1', ((num_labels + 7) // 8,))])
+
+
+def decode_audio(ytid, ts_start, audio_filepath, ffmpeg_path, sample_rate):
+    """
+    Decode an audio file into mono 16-bit PCM at the given sample rate. Files
+    already at that sample rate are decoded with libsndfile, and the others
+    are resampled by ffmpeg.
+
+    Args:
+        ytid:            YouTube ID of the segment
+                         (Type: str)
+
+        ts_start:        Segment start time (in seconds)
+                         (Type: float)
+
+        audio_filepath:  Path to audio file
+                         (Type: str)
+
+        ffmpeg_path:     Path to ffmpeg executable
+                         (Type: str)
+
+        sample_rate:     Sample rate of the decoded audio, in Hz
+                         (Type: int)
+
+    Returns:
+        ytid:      YouTube ID of the segment
+                   (Type: str)
+
+        ts_start:  Segment start time (in seconds)
+                   (Type: float)
+
+        data:      Decoded samples, or None if the file could not be decoded
+                   (Type: bytes or None)
+
+        error:     Error message if the file could not be decoded
+                   (Type: str or None)
+    """
+    try:
+        if sf.info(audio_filepath).samplerate == sample_rate:
+            samples, _ = sf.read(audio_filepath, dtype='int16', always_2d=True)
+            if samples.shape[1] > 1:
+                samples = np.round(samples.mean(axis=1))
+            data = samples.astype(PCM_DTYPE).tobytes()
+        else:
+            cmd = [ffmpeg_path, '-nostdin', '-v', 'error', '-i', audio_filepath,
+                   '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', '-']
+            data, _, _ = run_command(cmd)
+    except (RuntimeError, SubprocessError) as e:
+        return ytid, ts_start, None, str(e)
+    return ytid, ts_start, data, None
+
+
+class PcmDataset(object):
+    """
+    Read-only view of a PCM export, where every segment is a zero-copy slice
+    of the memory-mapped PCM file
+    """
+
+    def __init__(self, export_dir):
+        """
+        Args:
+            export_dir:  Directory of the export, e.g. data/<subset>/pcm
+                         (Type: str)
+        """
+        with open(os.path.join(export_dir, INFO_FILENAME), 'r') as f:
+            self.info = json.load(f)
+        self.sample_rate = self.info['sample_rate']
+        self.label_ids = self.info['labels']
+        self.index = np.load(os.path.join(export_dir, INDEX_FILENAME))
+
+        pcm_path = os.path.join(export_dir, PCM_FILENAME)
+        if os.path.getsize(pcm_path) > 0:
+            self.data = np.memmap(pcm_path, dtype=PCM_DTYPE, mode='r')
+        else:
+            # Empty files cannot be mapped
+            self.data = np.zeros(0, dtype=PCM_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        """
+        Get the samples of a segment
+
+        Args:
+            idx:  Position of the segment in the index
+                  (Type: int)
+
+        Returns:
+            samples:  Samples of the segment
+                      (Type: numpy.ndarray)
+        """
+        record = self.index[idx]
+        offset = int(record['offset'])
+        return self.data[offset:offset + int(record['num_samples'])]
+
+    def get_labels(self, idx):
+        """
+        Get the labels of a segment
+
+        Args:
+            idx:  Position of the segment in the index
+                  (Type: int)
+
+        Returns:
+            labels:  Label IDs of the segment
+                     (Type: list[str])
+        """
+        bits = np.unpackbits(self.index[idx]['labels'])[:len(self.label_ids)]
+        return [self.label_ids[i] for i in np.flatnonzero(bits)]
+
+
+def _load_journal(journal_path, pcm_path, dtype):
+    """
+    Load the records of an interrupted export, and truncate the journal and
+    the PCM file to the last checkpoint
+    """
+    if not os.path.exists(journal_path):
+        open(pcm_path, 'wb').close()
+        return np.zeros(0, dtype=dtype)
+
+    # A record may have been partially written when the export was killed
+    num_records = os.path.getsize(journal_path) // dtype.itemsize
+    os.truncate(journal_path, num_records * dtype.itemsize)
+    records = np.fromfile(journal_path, dtype=dtype, count=num_records)
+
+    end = int((records['offset'] + records['num_samples']).max()) if num_records else 0
+    if not os.path.exists(pcm_path):
+        open(pcm_path, 'wb').close()
+    if os.path.getsize(pcm_path) < end * PCM_DTYPE.itemsize:
+        raise ValueError('PCM file {} is shorter than its journal'.format(pcm_path))
+    os.truncate(pcm_path, end * PCM_DTYPE.itemsize)
+    return records
+
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class PcmWriter(object):
+    """
+    Appends the samples of segments to the PCM file of an export, and keeps
+    the journal and the index of the export.
+
+    Segments are recorded in the journal at every checkpoint, after the PCM
+    file is flushed to disk, so that an interrupted export is resumed from
+    its last checkpoint. Segments are only safely stored once they are
+    recorded, so each segment can carry a payload that is handed back at that
+    point, e.g. to record that the segment is done.
+
+    Only one writer may use an export at a time, e.g. among the tasks of a
+    job array sharing the data directory of a subset, so the writer holds an
+    exclusive lock on the journal until it is closed.
+    """
+
+    def __init__(self, export_dir, sample_rate, checkpoint_interval=256, wait=False):
+        """
+        Args:
+            export_dir:           Directory of the export, e.g. data/<subset>/pcm
+                                  (Type: str)
+
+            sample_rate:          Sample rate of the exported audio, in Hz
+                                  (Type: int)
+
+        Keyword Args:
+            checkpoint_interval:  Number of segments between checkpoints
+                                  (Type: int)
+
+            wait:                 If True, wait for the writer that holds
+                                  the export to close it. Otherwise, raise a
+                                  ValueError if the export is in use.
+                                  (Type: bool)
+        """
+        self.export_dir = export_dir
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(export_dir, exist_ok=True)
+
+        # The lock is taken before the export is read, since resuming it
+        # truncates the files of the export
+        journal_path = os.path.join(export_dir, JOURNAL_FILENAME)
+        self._journal_f = open(journal_path, 'ab')
+        try:
+            self._lock(wait)
+            self._open(sample_rate, journal_path)
+        except BaseException:
+            self._journal_f.close()
+            raise
+
+    def _lock(self, wait):
+        """
+        Take the exclusive lock on the journal of the export
+        """
+        operation = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._journal_f, operation)
+        except BlockingIOError:
+            err_msg = 'The export in {} is used by another process'
+            raise ValueError(err_msg.format(self.export_dir))
+
+    def _open(self, sample_rate, journal_path):
+        """
+        Read the info of the export, and load the journal of an interrupted
+        export
+        """
+        export_dir = self.export_dir
+
+        info_path = os.path.join(export_dir, INFO_FILENAME)
+        if os.path.exists(info_path):
+            with open(info_path, 'r') as f:
+                self.info = json.load(f)
+            if self.info['sample_rate'] != sample_rate:
+                err_msg = 'Cannot resume the export in {} at {} Hz instead of {} Hz'
+                raise ValueError(err_msg.format(export_dir, sample_rate,
+                                                self.info['sample_rate']))
+        else:
+            self.info = {'sample_rate': sample_rate, 'dtype': PCM_DTYPE.str, 'channels': 1,
+                         'labels': get_label_vocabulary()}
+            write_atomic(info_path, json.dumps(self.info) + '\n')
+
+        self._label_bits = {label_id: idx for idx, label_id in enumerate(self.info['labels'])}
+        self._dtype = get_index_dtype(len(self.info['labels']))
+
+        pcm_path = os.path.join(export_dir, PCM_FILENAME)
+        self._records = [_load_journal(journal_path, pcm_path, self._dtype)]
+        self._exported = set(zip(self._records[0]['ytid'].tolist(),
+                                 self._records[0]['ts_start'].tolist()))
+        self._offset = int((self._records[0]['offset'] + self._records[0]['num_samples']).max()) \
+            if len(self._records[0]) else 0
+
+        self._pcm_f = open(pcm_path, 'ab')
+        self._pending = []
+        self._payloads = []
+
+    def __contains__(self, segment):
+        """
+        Check whether a segment, given as a tuple of (YouTube ID, start time),
+        is already exported
+        """
+        ytid, ts_start = segment
+        return (ytid.encode(), ts_start) in self._exported
+
+    def add(self, ytid, ts_start, labels, data, payload=None):
+        """
+        Append the samples of a segment, and record the pending segments if
+        it is time for a checkpoint. Segments that are already exported are
+        not appended again.
+
+        Args:
+            ytid:      YouTube ID of the segment
+                       (Type: str)
+
+            ts_start:  Segment start time (in seconds)
+                       (Type: float)
+
+            labels:    Label IDs of the segment. Labels that are not in the
+                       vocabulary of the export are ignored.
+                       (Type: list[str])
+
+            data:      Mono 16-bit samples of the segment
+                       (Type: bytes or numpy.ndarray)
+
+        Keyword Args:
+            payload:   Object handed back once the segment is recorded
+                       (Type: *)
+
+        Returns:
+            payloads:  Payloads of the recorded segments, or an empty list if
+                       no checkpoint was made
+                       (Type: list)
+        """
+        key = (ytid.encode(), ts_start)
+        if key in self._exported:
+            return [payload]
+        self._exported.add(key)
+
+        data = memoryview(data).cast('B')
+        num_samples = len(data) // PCM_DTYPE.itemsize
+        self._pcm_f.write(data[:num_samples * PCM_DTYPE.itemsize])
+        mask = np.zeros(len(self.info['labels']), dtype=bool)
+        mask[[self._label_bits[label] for label in labels if label in self._label_bits]] = True
+        self._pending.append((key[0], ts_start, self._offset, num_samples, np.packbits(mask)))
+        self._payloads.append(payload)
+        self._offset += num_samples
+
+        if len(self._pending) >= self.checkpoint_interval:
+            return self.checkpoint()
+        return []
+
+    def checkpoint(self):
+        """
+        Record the pending segments in the journal
+
+        Returns:
+            payloads:  Payloads of the recorded segments
+                       (Type: list)
+        """
+        if self._pending:
+            # The journal never refers to samples that are not on disk
+            _fsync(self._pcm_f)
+            records = np.array(self._pending, dtype=self._dtype)
+            self._journal_f.write(records.tobytes())
+            _fsync(self._journal_f)
+            self._records.append(records)
+        payloads = self._payloads
+        self._pending = []
+        self._payloads = []
+        return payloads
+
+    def close(self):
+        """
+        Record the pending segments and write the index of all the segments
+        of the export, sorted by YouTube ID and start time
+
+        Returns:
+            payloads:  Payloads of the recorded segments
+                       (Type: list)
+        """
+        try:
+            payloads = self.checkpoint()
+            self._pcm_f.close()
+
+            records = np.concatenate(self._records)
+            records.sort(order=['ytid', 'ts_start'])
+            self._records = [records]
+            index_path = os.path.join(self.export_dir, INDEX_FILENAME)
+            temp_index_path = get_temp_path(index_path)
+            with open(temp_index_path, 'wb') as f:
+                np.save(f, records)
+            publish_file(temp_index_path, index_path)
+        finally:
+            # The index is written before the lock is released, so that it
+            # is never replaced by the index of an earlier writer
+            self._journal_f.close()
+        return payloads
+
+    @property
+    def num_segments(self):
+        """
+        Number of exported segments
+        """
+        return sum(len(records) for records in self._records) + len(self._pending)
+
+
+def export_subset_pcm(subset_path, data_dir, ffmpeg_path, sample_rate=16000,
+                      num_workers=4, audio_format='flac', checkpoint_interval=256):
+    """
+    Export the downloaded audio of the segments of a subset as mono 16-bit PCM
+    appended to `<data_dir>/pcm/audio.pcm`, with an index of the segments in
+    `<data_dir>/pcm/index.npy`. Audio files are decoded in parallel.
+
+    An interrupted export is resumed from its last checkpoint. Segments whose
+    audio was not downloaded are skipped, and exported by a later run. The
+    index is rewritten at the end of every run. Concurrent exports of the
+    subset, e.g. by the tasks of a job array that downloaded parts of a split
+    subset file, wait for each other.
+
+    Args:
+        subset_path:          Path to subset segments file
+                              (Type: str)
+
+        data_dir:             Path to subset data directory
+                              (Type: str)
+
+        ffmpeg_path:          Path to ffmpeg executable
+                              (Type: str)
+
+    Keyword Args:
+        sample_rate:          Sample rate of the exported audio, in Hz
+                              (Type: int)
+
+        num_workers:          Number of processes that decode audio
+                              (Type: int)
+
+        audio_format:         Extension of the downloaded audio files
+                              (Type: str)
+
+        checkpoint_interval:  Number of exported segments between checkpoints
+                              (Type: int)
+
+    Returns:
+        status_counts:  Number of segments that were exported, were already
+                        exported, had no audio and failed to decode
+                        (Type: collections.Counter)
+    """
+    export_dir = os.path.join(data_dir, PCM_DIRNAME)
+    # Tasks of a job array that share the data directory take turns
+    writer = PcmWriter(export_dir, sample_rate, checkpoint_interval=checkpoint_interval,
+                       wait=True)
+
+    layout = read_layout(data_dir) or {}
+    status_counts = collections.Counter()
+    segment_labels = {}
+
+    def iter_tasks():
+        for ytid, ts_start, ts_end, row in read_segments(subset_path):
+            if (ytid, ts_start) in writer or (ytid, ts_start) in segment_labels:
+                status_counts['skipped'] += 1
+                continue
+            media_filename = get_media_filename(ytid, ts_start, ts_end,
+                                                layout.get('num_buckets'),
+                                                layout.get('bucket_levels') or 1)
+            audio_filepath = os.path.join(data_dir, 'audio', media_filename + '.' + audio_format)
+            if not os.path.exists(audio_filepath):
+                status_counts['missing'] += 1
+                continue
+            segment_labels[(ytid, ts_start)] = get_row_labels(row)
+            yield ytid, ts_start, audio_filepath, ffmpeg_path, sample_rate
+
+    LOGGER.info('Exporting the audio of subset "{}" to {}'.format(get_subset_name(subset_path),
+                                                                  export_dir))
+    pool = mp.Pool(num_workers, initializer=init_pool_worker)
+    try:
+        results = imap_bounded(pool, decode_audio, iter_tasks(), 2 * num_workers)
+        for ytid, ts_start, data, error in results:
+            labels = segment_labels.pop((ytid, ts_start))
+            if data is None:
+                LOGGER.warning('Could not decode the audio of {} ({}): {}'.format(
+                    ytid, ts_start, error))
+                status_counts['failed'] += 1
+                continue
+            writer.add(ytid, ts_start, labels, data)
+            status_counts['exported'] += 1
+
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        raise
+    finally:
+        writer.close()
+
+    info_msg = 'Exported {} segments of subset "{}" ({} already exported, {} without audio, ' \
+               '{} failed), {} segments in the index'
+    LOGGER.info(info_msg.format(status_counts['exported'], get_subset_name(subset_path),
+                                status_counts['skipped'], status_counts['missing'],
+                                status_counts['failed'], writer.num_segments))
+    return status_counts
+
+
+def export_pcm(data_dir, ffmpeg_path, sample_rate=16000, audio_format='flac', subsets=None,
+               num_workers=4, checkpoint_interval=256, verbose=False):
+    """
+    Export the downloaded audio of AudioSet subsets as memory-mappable PCM
+
+    Args:
+        data_dir:             Directory where dataset files are saved
+                              (Type: str)
+
+        ffmpeg_path:          Path to ffmpeg executable
+                              (Type: str)
+
+    Keyword Args:
+        sample_rate:          Sample rate of the exported audio, in Hz
+                              (Type: int)
+
+        audio_format:         Extension of the downloaded audio files
+                              (Type: str)
+
+        subsets:              Names of subsets to export, or paths to their
+                              segments files if they are not in `data_dir`.
+                              If None, all subsets.
+                              (Type: list[str] or None)
+
+        num_workers:          Number of processes that decode audio
+                              (Type: int)
+
+        checkpoint_interval:  Number of exported segments between checkpoints
+                              (Type: int)
+
+        verbose:              If True, print detailed information
+                              (Type: bool)
+    """
+    init_console_logger(LOGGER, verbose=verbose)
+
+    subsets_dir = os.path.join(data_dir, 'data')
+    if subsets is None:
+        subsets = sorted(name for name in os.listdir(subsets_dir)
+                         if os.path.isdir(os.path.join(subsets_dir, name)))
+
+    for subset in subsets:
+        if os.path.isfile(subset):
+            subset_path, subset_name = subset, get_subset_name(subset)
+        else:
+            subset_path, subset_name = os.path.join(data_dir, subset + '.csv'), subset
+        if not os.path.exists(subset_path):
+            LOGGER.warning('Not exporting subset "{}": {} does not exist'.format(
+                subset_name, subset_path))
+            continue
+        try:
+            export_subset_pcm(subset_path, os.path.join(subsets_dir, subset_name),
+                              ffmpeg_path, sample_rate=sample_rate, num_workers=num_workers,
+                              audio_format=audio_format,
+                              checkpoint_interval=checkpoint_interval)
+        except ValueError as e:
+            LOGGER.error(str(e))
+            sys.exit(str(e))
+        except KeyboardInterrupt:
+            LOGGER.info("Forcing exit.")
+            exit()
+
+
+if __name__ == '__main__':
+    export_pcm(**parse_arguments())
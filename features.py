@@ -0,0 +1,390 @@
+"""
+Extraction of log-mel and STFT features from the audio of segments
+"""
+import json
+import logging
+import math
+import os
+import time
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import firwin, resample_poly
+
+from utils import get_media_filename, get_temp_path, publish_file, write_atomic
+
+LOGGER = logging.getLogger('audiosetdl')
+
+FEATURE_TYPES = ('logmel', 'stft')
+
+# Sidecar with the parameters of the features, in the subset data directory
+FEATURE_INFO_FILENAME = 'features.json'
+
+FEATURE_DTYPE = np.dtype('<f2')
+
+# Offset added to the magnitudes before taking their log, to avoid log(0)
+LOG_OFFSET = 1e-6
+
+_EXTRACTORS = {}
+
+
+def hz_to_mel(frequency):
+    """
+    Convert frequencies in Hz to the HTK mel scale
+    """
+    return 1127.0 * np.log1p(np.asarray(frequency, dtype=np.float64) / 700.0)
+
+
+def mel_filterbank(num_mels, n_fft, sample_rate, fmin, fmax):
+    """
+    Get a matrix of triangular filters spaced evenly on the mel scale
+
+    Args:
+        num_mels:     Number of mel bands
+                      (Type: int)
+
+        n_fft:        FFT size
+                      (Type: int)
+
+        sample_rate:  Sample rate of the audio (in Hz)
+                      (Type: int)
+
+        fmin:         Lower edge of the lowest band (in Hz)
+                      (Type: float)
+
+        fmax:         Upper edge of the highest band (in Hz)
+                      (Type: float)
+
+    Returns:
+        filterbank:  Matrix of shape (n_fft // 2 + 1, num_mels) that maps
+                     magnitude spectra to mel bands
+                     (Type: numpy.ndarray)
+    """
+    bin_mels = hz_to_mel(np.linspace(0.0, sample_rate / 2.0, n_fft // 2 + 1))
+    edge_mels = np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), num_mels + 2)
+    lower, center, upper = edge_mels[:-2], edge_mels[1:-1], edge_mels[2:]
+    rising = (bin_mels[:, None] - lower) / (center - lower)
+    falling = (upper - bin_mels[:, None]) / (upper - center)
+    return np.maximum(0.0, np.minimum(rising, falling)).astype(np.float32)
+
+
+class FeatureExtractor(object):
+    """
+    Computes log-mel or log-magnitude STFT features of batches of clips with
+    vectorized NumPy. The resampling filter, the window and the mel
+    filterbank are computed once, when the extractor is created.
+    """
+
+    def __init__(self, audio_sample_rate, feature_type='logmel', sample_rate=16000,
+                 window_duration=0.025, hop_duration=0.010, num_mels=64, fmin=125.0,
+                 fmax=7500.0):
+        """
+        Args:
+            audio_sample_rate:  Sample rate of the audio of the clips (in Hz)
+                                (Type: int)
+
+        Keyword Args:
+            feature_type:       'logmel' or 'stft'
+                                (Type: str)
+
+            sample_rate:        Sample rate at which the features are
+                                computed (in Hz). The clips are resampled if
+                                it is not the sample rate of the audio.
+                                (Type: int)
+
+            window_duration:    Duration of the analysis window (in seconds)
+                                (Type: float)
+
+            hop_duration:       Time between consecutive frames (in seconds)
+                                (Type: float)
+
+            num_mels:           Number of mel bands of log-mel features
+                                (Type: int)
+
+            fmin:               Lower edge of the lowest mel band (in Hz)
+                                (Type: float)
+
+            fmax:               Upper edge of the highest mel band (in Hz)
+                                (Type: float)
+        """
+        if feature_type not in FEATURE_TYPES:
+            raise ValueError('Invalid feature type: {}'.format(feature_type))
+
+        self.audio_sample_rate = audio_sample_rate
+        self.feature_type = feature_type
+        self.sample_rate = sample_rate
+        self.window_length = int(round(window_duration * sample_rate))
+        self.hop_length = int(round(hop_duration * sample_rate))
+        self.n_fft = 2 ** int(math.ceil(math.log2(self.window_length)))
+        self.num_mels = num_mels
+        self.fmin = fmin
+        self.fmax = min(fmax, sample_rate / 2.0)
+
+        # Periodic Hann window
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(self.window_length)
+                                          / self.window_length)).astype(np.float32)
+        self.filterbank = None
+        if feature_type == 'logmel':
+            self.filterbank = mel_filterbank(num_mels, self.n_fft, sample_rate,
+                                             self.fmin, self.fmax)
+
+        # Polyphase resampling filter, as designed by `scipy.signal.resample_poly`
+        gcd = math.gcd(audio_sample_rate, sample_rate)
+        self.up, self.down = sample_rate // gcd, audio_sample_rate // gcd
+        self.resample_filter = None
+        if self.up != self.down:
+            max_rate = max(self.up, self.down)
+            self.resample_filter = firwin(20 * max_rate + 1, 1.0 / max_rate,
+                                          window=('kaiser', 5.0)).astype(np.float32)
+
+    @property
+    def params(self):
+        """
+        Parameters of the features, as recorded in the sidecar
+        """
+        params = {'audio_sample_rate': self.audio_sample_rate,
+                  'feature_type': self.feature_type,
+                  'sample_rate': self.sample_rate,
+                  'window_length': self.window_length,
+                  'hop_length': self.hop_length,
+                  'n_fft': self.n_fft,
+                  'window': 'hann',
+                  'log_offset': LOG_OFFSET,
+                  'dtype': FEATURE_DTYPE.str,
+                  'shape': ['frames', 'mels' if self.filterbank is not None else 'bins']}
+        if self.filterbank is not None:
+            params.update({'num_mels': self.num_mels, 'fmin': self.fmin, 'fmax': self.fmax,
+                           'mel_scale': 'htk'})
+        return params
+
+    def get_num_frames(self, num_samples):
+        """
+        Get the number of feature frames of a clip
+
+        Args:
+            num_samples:  Number of samples of the clip at the sample rate of
+                          the audio
+                          (Type: int)
+
+        Returns:
+            num_frames:  Number of frames
+                         (Type: int)
+        """
+        num_samples = -(-num_samples * self.up // self.down)
+        return max(0, 1 + (num_samples - self.window_length) // self.hop_length)
+
+    def compute(self, clips):
+        """
+        Compute the features of a batch of clips. Clips of different lengths
+        are zero-padded to the longest one, and their features cut to their
+        own number of frames.
+
+        Args:
+            clips:  Clips of 16-bit samples at the sample rate of the audio,
+                    of shape (samples,) or (samples, channels)
+                    (Type: list[numpy.ndarray])
+
+        Returns:
+            features:  Features of each clip, of shape (frames, mels) or
+                       (frames, bins)
+                       (Type: list[numpy.ndarray])
+        """
+        if not clips:
+            return []
+        max_length = max(len(clip) for clip in clips)
+        batch = np.zeros((len(clips), max_length), dtype=np.float32)
+        for idx, clip in enumerate(clips):
+            batch[idx, :len(clip)] = clip.reshape(len(clip), -1).mean(axis=1) / 32768.0
+
+        if self.resample_filter is not None:
+            batch = resample_poly(batch, self.up, self.down, axis=-1,
+                                  window=self.resample_filter).astype(np.float32)
+
+        num_frames = [self.get_num_frames(len(clip)) for clip in clips]
+        if batch.shape[1] < self.window_length:
+            batch = np.pad(batch, ((0, 0), (0, self.window_length - batch.shape[1])))
+        frames = np.lib.stride_tricks.sliding_window_view(
+            batch, self.window_length, axis=-1)[:, ::self.hop_length]
+        spectra = np.abs(np.fft.rfft(frames * self.window, n=self.n_fft, axis=-1))
+        if self.filterbank is not None:
+            spectra = spectra @ self.filterbank
+        features = np.log(spectra + LOG_OFFSET).astype(FEATURE_DTYPE)
+        return [features[idx, :count] for idx, count in enumerate(num_frames)]
+
+
+def get_feature_extractor(audio_sample_rate, feature_type='logmel', **params):
+    """
+    Get a feature extractor for the current process, which is only created
+    the first time it is requested with the same parameters
+
+    Args:
+        audio_sample_rate:  Sample rate of the audio of the clips (in Hz)
+                            (Type: int)
+
+    Keyword Args:
+        feature_type:       'logmel' or 'stft'
+                            (Type: str)
+
+        **params:           Other arguments of `FeatureExtractor`
+                            (Type: dict[str, *])
+
+    Returns:
+        extractor:  Feature extractor
+                    (Type: features.FeatureExtractor)
+    """
+    key = (os.getpid(), audio_sample_rate, feature_type, tuple(sorted(params.items())))
+    if key not in _EXTRACTORS:
+        _EXTRACTORS[key] = FeatureExtractor(audio_sample_rate, feature_type=feature_type,
+                                            **params)
+    return _EXTRACTORS[key]
+
+
+def read_feature_info(data_dir):
+    """
+    Read the parameters of the features of a subset
+
+    Args:
+        data_dir:  Path to subset data directory
+                   (Type: str)
+
+    Returns:
+        params:  Parameters of the features, or None if they were never
+                 recorded
+                 (Type: dict or None)
+    """
+    info_path = os.path.join(data_dir, FEATURE_INFO_FILENAME)
+    if not os.path.exists(info_path):
+        return None
+    with open(info_path, 'r') as f:
+        return json.load(f)
+
+
+def write_feature_info(data_dir, params):
+    """
+    Record the parameters of the features of a subset
+
+    Args:
+        data_dir:  Path to subset data directory
+                   (Type: str)
+
+        params:    Parameters of the features, e.g. from
+                   `FeatureExtractor.params`
+                   (Type: dict)
+    """
+    write_atomic(os.path.join(data_dir, FEATURE_INFO_FILENAME),
+                 json.dumps(params, sort_keys=True) + '\n')
+
+
+def get_segment_feature_extractor(features, audio_sample_rate=48000, feature_sample_rate=16000,
+                                  feature_window=0.025, feature_hop=0.010, num_mels=64,
+                                  **ffmpeg_cfg):
+    """
+    Get the feature extractor of the current process for the given
+    configuration
+
+    Args:
+        features:             'logmel' or 'stft'
+                              (Type: str)
+
+    Keyword Args:
+        audio_sample_rate:    Sample rate of the audio (in Hz)
+                              (Type: int)
+
+        feature_sample_rate:  Sample rate at which features are computed
+                              (Type: int)
+
+        feature_window:       Duration of the analysis window (in seconds)
+                              (Type: float)
+
+        feature_hop:          Time between feature frames (in seconds)
+                              (Type: float)
+
+        num_mels:             Number of mel bands
+                              (Type: int)
+
+        **ffmpeg_cfg:         Other configuration, which is ignored
+                              (Type: dict[str, *])
+
+    Returns:
+        extractor:  Feature extractor
+                    (Type: features.FeatureExtractor)
+    """
+    return get_feature_extractor(audio_sample_rate, feature_type=features,
+                                 sample_rate=feature_sample_rate,
+                                 window_duration=feature_window, hop_duration=feature_hop,
+                                 num_mels=num_mels)
+
+
+def extract_segment_features(results, data_dir, num_buckets, extractor, bucket_levels=1):
+    """
+    Compute the features of the segments that succeeded, in a single batch,
+    from their streamed samples or their audio files. The features are saved
+    next to the audio, as <media filename>.<feature type>.npy.
+
+    Args:
+        results:        Download status of each segment
+                        (Type: list[scheduler.SegmentResult])
+
+        data_dir:       Directory where the features are saved
+                        (Type: str)
+
+        num_buckets:    Number of buckets in each level. If None, files are
+                        not bucketed.
+                        (Type: int or None)
+
+        extractor:      Feature extractor
+                        (Type: features.FeatureExtractor)
+
+    Keyword Args:
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+    Returns:
+        results:  Status of each segment, with the path to its features. The
+                  segments whose audio could not be read failed.
+                  (Type: list[scheduler.SegmentResult])
+    """
+    start_time = time.time()
+    results = list(results)
+    clips = []
+    pending = []
+    for idx, result in enumerate(results):
+        if not result.succeeded:
+            continue
+        media_filename = get_media_filename(result.ytid, result.ts_start, result.ts_end,
+                                            num_buckets, bucket_levels)
+        feature_filepath = os.path.join(data_dir, 'audio', '{}.{}.npy'.format(
+            media_filename, extractor.feature_type))
+        if os.path.exists(feature_filepath):
+            results[idx] = result._replace(feature_filepath=feature_filepath)
+            continue
+        try:
+            if result.samples is not None:
+                samples = result.samples
+            else:
+                samples, _ = sf.read(result.audio_filepath, dtype='int16', always_2d=True)
+        except RuntimeError as e:
+            LOGGER.error('Could not read the audio of video {} ({} - {}): {}'.format(
+                result.ytid, result.ts_start, result.ts_end, e))
+            results[idx] = result._replace(succeeded=False, error_class=type(e).__name__,
+                                           error_msg=str(e), permanent=False)
+            continue
+        clips.append(samples)
+        pending.append((idx, feature_filepath))
+
+    for (idx, feature_filepath), features in zip(pending, extractor.compute(clips)):
+        os.makedirs(os.path.dirname(feature_filepath), exist_ok=True)
+        temp_path = get_temp_path(feature_filepath)
+        with open(temp_path, 'wb') as f:
+            np.save(f, features)
+        publish_file(temp_path, feature_filepath)
+        results[idx] = results[idx]._replace(feature_filepath=feature_filepath,
+                                             num_bytes=(results[idx].num_bytes or 0)
+                                             + os.path.getsize(feature_filepath))
+
+    if pending:
+        # The batch is accounted for in its first segment
+        idx = pending[0][0]
+        timings = dict(results[idx].timings or {}, features=time.time() - start_time)
+        results[idx] = results[idx]._replace(timings=timings)
+    return results
@@ -0,0 +1,664 @@
+"""
+Persistent manifest of segment download jobs, stored in an SQLite database
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from scheduler import get_row_labels
+
+LOGGER = logging.getLogger('audiosetdl')
+
+
+STATE_PENDING = 'pending'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+# Failed with an error that is not expected to go away, e.g. video removed
+STATE_DEAD = 'dead'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    subset      TEXT NOT NULL,
+    ytid        TEXT NOT NULL,
+    ts_start    REAL NOT NULL,
+    ts_end      REAL NOT NULL,
+    state       TEXT NOT NULL DEFAULT 'pending',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT,
+    audio_path  TEXT,
+    video_path  TEXT,
+    num_bytes   INTEGER,
+    elapsed     REAL,
+    updated_at  REAL,
+    labels      TEXT,
+    PRIMARY KEY (subset, ytid, ts_start, ts_end)
+);
+CREATE INDEX IF NOT EXISTS segments_state_idx ON segments (subset, state, attempts);
+CREATE INDEX IF NOT EXISTS segments_ytid_idx ON segments (ytid, ts_start, ts_end);
+CREATE TABLE IF NOT EXISTS subsets (
+    subset        TEXT PRIMARY KEY,
+    source_size   INTEGER,
+    source_mtime  REAL,
+    imported_at   REAL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    subset      TEXT NOT NULL,
+    ytid        TEXT NOT NULL,
+    owner       TEXT NOT NULL,
+    expires_at  REAL NOT NULL,
+    PRIMARY KEY (subset, ytid)
+);
+CREATE INDEX IF NOT EXISTS leases_owner_idx ON leases (owner);
+CREATE TABLE IF NOT EXISTS lease_passes (
+    subset     TEXT PRIMARY KEY,
+    pass       INTEGER NOT NULL,
+    cursor     TEXT NOT NULL,
+    exhausted  INTEGER NOT NULL
+);
+"""
+
+
+def get_lease_owner():
+    """
+    Get a name for the current process that is unique across nodes
+
+    Returns:
+        owner:  Lease owner name
+                (Type: str)
+    """
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class Manifest(object):
+    """
+    Tracks the state of every segment of every subset across runs.
+
+    Only the parent process of a run accesses the database. Results reported
+    by the workers are buffered and written in batched transactions.
+
+    The manifest can also serve as a work queue shared by any number of
+    processes, e.g. on different nodes with the database on a shared
+    filesystem. Each process claims leases on small batches of videos with
+    `iter_leased`, and keeps them alive with a `LeaseHeartbeat`. The lease on
+    a video is released with `release` once its results are recorded, and
+    leases that are not renewed expire and are claimed by other processes,
+    which find them with `wait_for_leases`.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=10.0):
+        """
+        Args:
+            path:            Path to SQLite database file
+                             (Type: str)
+
+        Keyword Args:
+            batch_size:      Number of buffered updates that triggers a write
+                             (Type: int)
+
+            flush_interval:  Maximum number of seconds updates are buffered
+                             (Type: float)
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._updates = []
+        self._releases = []
+        self._lease_passes = {}
+        self._last_flush = time.time()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self._add_labels_column()
+
+    def _add_labels_column(self):
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(segments)')]
+        if 'labels' in columns:
+            return
+        # The labels of the segments of manifests created before they were
+        # kept are filled in by importing the subsets again
+        try:
+            with self.conn:
+                self.conn.execute('ALTER TABLE segments ADD COLUMN labels TEXT')
+                self.conn.execute('DELETE FROM subsets')
+        except sqlite3.OperationalError:
+            # Added by another process in the meantime
+            pass
+
+    def import_segments(self, subset_name, subset_path, segments, is_done=None):
+        """
+        Add the segments of a subset to the manifest.
+
+        The import is skipped if the subset file has not changed since it was
+        last imported. On the first import of a subset, `is_done` is used to
+        adopt outputs that were downloaded before the manifest existed.
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+            subset_path:  Path to subset segments file
+                          (Type: str)
+
+            segments:     Iterable of (YouTube ID, start time, end time, row),
+                          with the row of the segment in the subset file
+                          (Type: iterable[tuple])
+
+        Keyword Args:
+            is_done:      Function that returns True if a segment has already
+                          been downloaded
+                          (Type: callable[[str, float, float], bool] or None)
+
+        Returns:
+            num_imported:  Number of rows inserted into the manifest, or whose
+                           labels were filled in
+                           (Type: int)
+        """
+        stat = os.stat(subset_path)
+        row = self.conn.execute(
+            'SELECT source_size, source_mtime FROM subsets WHERE subset = ?',
+            (subset_name,)).fetchone()
+        if row is not None and tuple(row) == (stat.st_size, stat.st_mtime):
+            return 0
+        first_import = row is None
+
+        num_imported = 0
+        batch = []
+        now = time.time()
+        with self.conn:
+            for segment in segments:
+                ytid, ts_start, ts_end = segment[:3]
+                state = STATE_PENDING
+                if first_import and is_done is not None and is_done(ytid, ts_start, ts_end):
+                    state = STATE_DONE
+                labels = ','.join(get_row_labels(segment[3])) if len(segment) > 3 else None
+                batch.append((subset_name, ytid, ts_start, ts_end, state, now, labels or None))
+                if len(batch) >= self.batch_size:
+                    num_imported += self._insert_segments(batch)
+                    batch = []
+            num_imported += self._insert_segments(batch)
+
+            self.conn.execute(
+                'INSERT OR REPLACE INTO subsets VALUES (?, ?, ?, ?)',
+                (subset_name, stat.st_size, stat.st_mtime, now))
+
+        return num_imported
+
+    def _insert_segments(self, rows):
+        # Only the labels of existing segments are filled in, if missing
+        cur = self.conn.executemany(
+            'INSERT INTO segments (subset, ytid, ts_start, ts_end, state, updated_at, labels) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (subset, ytid, ts_start, ts_end) DO UPDATE SET labels = excluded.labels '
+            'WHERE labels IS NULL AND excluded.labels IS NOT NULL', rows)
+        return max(cur.rowcount, 0)
+
+    def iter_pending(self, subset_name, max_attempts=None, retry_dead=False, chunk_size=1000):
+        """
+        Iterate over the segments of a subset that still need to be downloaded,
+        ordered by YouTube ID, so that the segments of a video are adjacent.
+
+        Rows are fetched in chunks so that the manifest can be updated while
+        iterating. A separate connection is used, so the iteration can run in
+        a different thread than the one recording results.
+
+        Args:
+            subset_name:   Name of subset
+                           (Type: str)
+
+        Keyword Args:
+            max_attempts:  Segments that failed this many times are not retried.
+                           If None, failed segments are always retried.
+                           (Type: int or None)
+
+            retry_dead:    If True, also iterate over segments that failed
+                           with a permanent error
+                           (Type: bool)
+
+            chunk_size:    Number of rows fetched per query
+                           (Type: int)
+
+        Yields:
+            segment:  Tuple of (YouTube ID, start time, end time)
+                      (Type: tuple[str, float, float])
+        """
+        if max_attempts is None:
+            max_attempts = -1
+        states = (STATE_PENDING, STATE_FAILED, STATE_DEAD if retry_dead else STATE_FAILED)
+        conn = sqlite3.connect(self.path, timeout=60)
+        last_key = ('', float('-inf'), float('-inf'))
+        while True:
+            # The state and attempts columns are excluded from index selection
+            # with unary '+', so that rows are read in the order of the
+            # primary key instead of being sorted for every chunk
+            rows = conn.execute(
+                'SELECT ytid, ts_start, ts_end FROM segments '
+                'WHERE subset = ? AND (ytid, ts_start, ts_end) > (?, ?, ?) '
+                'AND +state IN (?, ?, ?) AND (? < 0 OR +attempts < ?) '
+                'ORDER BY ytid, ts_start, ts_end LIMIT ?',
+                (subset_name,) + last_key + states +
+                (max_attempts, max_attempts, chunk_size)).fetchall()
+            if not rows:
+                break
+            for ytid, ts_start, ts_end in rows:
+                yield ytid, ts_start, ts_end
+            last_key = tuple(rows[-1])
+        conn.close()
+
+    def iter_leased(self, subset_name, owner, batch_size=16, lease_timeout=300.0,
+                    max_attempts=None, retry_dead=False):
+        """
+        Iterate over the segments of the videos of a subset that this process
+        claims from the queue shared with other processes.
+
+        Videos are claimed in batches. Expired leases of other processes are
+        claimed first, then videos that still need to be downloaded are
+        claimed in order of YouTube ID, from a cursor shared by all processes,
+        so that every video is claimed once per pass over the subset. The
+        iteration ends when there is nothing left to claim; once the leases
+        held by this process are released, `wait_for_leases` tells whether
+        it is worth iterating again to claim the leases of other processes
+        that expire.
+
+        A separate connection is used, so the iteration can run in a
+        different thread than the one recording results.
+
+        Args:
+            subset_name:    Name of subset
+                            (Type: str)
+
+            owner:          Name of this process, e.g. from `get_lease_owner`
+                            (Type: str)
+
+        Keyword Args:
+            batch_size:     Number of videos claimed at a time
+                            (Type: int)
+
+            lease_timeout:  Number of seconds after which a lease that was not
+                            renewed expires
+                            (Type: float)
+
+            max_attempts:   Segments that failed this many times are not retried.
+                            If None, failed segments are always retried.
+                            (Type: int or None)
+
+            retry_dead:     If True, also iterate over segments that failed
+                            with a permanent error
+                            (Type: bool)
+
+        Yields:
+            segment:  Tuple of (YouTube ID, start time, end time)
+                      (Type: tuple[str, float, float])
+        """
+        if max_attempts is None:
+            max_attempts = -1
+        states = (STATE_PENDING, STATE_FAILED, STATE_DEAD if retry_dead else STATE_FAILED)
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            while True:
+                # The pass is remembered across iterations, so that waiting
+                # for other processes never starts a new pass
+                pass_id, ytids = self._claim(
+                    conn, subset_name, owner, self._lease_passes.get(subset_name),
+                    batch_size, lease_timeout, states, max_attempts)
+                self._lease_passes[subset_name] = pass_id
+                if not ytids:
+                    break
+
+                for ytid in ytids:
+                    rows = conn.execute(
+                        'SELECT ytid, ts_start, ts_end FROM segments '
+                        'WHERE subset = ? AND ytid = ? '
+                        'AND state IN (?, ?, ?) AND (? < 0 OR attempts < ?) '
+                        'ORDER BY ts_start, ts_end',
+                        (subset_name, ytid) + states + (max_attempts, max_attempts)).fetchall()
+                    if not rows:
+                        # The segments of a stolen lease may all be recorded
+                        self.release(subset_name, ytid, owner)
+                    for row in rows:
+                        yield tuple(row)
+        finally:
+            conn.close()
+
+    def wait_for_leases(self, subset_name, owner, poll_interval=10.0, stop_event=None):
+        """
+        Wait for the leases of other processes on the videos of a subset to be
+        released or to expire. Buffered updates are flushed first, so that
+        the leases of this process are released.
+
+        Args:
+            subset_name:    Name of subset
+                            (Type: str)
+
+            owner:          Name of this process, e.g. from `get_lease_owner`
+                            (Type: str)
+
+        Keyword Args:
+            poll_interval:  Number of seconds between checks of the leases
+                            (Type: float)
+
+            stop_event:     Event that stops the wait when set
+                            (Type: threading.Event or None)
+
+        Returns:
+            expired:  True if leases expired and can be claimed with
+                      `iter_leased`, False if no other process holds a lease
+                      or the wait was stopped
+                      (Type: bool)
+        """
+        self.flush()
+        while True:
+            num_leases, num_expired = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(expires_at < ?), 0) FROM leases '
+                'WHERE subset = ? AND owner != ?',
+                (time.time(), subset_name, owner)).fetchone()
+            if num_expired:
+                return True
+            if not num_leases:
+                return False
+            if stop_event is None:
+                time.sleep(poll_interval)
+            elif stop_event.wait(poll_interval):
+                return False
+
+    def _claim(self, conn, subset_name, owner, pass_id, batch_size, lease_timeout,
+               states, max_attempts):
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT pass, cursor, exhausted FROM lease_passes '
+                               'WHERE subset = ?', (subset_name,)).fetchone()
+            if row is None:
+                row = (1, '', 0)
+                conn.execute('INSERT INTO lease_passes VALUES (?, ?, ?, ?)',
+                             (subset_name,) + row)
+            current_pass, cursor, exhausted = row
+            if pass_id is None and exhausted:
+                # Start a new pass over the subset, e.g. to retry the
+                # segments that failed in the previous pass
+                current_pass, cursor, exhausted = current_pass + 1, '', 0
+                conn.execute('UPDATE lease_passes SET pass = ?, cursor = ?, exhausted = ? '
+                             'WHERE subset = ?', (current_pass, cursor, exhausted, subset_name))
+            elif pass_id is not None and pass_id != current_pass:
+                # Another process started a new pass after this one was done
+                conn.execute('COMMIT')
+                return pass_id, []
+
+            ytids = [ytid for ytid, in conn.execute(
+                'SELECT ytid FROM leases WHERE subset = ? AND expires_at < ? '
+                'ORDER BY expires_at LIMIT ?', (subset_name, now, batch_size))]
+            if ytids:
+                LOGGER.info('Claiming {} expired leases of subset "{}"'.format(
+                    len(ytids), subset_name))
+
+            if not exhausted and len(ytids) < batch_size:
+                num_claims = batch_size - len(ytids)
+                new_ytids = [ytid for ytid, in conn.execute(
+                    'SELECT DISTINCT ytid FROM segments '
+                    'WHERE subset = ? AND ytid > ? '
+                    'AND +state IN (?, ?, ?) AND (? < 0 OR +attempts < ?) '
+                    'AND NOT EXISTS (SELECT 1 FROM leases AS l '
+                    '                WHERE l.subset = segments.subset AND l.ytid = segments.ytid) '
+                    'ORDER BY ytid LIMIT ?',
+                    (subset_name, cursor) + states + (max_attempts, max_attempts, num_claims))]
+                if new_ytids:
+                    cursor = new_ytids[-1]
+                exhausted = int(len(new_ytids) < num_claims)
+                conn.execute('UPDATE lease_passes SET cursor = ?, exhausted = ? WHERE subset = ?',
+                             (cursor, exhausted, subset_name))
+                ytids += new_ytids
+
+            conn.executemany(
+                'INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)',
+                [(subset_name, ytid, owner, now + lease_timeout) for ytid in ytids])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return current_pass, ytids
+
+    def release(self, subset_name, ytid, owner):
+        """
+        Release the lease on a video. The lease is deleted with the next
+        flush, in the same transaction as the results recorded before, so
+        that the video is claimed again if the process stops before.
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+            ytid:         YouTube ID of video
+                          (Type: str)
+
+            owner:        Name of the process holding the lease
+                          (Type: str)
+        """
+        self._releases.append((subset_name, ytid, owner))
+
+    def get_labels(self, subset_name, ytid, ts_start, ts_end):
+        """
+        Get the labels of a segment
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+            ytid:         YouTube ID of video
+                          (Type: str)
+
+            ts_start:     Segment start time (in seconds)
+                          (Type: float)
+
+            ts_end:       Segment end time (in seconds)
+                          (Type: float)
+
+        Returns:
+            labels:  Label IDs of the segment, or None if unknown
+                     (Type: list[str] or None)
+        """
+        row = self.conn.execute(
+            'SELECT labels FROM segments '
+            'WHERE subset = ? AND ytid = ? AND ts_start = ? AND ts_end = ?',
+            (subset_name, ytid, ts_start, ts_end)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0].split(',')
+
+    def find_duplicates(self, subset_name):
+        """
+        Find the segments of a subset that are not done, but for which the
+        same segment (YouTube ID, start time and end time) is done in another
+        subset.
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+        Returns:
+            duplicates:  Tuples of (YouTube ID, start time, end time, audio
+                         path, video path), with the outputs of the segment
+                         in the other subset
+                         (Type: list[tuple[str, float, float, str, str]])
+        """
+        return self.conn.execute(
+            'SELECT s.ytid, s.ts_start, s.ts_end, d.audio_path, d.video_path '
+            'FROM segments AS s JOIN segments AS d '
+            'ON d.ytid = s.ytid AND d.ts_start = s.ts_start AND d.ts_end = s.ts_end '
+            'WHERE s.subset = ? AND s.state != ? AND d.subset != s.subset AND d.state = ? '
+            'GROUP BY s.ytid, s.ts_start, s.ts_end',
+            (subset_name, STATE_DONE, STATE_DONE)).fetchall()
+
+    def record(self, subset_name, result):
+        """
+        Record the outcome of a segment download job.
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+            result:       Download status of the segment
+                          (Type: scheduler.SegmentResult)
+        """
+        if result.succeeded:
+            state = STATE_DONE
+        elif result.permanent:
+            state = STATE_DEAD
+        else:
+            state = STATE_FAILED
+        self._updates.append((state, result.error_class, result.audio_filepath,
+                              result.video_filepath, result.num_bytes,
+                              result.elapsed, time.time(), subset_name,
+                              result.ytid, result.ts_start, result.ts_end))
+        if len(self._updates) >= self.batch_size \
+                or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def requeue(self, subset_name, segments, owner=None):
+        """
+        Record that the downloads of segments were interrupted, e.g. because
+        the process was asked to stop. The segments are pending again, without
+        counting as an attempt, so that the next run picks them up where this
+        one stopped. Buffered updates are flushed first.
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+            segments:     Segments as tuples of (YouTube ID, start time,
+                          end time)
+                          (Type: iterable[tuple[str, float, float]])
+
+        Keyword Args:
+            owner:        Name of this process. If given, all the leases it
+                          holds on the videos of the subset are released, so
+                          that other processes claim them right away.
+                          (Type: str or None)
+        """
+        self.flush()
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE segments SET state = ?, last_error = ?, updated_at = ? '
+                'WHERE subset = ? AND ytid = ? AND ts_start = ? AND ts_end = ? '
+                'AND state != ?',
+                [(STATE_PENDING, 'Interrupted', now, subset_name, ytid, ts_start, ts_end,
+                  STATE_DONE) for ytid, ts_start, ts_end in segments])
+            if owner is not None:
+                self.conn.execute('DELETE FROM leases WHERE subset = ? AND owner = ?',
+                                  (subset_name, owner))
+
+    def flush(self):
+        """
+        Write all buffered updates in a single transaction
+        """
+        if self._updates or self._releases:
+            # Leases may be released from another thread while flushing
+            releases = list(self._releases)
+            with self.conn:
+                self.conn.executemany(
+                    'UPDATE segments SET state = ?, attempts = attempts + 1, '
+                    'last_error = ?, audio_path = ?, video_path = ?, '
+                    'num_bytes = ?, elapsed = ?, updated_at = ? '
+                    'WHERE subset = ? AND ytid = ? AND ts_start = ? AND ts_end = ?',
+                    self._updates)
+                self.conn.executemany(
+                    'DELETE FROM leases WHERE subset = ? AND ytid = ? AND owner = ?',
+                    releases)
+            self._updates = []
+            del self._releases[:len(releases)]
+        self._last_flush = time.time()
+
+    def counts(self, subset_name):
+        """
+        Get the number of segments in each state for a subset
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+        Returns:
+            counts:  Number of segments per state
+                     (Type: dict[str, int])
+        """
+        rows = self.conn.execute(
+            'SELECT state, COUNT(*) FROM segments WHERE subset = ? GROUP BY state',
+            (subset_name,))
+        return dict(rows.fetchall())
+
+    def close(self):
+        """
+        Flush buffered updates and close the database
+        """
+        self.flush()
+        self.conn.close()
+
+
+class LeaseHeartbeat(object):
+    """
+    Renews the leases held by a process from a background thread, so that
+    they only expire if the process stops.
+    """
+
+    def __init__(self, path, owner, lease_timeout=300.0, interval=None):
+        """
+        Args:
+            path:           Path to SQLite database file of the manifest
+                            (Type: str)
+
+            owner:          Name of the process holding the leases
+                            (Type: str)
+
+        Keyword Args:
+            lease_timeout:  Number of seconds after which a lease that was not
+                            renewed expires
+                            (Type: float)
+
+            interval:       Number of seconds between renewals. If None, a
+                            third of the lease timeout.
+                            (Type: float or None)
+        """
+        self.path = path
+        self.owner = owner
+        self.lease_timeout = lease_timeout
+        self.interval = interval or lease_timeout / 3
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    with conn:
+                        conn.execute('UPDATE leases SET expires_at = ? WHERE owner = ?',
+                                     (time.time() + self.lease_timeout, self.owner))
+                except sqlite3.Error as e:
+                    LOGGER.warning('Could not renew leases of {}: {}'.format(self.owner, e))
+        finally:
+            conn.close()
+
+    def start(self):
+        """
+        Start renewing the leases periodically
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='lease-heartbeat',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop renewing the leases. Leases that were not released expire after
+        the lease timeout.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,360 @@
+"""
+Aggregation and export of download metrics
+"""
+import bisect
+import collections
+import json
+import logging
+import threading
+import time
+
+from utils import write_atomic
+
+LOGGER = logging.getLogger('audiosetdl')
+
+# Upper bounds (in seconds) of the histogram buckets of stage durations
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+METRIC_PREFIX = 'audiosetdl_'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for k, v in sorted(labels.items()))
+    return '{' + ','.join(items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values with fixed bucket bounds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Keyword Args:
+            buckets:  Upper bounds of the buckets, in increasing order
+                      (Type: tuple[float])
+        """
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram
+
+        Args:
+            value:  Observed value
+                    (Type: float)
+        """
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within its bucket
+
+        Args:
+            q:  Quantile, between 0 and 1
+                (Type: float)
+
+        Returns:
+            value:  Estimated value of the quantile, or None if the histogram
+                    is empty
+                    (Type: float or None)
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.bucket_counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                upper = min(upper, self.max)
+                lower = min(lower, upper)
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.max
+
+
+class Metrics(object):
+    """
+    Counters and histograms of the segments processed in a run.
+
+    The parent process updates the metrics as jobs are dispatched and their
+    results come back from the workers, so no state is shared with the
+    worker processes. All methods are thread-safe.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Keyword Args:
+            buckets:  Upper bounds (in seconds) of the histogram buckets of
+                      stage durations
+                      (Type: tuple[float])
+        """
+        self.buckets = buckets
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self.num_dispatched = 0
+        self.num_completed = 0
+        self.segments = collections.Counter()
+        self.failures = collections.Counter()
+        self.retries = 0
+        self.http_errors = 0
+        self.bytes_out = 0
+        self.stage_durations = collections.OrderedDict()
+
+    def dispatched(self):
+        """
+        Record that a segment job was dispatched
+        """
+        with self._lock:
+            self.num_dispatched += 1
+
+    def skipped(self, subset_name, count=1):
+        """
+        Record segments that were skipped because they were already downloaded
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+        Keyword Args:
+            count:        Number of skipped segments
+                          (Type: int)
+        """
+        with self._lock:
+            self.segments[(subset_name, 'skipped')] += count
+
+    def observe(self, subset_name, result):
+        """
+        Record the result of a segment job
+
+        Args:
+            subset_name:  Name of subset
+                          (Type: str)
+
+            result:       Download status of the segment
+                          (Type: scheduler.SegmentResult)
+        """
+        with self._lock:
+            self.num_completed += 1
+            if result.succeeded:
+                self.segments[(subset_name, 'succeeded')] += 1
+            else:
+                self.segments[(subset_name, 'failed')] += 1
+                self.failures[(subset_name, result.error_class or 'Unknown')] += 1
+            self.retries += result.retries or 0
+            self.http_errors += result.http_errors or 0
+            self.bytes_out += result.num_bytes or 0
+
+            stages = dict(result.timings or {})
+            if result.elapsed is not None:
+                stages['total'] = result.elapsed
+            for stage, seconds in stages.items():
+                if stage not in self.stage_durations:
+                    self.stage_durations[stage] = Histogram(self.buckets)
+                self.stage_durations[stage].observe(seconds)
+
+    @property
+    def in_flight(self):
+        return max(self.num_dispatched - self.num_completed, 0)
+
+    def to_prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format
+
+        Returns:
+            text:  Metrics text
+                   (Type: str)
+        """
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{}{} {}'.format(METRIC_PREFIX, name, suffix,
+                                                  _format_labels(labels),
+                                                  _format_value(value)))
+
+        with self._lock:
+            add_metric('segments_in_flight', 'gauge',
+                       'Number of segment jobs dispatched that have not completed',
+                       [('', {}, self.in_flight)])
+            add_metric('segments_total', 'counter',
+                       'Number of segments processed, by subset and status',
+                       [('', {'subset': subset, 'status': status}, count)
+                        for (subset, status), count in sorted(self.segments.items())])
+            add_metric('segment_failures_total', 'counter',
+                       'Number of failed segments, by subset and error class',
+                       [('', {'subset': subset, 'error_class': error_class}, count)
+                        for (subset, error_class), count in sorted(self.failures.items())])
+            add_metric('retries_total', 'counter',
+                       'Number of ffmpeg invocations that were retried',
+                       [('', {}, self.retries)])
+            add_metric('http_errors_total', 'counter',
+                       'Number of HTTP error responses received while resolving '
+                       'or downloading segments',
+                       [('', {}, self.http_errors)])
+            add_metric('bytes_written_total', 'counter',
+                       'Number of bytes of audio and video files written',
+                       [('', {}, self.bytes_out)])
+
+            samples = []
+            for stage, hist in self.stage_durations.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                               hist.bucket_counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', {'stage': stage, 'le': _format_value(bound)},
+                                    cumulative))
+                samples.append(('_sum', {'stage': stage}, hist.sum))
+                samples.append(('_count', {'stage': stage}, hist.count))
+            add_metric('stage_duration_seconds', 'histogram',
+                       'Time spent in each stage of a segment job', samples)
+
+            add_metric('uptime_seconds', 'gauge', 'Number of seconds since the run started',
+                       [('', {}, time.time() - self.started_at)])
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Summarize the metrics of the run
+
+        Returns:
+            summary:  JSON-serializable summary
+                      (Type: dict)
+        """
+        with self._lock:
+            wall_time = time.time() - self.started_at
+            num_succeeded = sum(count for (_, status), count in self.segments.items()
+                                if status == 'succeeded')
+            subsets = collections.OrderedDict()
+            for (subset, status), count in sorted(self.segments.items()):
+                subsets.setdefault(subset, {})[status] = count
+            failures = collections.OrderedDict()
+            for (subset, error_class), count in sorted(self.failures.items()):
+                failures.setdefault(subset, {})[error_class] = count
+
+            stages = collections.OrderedDict()
+            for stage, hist in self.stage_durations.items():
+                stages[stage] = {
+                    'count': hist.count,
+                    'total_seconds': hist.sum,
+                    'mean_seconds': hist.sum / hist.count,
+                    'p50_seconds': hist.quantile(0.5),
+                    'p95_seconds': hist.quantile(0.95),
+                    'max_seconds': hist.max,
+                }
+
+            return {
+                'wall_time_seconds': wall_time,
+                'segments': subsets,
+                'failures': failures,
+                'retries': self.retries,
+                'http_errors': self.http_errors,
+                'bytes_written': self.bytes_out,
+                'segments_per_second': num_succeeded / wall_time if wall_time > 0 else 0.0,
+                'stages': stages,
+            }
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in the Prometheus text exposition format, e.g. for
+        the textfile collector of the node exporter
+
+        Args:
+            path:  Path to output file
+                   (Type: str)
+        """
+        write_atomic(path, self.to_prometheus())
+
+    def write_summary(self, path):
+        """
+        Write the summary of the metrics as JSON
+
+        Args:
+            path:  Path to output file
+                   (Type: str)
+        """
+        write_atomic(path, json.dumps(self.summary(), indent=2) + '\n')
+
+
+class MetricsReporter(object):
+    """
+    Periodically rewrites the Prometheus metrics file from a background
+    thread, and writes the final metrics and the JSON summary when stopped.
+    """
+
+    def __init__(self, metrics, metrics_path=None, summary_path=None, interval=15.0):
+        """
+        Args:
+            metrics:       Metrics to export
+                           (Type: metrics.Metrics)
+
+        Keyword Args:
+            metrics_path:  Path to Prometheus metrics file. If None, not written.
+                           (Type: str or None)
+
+            summary_path:  Path to JSON summary file. If None, not written.
+                           (Type: str or None)
+
+            interval:      Number of seconds between rewrites of the metrics file
+                           (Type: float)
+        """
+        self.metrics = metrics
+        self.metrics_path = metrics_path
+        self.summary_path = summary_path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._write_metrics()
+
+    def _write_metrics(self):
+        try:
+            self.metrics.write_prometheus(self.metrics_path)
+        except OSError as e:
+            LOGGER.warning('Could not write metrics to {}: {}'.format(self.metrics_path, e))
+
+    def start(self):
+        """
+        Start rewriting the metrics file periodically
+        """
+        if self.metrics_path and self._thread is None:
+            self._write_metrics()
+            self._thread = threading.Thread(target=self._run, name='metrics-reporter',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and write the final metrics and summary
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.metrics_path:
+            self._write_metrics()
+        if self.summary_path:
+            self.metrics.write_summary(self.summary_path)
+            LOGGER.info('Wrote metrics summary to {}'.format(self.summary_path))
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+"""
+Moves downloaded files into the bucket layout used by `download_audioset.py`
+and writes an index of the files of every subset.
+
+Files of older versions, which are named by YouTube ID only, are renamed
+after the segment they were downloaded for. Segments of the same video used
+to share such files, so a file is attributed to the segment of its video that
+was recorded first in the manifest, or to the only segment of its video in
+the subset segments file. No file is ever removed: files that cannot be
+attributed are left in place, and the other segments that shared a file are
+pending again in the manifest.
+"""
+import argparse
+import collections
+import csv
+import io
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import sqlite3
+import time
+from functools import partial
+
+from log import init_console_logger
+from manifest import STATE_DONE, STATE_PENDING
+from scheduler import read_segments
+from utils import get_media_filename, get_layout, get_subset_name, parse_segment_key, \
+    read_layout, write_atomic, write_layout
+
+LOGGER = logging.getLogger('audiosetdl')
+LOGGER.setLevel(logging.DEBUG)
+
+MEDIA_DIRS = ('audio', 'video')
+
+# Index of the files of a subset, written in its data directory
+INDEX_FILENAME = 'index.csv'
+
+
+def parse_arguments():
+    """
+    Parse arguments from the command line
+
+
+    Returns:
+        args:  Argument dictionary
+               (Type: dict[str, str])
+    """
+    parser = argparse.ArgumentParser(description='Move downloaded AudioSet files into a '
+                                                 'bucket layout and index them')
+
+    parser.add_argument('-nb',
+                        '--num-buckets',
+                        dest='num_buckets',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help="Number of buckets to store the downloaded files"
+                             " into (default = no bucketing)")
+
+    parser.add_argument('-bl',
+                        '--bucket-levels',
+                        dest='bucket_levels',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='Number of levels of nested buckets, each with '
+                             '--num-buckets buckets')
+
+    parser.add_argument('-s',
+                        '--subset',
+                        dest='subsets',
+                        action='append',
+                        default=None,
+                        help='Name of a subset to migrate, e.g. eval_segments. Can '
+                             'be given multiple times (default = all subsets)')
+
+    parser.add_argument('-sf',
+                        '--segments-file',
+                        dest='segments_paths',
+                        action='append',
+                        default=None,
+                        help='Path to a subset segments file, used to attribute the '
+                             'files named by YouTube ID only of videos with a single '
+                             'segment when there is no manifest. Can be given multiple '
+                             'times (default = <data_dir>/<subset>.csv if it exists)')
+
+    parser.add_argument('-n',
+                        '--num-workers',
+                        dest='num_workers',
+                        action='store',
+                        type=int,
+                        default=mp.cpu_count(),
+                        help='Number of processes that move files in parallel')
+
+    parser.add_argument('-dr',
+                        '--dry-run',
+                        dest='dry_run',
+                        action='store_true',
+                        default=False,
+                        help='Only report how many files would be moved')
+
+    parser.add_argument('-v',
+                        '--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        default=False,
+                        help='If True, prints detailed information about the migration')
+
+    parser.add_argument('data_dir',
+                        action='store',
+                        type=str,
+                        help='Path to directory where AudioSet data is stored')
+
+    return vars(parser.parse_args())
+
+
+def get_target_path(path, num_buckets, bucket_levels=1, segments=None):
+    """
+    Get the path of a downloaded file in a bucket layout
+
+    Args:
+        path:           Path to file in the audio or video directory of a
+                        subset, in any layout
+                        (Type: str)
+
+        num_buckets:    Number of buckets in each level. If None, files are
+                        not bucketed.
+                        (Type: int or None)
+
+    Keyword Args:
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+        segments:       (start time, end time) of the segment that each file
+                        named by YouTube ID only belongs to, by YouTube ID
+                        (Type: dict[str, tuple[float, float]] or None)
+
+    Returns:
+        target_path:  Path to file in the bucket layout, the given path if it
+                      is not in an audio or video directory, or None if it is
+                      named by YouTube ID only and its segment is unknown
+                      (Type: str or None)
+    """
+    media_dir, filename = os.path.split(path)
+    while os.path.basename(media_dir) not in MEDIA_DIRS:
+        parent_dir = os.path.dirname(media_dir)
+        if parent_dir == media_dir:
+            return path
+        media_dir = parent_dir
+
+    # Files are named <YouTube ID>_<start ms>_<end ms>.<extension>, or
+    # <YouTube ID>.<extension> by older versions
+    if '.' not in filename:
+        return path
+    key, ext = filename.split('.', 1)
+    ytid, ts_start, ts_end = parse_segment_key(key)
+    if ts_start is None:
+        if not segments or ytid not in segments:
+            return None
+        ts_start, ts_end = segments[ytid]
+    media_filename = get_media_filename(ytid, ts_start, ts_end, num_buckets, bucket_levels)
+    return os.path.join(media_dir, media_filename + '.' + ext)
+
+
+def read_legacy_segments(manifest_path, subset_name):
+    """
+    Read the segment that the files named by YouTube ID only of each video of
+    a subset belong to, from the manifest.
+
+    ffmpeg did not overwrite existing files, so such a file holds the segment
+    of its video that was recorded first with it. Videos whose first segment
+    cannot be told apart are left out.
+
+    Args:
+        manifest_path:  Path to SQLite database file of the manifest
+                        (Type: str)
+
+        subset_name:    Name of subset
+                        (Type: str)
+
+    Returns:
+        segments:  (start time, end time) of the segment of each video
+                   (Type: dict[str, tuple[float, float]])
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    conn.create_function('is_named_by_ytid', 2, is_named_by_ytid)
+    try:
+        rows = conn.execute(
+            'SELECT ytid, ts_start, ts_end, updated_at, '
+            'is_named_by_ytid(COALESCE(audio_path, video_path), ytid) FROM segments '
+            'WHERE subset = ? AND state = ? ORDER BY ytid', (subset_name, STATE_DONE))
+        segments = {}
+        for ytid, video_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            video_rows = list(video_rows)
+            recorded = sorted((row for row in video_rows if row[4]),
+                              key=lambda row: row[3] or 0.0)
+            if len(recorded) == 1 or (len(recorded) > 1
+                                      and (recorded[0][3] or 0.0) < (recorded[1][3] or 0.0)):
+                segments[ytid] = recorded[0][1:3]
+            elif not recorded and len(video_rows) == 1:
+                # Adopted before the manifest existed, without a path
+                segments[ytid] = video_rows[0][1:3]
+    finally:
+        conn.close()
+    return segments
+
+
+def read_single_segments(segments_path):
+    """
+    Read the segment of each video that has a single segment in a subset
+    segments file, which the files of the video that are named by YouTube ID
+    only belong to
+
+    Args:
+        segments_path:  Path to subset segments file
+                        (Type: str)
+
+    Returns:
+        segments:  (start time, end time) of the segment of each video
+                   (Type: dict[str, tuple[float, float]])
+    """
+    segments = {}
+    ytid_counts = collections.Counter()
+    for ytid, ts_start, ts_end, _ in read_segments(segments_path):
+        ytid_counts[ytid] += 1
+        segments[ytid] = (ts_start, ts_end)
+    return {ytid: segment for ytid, segment in segments.items() if ytid_counts[ytid] == 1}
+
+
+def is_named_by_ytid(path, ytid):
+    """
+    Check if a recorded output path is named by YouTube ID only, as by older
+    versions
+
+    Args:
+        path:  Path to output file
+               (Type: str or None)
+
+        ytid:  YouTube ID of its video
+               (Type: str)
+
+    Returns:
+        named_by_ytid:  True if the file is named by YouTube ID only
+                        (Type: bool)
+    """
+    return bool(path) and os.path.basename(path).split('.', 1)[0] == ytid
+
+
+def list_entry(path):
+    """
+    List the files under an entry of the audio or video directory of a subset
+
+    Args:
+        path:  Path to a file or a bucket directory
+               (Type: str)
+
+    Returns:
+        filepaths:  Paths to files
+                    (Type: list[str])
+    """
+    if not os.path.isdir(path):
+        return [path]
+
+    filepaths = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        # Hidden files are partial outputs and temporary files
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        filepaths.extend(os.path.join(dirpath, name) for name in filenames
+                         if not name.startswith('.'))
+    return filepaths
+
+
+def migrate_file(move, dry_run=False):
+    """
+    Move a file into a bucket layout
+
+    Args:
+        move:     Path to file in the audio or video directory of a subset,
+                  and its path in the layout, or None if it cannot be
+                  attributed to a segment
+                  (Type: tuple[str, str or None])
+
+    Keyword Args:
+        dry_run:  If True, do not move the file
+                  (Type: bool)
+
+    Returns:
+        status:     'moved', 'kept' if the file was already in place,
+                    'conflict' if another file is at its path in the layout,
+                    or 'unattributed' if it was left in place because it
+                    could not be attributed to a segment
+                    (Type: str)
+
+        filepath:   Path to the file after the migration
+                    (Type: str)
+    """
+    filepath, target_path = move
+    if target_path is None:
+        return 'unattributed', filepath
+    if target_path == filepath:
+        return 'kept', filepath
+    if os.path.exists(target_path):
+        return 'conflict', filepath
+    if not dry_run:
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.rename(filepath, target_path)
+    return 'moved', target_path
+
+
+def remove_empty_dirs(media_dir):
+    """
+    Remove the empty directories under a directory
+
+    Args:
+        media_dir:  Path to directory
+                    (Type: str)
+    """
+    for dirpath, _, _ in os.walk(media_dir, topdown=False):
+        if dirpath != media_dir:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # Not empty
+                pass
+
+
+def write_index(subset_dir, filepaths):
+    """
+    Write the index of the files of a subset, with one row of YouTube ID,
+    media type and path relative to the subset data directory per file
+
+    Args:
+        subset_dir:  Path to subset data directory
+                     (Type: str)
+
+        filepaths:   Paths to files in the audio and video directories
+                     (Type: iterable[str])
+    """
+    rows = []
+    for filepath in filepaths:
+        relpath = os.path.relpath(filepath, subset_dir)
+        media = relpath.split(os.sep, 1)[0]
+        ytid = parse_segment_key(os.path.basename(filepath).split('.', 1)[0])[0]
+        rows.append((ytid, media, relpath))
+
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(('ytid', 'media', 'path'))
+    writer.writerows(sorted(rows))
+    write_atomic(os.path.join(subset_dir, INDEX_FILENAME), f.getvalue())
+
+
+def update_manifest(manifest_path, subset_segments, num_buckets, bucket_levels=1):
+    """
+    Update the paths of the outputs recorded in the manifest to a bucket layout.
+    Segments recorded with files named by YouTube ID only that do not belong
+    to them are pending again.
+
+    Args:
+        manifest_path:    Path to SQLite database file of the manifest
+                          (Type: str)
+
+        subset_segments:  Segment that the files named by YouTube ID only of
+                          each video belong to, by subset name
+                          (Type: dict[str, dict[str, tuple[float, float]]])
+
+        num_buckets:    Number of buckets in each level. If None, files are
+                        not bucketed.
+                        (Type: int or None)
+
+    Keyword Args:
+        bucket_levels:    Number of levels of nested buckets
+                          (Type: int)
+
+    Returns:
+        num_updated:  Number of updated segments
+                      (Type: int)
+
+        num_reset:    Number of segments that are pending again
+                      (Type: int)
+    """
+    def relocate(path, ytid, ts_start, ts_end):
+        if not path:
+            return path
+        return get_target_path(path, num_buckets, bucket_levels,
+                               segments={ytid: (ts_start, ts_end)})
+
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    conn.create_function('relocate', 4, relocate)
+    conn.create_function('is_named_by_ytid', 2, is_named_by_ytid)
+    num_updated = 0
+    num_reset = 0
+    with conn:
+        for subset_name, segments in subset_segments.items():
+            conn.create_function(
+                'owns_file', 3,
+                lambda ytid, ts_start, ts_end: segments.get(ytid) == (ts_start, ts_end))
+            # These segments were recorded with the files of another segment
+            # of their video, which are not theirs
+            cur = conn.execute(
+                'UPDATE segments SET state = ?, audio_path = NULL, video_path = NULL, '
+                'last_error = ?, updated_at = ? '
+                'WHERE subset = ? AND state = ? '
+                'AND is_named_by_ytid(COALESCE(audio_path, video_path), ytid) '
+                'AND NOT owns_file(ytid, ts_start, ts_end)',
+                (STATE_PENDING, 'Shared output', time.time(), subset_name, STATE_DONE))
+            num_reset += max(cur.rowcount, 0)
+            cur = conn.execute(
+                'UPDATE segments SET audio_path = relocate(audio_path, ytid, ts_start, ts_end), '
+                'video_path = relocate(video_path, ytid, ts_start, ts_end) '
+                'WHERE subset = ? AND (audio_path IS NOT NULL OR video_path IS NOT NULL)',
+                (subset_name,))
+            num_updated += max(cur.rowcount, 0)
+    conn.close()
+    return num_updated, num_reset
+
+
+def migrate_buckets(data_dir, num_buckets=None, bucket_levels=1, subsets=None,
+                    segments_paths=None, num_workers=4, dry_run=False, verbose=False):
+    """
+    Move the downloaded files of AudioSet subsets into a bucket layout, in
+    parallel, and write the index of the files of every subset. The paths in
+    the manifest are updated accordingly. Files named by YouTube ID only are
+    renamed after their segment, or left in place if it is unknown. No file
+    is removed.
+
+    This must not run while files are being downloaded into `data_dir`.
+
+    Args:
+        data_dir:       Directory where dataset files are saved
+                        (Type: str)
+
+    Keyword Args:
+        num_buckets:    Number of buckets in each level. If None, files are
+                        moved out of buckets.
+                        (Type: int or None)
+
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+        subsets:        Names of subsets to migrate. If None, all subsets.
+                        (Type: list[str] or None)
+
+        segments_paths: Paths to subset segments files, used to attribute the
+                        files named by YouTube ID only of videos with a single
+                        segment. If None, <data_dir>/<subset>.csv is used if
+                        it exists.
+                        (Type: list[str] or None)
+
+        num_workers:    Number of processes that move files in parallel
+                        (Type: int)
+
+        dry_run:        If True, only report how many files would be moved
+                        (Type: bool)
+
+        verbose:        If True, print detailed information
+                        (Type: bool)
+    """
+    init_console_logger(LOGGER, verbose=verbose)
+
+    subsets_dir = os.path.join(data_dir, 'data')
+    if subsets is None:
+        subsets = sorted(name for name in os.listdir(subsets_dir)
+                         if os.path.isdir(os.path.join(subsets_dir, name)))
+
+    segments_paths = {get_subset_name(path): path for path in segments_paths or []}
+    manifest_path = os.path.join(data_dir, 'manifest.db')
+    subset_segments = {}
+    pool = mp.Pool(num_workers)
+    try:
+        for subset_name in subsets:
+            subset_dir = os.path.join(subsets_dir, subset_name)
+            layout = read_layout(subset_dir)
+            if layout == get_layout(num_buckets, bucket_levels):
+                LOGGER.info('Subset "{}" is already in the layout'.format(subset_name))
+
+            # Every bucket directory (or file, if not bucketed) is listed by
+            # a separate task, and all files are listed before any is moved
+            paths = []
+            for media in MEDIA_DIRS:
+                media_dir = os.path.join(subset_dir, media)
+                if os.path.isdir(media_dir):
+                    paths.extend(os.path.join(media_dir, name) for name in os.listdir(media_dir)
+                                 if not name.startswith('.'))
+            src_filepaths = list(itertools.chain.from_iterable(
+                pool.imap_unordered(list_entry, paths, chunksize=16)))
+
+            segments_path = segments_paths.get(
+                subset_name, os.path.join(data_dir, subset_name + '.csv'))
+            segments = {}
+            if os.path.exists(segments_path):
+                segments.update(read_single_segments(segments_path))
+            # The manifest knows which segment was downloaded first
+            segments.update(read_legacy_segments(manifest_path, subset_name))
+            subset_segments[subset_name] = segments
+            moves = [(filepath, get_target_path(filepath, num_buckets, bucket_levels,
+                                                segments=segments))
+                     for filepath in src_filepaths]
+
+            worker_func = partial(migrate_file, dry_run=dry_run)
+            status_counts = collections.Counter()
+            filepaths = []
+            for status, filepath in pool.imap_unordered(worker_func, moves, chunksize=256):
+                status_counts[status] += 1
+                if status == 'conflict':
+                    LOGGER.warning('Not moving {}: another file is at its path in '
+                                   'the layout'.format(filepath))
+                elif status == 'unattributed':
+                    LOGGER.debug('Not moving {}: it is named by YouTube ID only and its '
+                                 'segment is unknown'.format(filepath))
+                filepaths.append(filepath)
+
+            info_msg = '{} subset "{}": {} files moved, {} already in place, {} conflicts, ' \
+                       '{} unattributed'
+            LOGGER.info(info_msg.format('Would migrate' if dry_run else 'Migrated', subset_name,
+                                        status_counts['moved'], status_counts['kept'],
+                                        status_counts['conflict'],
+                                        status_counts['unattributed']))
+            if status_counts['unattributed']:
+                warn_msg = '{} files of subset "{}" are named by YouTube ID only and could ' \
+                           'not be attributed to a segment. They are left in place, and ' \
+                           'their segments will be downloaded again. Give the subset ' \
+                           'segments file with --segments-file to attribute the files of ' \
+                           'videos with a single segment.'
+                LOGGER.warning(warn_msg.format(status_counts['unattributed'], subset_name))
+            if dry_run:
+                continue
+
+            for media in MEDIA_DIRS:
+                remove_empty_dirs(os.path.join(subset_dir, media))
+            write_index(subset_dir, filepaths)
+            write_layout(subset_dir, num_buckets, bucket_levels)
+
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        LOGGER.info("Forcing exit.")
+        exit()
+
+    if not dry_run and os.path.exists(manifest_path):
+        num_updated, num_reset = update_manifest(manifest_path, subset_segments, num_buckets,
+                                                 bucket_levels)
+        LOGGER.info('Updated the paths of {} segments in {}, {} segments are pending '
+                    'again'.format(num_updated, manifest_path, num_reset))
+
+
+if __name__ == '__main__':
+    migrate_buckets(**parse_arguments())
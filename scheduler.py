@@ -0,0 +1,413 @@
+"""
+Scheduling of segment download jobs on a multiprocessing pool
+"""
+import collections
+import concurrent.futures
+import csv
+import logging
+import queue
+import signal
+import threading
+import time
+
+from utils import configure_commands, kill_running_commands
+
+LOGGER = logging.getLogger('audiosetdl')
+
+SegmentResult = collections.namedtuple(
+    'SegmentResult', ['ytid', 'ts_start', 'ts_end', 'succeeded',
+                      'error_class', 'error_msg', 'audio_filepath',
+                      'video_filepath', 'num_bytes', 'elapsed', 'timings',
+                      'retries', 'http_errors', 'permanent', 'samples',
+                      'feature_filepath'])
+SegmentResult.__new__.__defaults__ = (None,) * 12
+
+
+CompletedTask = collections.namedtuple('CompletedTask', ['result'])
+CompletedTask.__doc__ = """
+Item of the iterable passed to `imap_bounded` that already has a result and
+is yielded as is instead of being submitted to the pool.
+"""
+
+_END_OF_QUEUE = object()
+_STOPPED = object()
+
+# Number of seconds between checks of a stop event while waiting for tasks
+STOP_POLL_INTERVAL = 0.1
+
+
+class _TaskError(object):
+    """
+    Wraps an exception raised inside of a pool task so that it can be told
+    apart from a regular result on the completion queue.
+    """
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _exit_worker(signum, frame):
+    kill_running_commands()
+    # Exiting with an exception, rather than being killed, releases the locks
+    # of the pool queues, which would otherwise deadlock the pool
+    raise SystemExit(128 + signum)
+
+
+def init_pool_worker(command_timeout=None):
+    """
+    Initializer for pool worker processes.
+
+    Workers ignore SIGINT so that a Ctrl-C is only handled by the parent
+    process, which then tears down the pool. On SIGTERM, e.g. from
+    `Pool.terminate`, a worker kills the commands it is running and exits.
+
+    Keyword Args:
+        command_timeout:  Number of seconds after which a command run by the
+                          worker is killed. If None, no timeout.
+                          (Type: float or None)
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _exit_worker)
+    configure_commands(timeout=command_timeout)
+
+
+class ShutdownHandler(object):
+    """
+    Turns SIGTERM and SIGINT into a request to stop, e.g. when a job is
+    preempted, so that the process can stop dispatching work, record where
+    it stopped and exit at a point where nothing is half written. A second
+    signal raises a KeyboardInterrupt, to exit right away.
+    """
+
+    def __init__(self, signums=(signal.SIGTERM, signal.SIGINT)):
+        """
+        Keyword Args:
+            signums:  Signals that request to stop
+                      (Type: tuple[int])
+        """
+        self.signums = signums
+        self.event = threading.Event()
+        self.signum = None
+        self._prev_handlers = {}
+
+    def _handle(self, signum, frame):
+        if self.event.is_set():
+            raise KeyboardInterrupt()
+        self.signum = signum
+        self.event.set()
+        LOGGER.warning('Received {}, stopping. Send it again to exit right away.'.format(
+            signal.Signals(signum).name))
+
+    @property
+    def requested(self):
+        """
+        True if a signal requested to stop
+        """
+        return self.event.is_set()
+
+    def install(self):
+        """
+        Handle the signals in this process. Must be called from the main
+        thread.
+        """
+        for signum in self.signums:
+            self._prev_handlers[signum] = signal.signal(signum, self._handle)
+
+    def restore(self):
+        """
+        Restore the previous handlers of the signals
+        """
+        for signum, handler in self._prev_handlers.items():
+            signal.signal(signum, handler)
+        self._prev_handlers = {}
+
+
+def read_segments(subset_path):
+    """
+    Lazily read the segments in a subset segments file, one row at a time
+
+    Args:
+        subset_path:  Path to subset segments file
+                      (Type: str)
+
+    Yields:
+        segment:  Tuple of (YouTube ID, start time, end time, row)
+                  (Type: tuple[str, float, float, list[str]])
+    """
+    with open(subset_path, 'r') as f:
+        reader = csv.reader(f)
+        try:
+            for row in reader:
+                # Skip empty and commented lines
+                if not row or row[0][0] == '#':
+                    continue
+                yield row[0], float(row[1]), float(row[2]), row
+        except csv.Error as e:
+            raise csv.Error('line {}: {}'.format(reader.line_num, e))
+
+
+def get_row_labels(row):
+    """
+    Get the labels of a segment from its row in a subset segments file, where
+    the quoted, comma-separated labels are split over the last columns
+
+    Args:
+        row:  Row of the segment
+              (Type: list[str])
+
+    Returns:
+        labels:  Label IDs of the segment
+                 (Type: list[str])
+    """
+    labels = ','.join(row[3:]).replace('"', '').split(',')
+    return [label.strip() for label in labels if label.strip()]
+
+
+def _get_limit(max_in_flight):
+    return max_in_flight() if callable(max_in_flight) else max_in_flight
+
+
+def imap_bounded(pool, func, iterable, max_in_flight, stop_event=None, stop_timeout=0.0):
+    """
+    Apply a function to each set of arguments in an iterable using a
+    multiprocessing pool, keeping at most `max_in_flight` tasks submitted at
+    any given time.
+
+    The iterable is only consumed as tasks complete, so the parent process
+    never holds more than `max_in_flight` pending tasks and their arguments,
+    regardless of the length of the iterable. Results are yielded in the
+    order in which the tasks complete. Items of the iterable that are
+    `CompletedTask` instances are not submitted, and their result is yielded
+    right away.
+
+    If `max_in_flight` is a function, it is called before each submission,
+    so the limit can be changed while iterating. When the limit shrinks,
+    no new tasks are submitted until enough of the running tasks completed.
+
+    Once `stop_event` is set, no new tasks are submitted, and the results of
+    the running tasks are yielded for at most `stop_timeout` more seconds.
+    The iteration then ends without waiting for the tasks that are still
+    running.
+
+    Args:
+        pool:           Multiprocessing pool
+                        (Type: multiprocessing.pool.Pool)
+
+        func:           Function to apply
+                        (Type: callable)
+
+        iterable:       Iterable of argument lists for `func`
+                        (Type: iterable[list])
+
+        max_in_flight:  Maximum number of submitted tasks that have not
+                        completed yet, or function that returns it
+                        (Type: int or callable[[], int])
+
+    Keyword Args:
+        stop_event:     Event that stops the submission of tasks when set
+                        (Type: threading.Event or None)
+
+        stop_timeout:   Number of seconds the running tasks are waited for
+                        once `stop_event` is set
+                        (Type: float)
+
+    Yields:
+        result:  Value returned by `func` for a completed task
+                 (Type: *)
+    """
+    if not callable(max_in_flight) and max_in_flight < 1:
+        raise ValueError('max_in_flight must be a positive integer')
+
+    done_queue = queue.Queue()
+    num_in_flight = 0
+    stop_deadline = []
+
+    def is_stopped():
+        if stop_event is None or not stop_event.is_set():
+            return False
+        if not stop_deadline:
+            stop_deadline.append(time.time() + stop_timeout)
+        return True
+
+    def get_result():
+        while True:
+            try:
+                result = done_queue.get(
+                    timeout=STOP_POLL_INTERVAL if stop_event is not None else None)
+            except queue.Empty:
+                if is_stopped() and time.time() >= stop_deadline[0]:
+                    return _STOPPED
+                continue
+            if isinstance(result, _TaskError):
+                raise result.exc
+            return result
+
+    for args in iterable:
+        if is_stopped():
+            break
+        if isinstance(args, CompletedTask):
+            yield args.result
+            continue
+
+        while num_in_flight >= max(_get_limit(max_in_flight), 1):
+            result = get_result()
+            if result is _STOPPED:
+                return
+            num_in_flight -= 1
+            yield result
+
+        if is_stopped():
+            break
+        pool.apply_async(func, args, callback=done_queue.put,
+                         error_callback=lambda e: done_queue.put(_TaskError(e)))
+        num_in_flight += 1
+
+    while num_in_flight > 0:
+        result = get_result()
+        if result is _STOPPED:
+            return
+        num_in_flight -= 1
+        yield result
+
+
+def imap_pipelined(pool, resolve_func, func, iterable, num_resolvers,
+                   max_in_flight, queue_size, report_interval=60, stop_event=None,
+                   stop_timeout=0.0):
+    """
+    Run jobs through a two-stage pipeline: a pool of threads that run
+    `resolve_func`, which is expected to be I/O-bound, feeding a bounded queue
+    that is consumed by a multiprocessing pool that runs `func`.
+
+    `resolve_func` is called with each argument list in `iterable` and
+    returns the argument list for `func`, or a `CompletedTask` if the job
+    should not be passed on to the second stage. Both stages have their own
+    concurrency, and the number of jobs in each stage is logged every
+    `report_interval` seconds. Once `stop_event` is set, no more jobs are
+    passed on to the second stage, which stops as in `imap_bounded`.
+
+    Args:
+        pool:             Multiprocessing pool
+                          (Type: multiprocessing.pool.Pool)
+
+        resolve_func:     Function run by the first stage
+                          (Type: callable)
+
+        func:             Function run by the second stage
+                          (Type: callable)
+
+        iterable:         Iterable of argument lists for `resolve_func`
+                          (Type: iterable[list])
+
+        num_resolvers:    Number of threads running the first stage
+                          (Type: int)
+
+        max_in_flight:    Maximum number of jobs submitted to the pool that
+                          have not completed yet, or function that returns it
+                          (Type: int or callable[[], int])
+
+        queue_size:       Maximum number of jobs waiting between the stages
+                          (Type: int)
+
+    Keyword Args:
+        report_interval:  Number of seconds between queue depth reports
+                          (Type: float)
+
+        stop_event:       Event that stops the submission of jobs when set
+                          (Type: threading.Event or None)
+
+        stop_timeout:     Number of seconds the running jobs of the second
+                          stage are waited for once `stop_event` is set
+                          (Type: float)
+
+    Yields:
+        result:  Value returned by `func`, or result of a `CompletedTask`
+                 (Type: *)
+    """
+    resolved_queue = queue.Queue(maxsize=queue_size)
+    resolve_slots = threading.BoundedSemaphore(num_resolvers)
+    resolve_stop_event = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(num_resolvers)
+    counts = collections.Counter()
+    counts_lock = threading.Lock()
+
+    def put_resolved(item):
+        # Block while the queue is full, so that resolution does not run
+        # ahead of the second stage, until the pipeline is stopped
+        while not resolve_stop_event.is_set():
+            try:
+                resolved_queue.put(item, timeout=STOP_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def acquire_slot():
+        while not resolve_slots.acquire(timeout=STOP_POLL_INTERVAL):
+            if resolve_stop_event.is_set():
+                return False
+        return not resolve_stop_event.is_set()
+
+    def on_resolved(future):
+        with counts_lock:
+            counts['resolving'] -= 1
+        if not future.cancelled():
+            put_resolved(future)
+        resolve_slots.release()
+
+    def resolve_stage():
+        try:
+            for args in iterable:
+                if not acquire_slot():
+                    break
+                with counts_lock:
+                    counts['resolving'] += 1
+                future = executor.submit(resolve_func, *args)
+                future.add_done_callback(on_resolved)
+            # The end of the queue comes after the last resolved job
+            executor.shutdown(wait=not resolve_stop_event.is_set())
+        except Exception as e:
+            put_resolved(_TaskError(e))
+        put_resolved(_END_OF_QUEUE)
+
+    def resolved_jobs():
+        while True:
+            try:
+                item = resolved_queue.get(
+                    timeout=STOP_POLL_INTERVAL if stop_event is not None else None)
+            except queue.Empty:
+                if stop_event.is_set():
+                    return
+                continue
+            if item is _END_OF_QUEUE:
+                return
+            if isinstance(item, _TaskError):
+                raise item.exc
+            counts['submitted'] += 1
+            yield item.result()
+
+    resolver_thread = threading.Thread(target=resolve_stage, daemon=True)
+    resolver_thread.start()
+
+    last_report = time.time()
+    try:
+        for result in imap_bounded(pool, func, resolved_jobs(), max_in_flight,
+                                   stop_event=stop_event, stop_timeout=stop_timeout):
+            yield result
+
+            if time.time() - last_report >= report_interval:
+                last_report = time.time()
+                info_msg = 'Pipeline status: {} resolving, {} queued, {} transcoding'
+                num_transcoding = min(counts['submitted'] - counts['completed'],
+                                      _get_limit(max_in_flight))
+                LOGGER.info(info_msg.format(counts['resolving'], resolved_queue.qsize(),
+                                            num_transcoding))
+            counts['completed'] += 1
+    finally:
+        resolve_stop_event.set()
+        # Jobs that are not resolved yet are dropped, and the resolver threads
+        # give up putting jobs into a full queue. The running resolutions are
+        # not waited for, since they may be waiting for the network.
+        executor.shutdown(wait=False, cancel_futures=True)
+        while resolver_thread.is_alive():
+            try:
+                resolved_queue.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                pass
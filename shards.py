@@ -0,0 +1,214 @@
+"""
+Packing of downloaded segments into tar shards
+"""
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+import uuid
+
+from utils import get_segment_key, get_temp_path, publish_file
+
+LOGGER = logging.getLogger('audiosetdl')
+
+# Suffix of the index written next to each shard
+INDEX_SUFFIX = '.index.json'
+
+
+def get_sample_key(ytid, ts_start, ts_end):
+    """
+    Get the key of the sample of a segment in a shard. Keys do not contain
+    dots, so that the extension of a member is all that follows the first dot
+    of its name, as expected by WebDataset.
+
+    Args:
+        ytid:      YouTube ID of a video
+                   (Type: str)
+
+        ts_start:  Segment start time (in seconds)
+                   (Type: float)
+
+        ts_end:    Segment end time (in seconds)
+                   (Type: float)
+
+    Returns:
+        key:  Sample key, of the format
+              <YouTube ID>_<start time in ms>_<end time in ms>
+              (Type: str)
+    """
+    # Samples have the same key as the files of the segment
+    return get_segment_key(ytid, ts_start, ts_end)
+
+
+def read_member(shard_path, member):
+    """
+    Read a member of a shard from its offset in the shard index, without
+    reading the rest of the shard
+
+    Args:
+        shard_path:  Path to shard
+                     (Type: str)
+
+        member:      Entry of the member in the shard index, with the keys
+                     'offset' and 'size'
+                     (Type: dict)
+
+    Returns:
+        data:  Contents of the member
+               (Type: bytes)
+    """
+    with open(shard_path, 'rb') as f:
+        f.seek(member['offset'])
+        return f.read(member['size'])
+
+
+class ShardWriter(object):
+    """
+    Streams the outputs of segments into tar shards of bounded size, in the
+    layout read by WebDataset: the members of a sample are named
+    <key>.<extension>, e.g. <key>.flac, <key>.mp4 and <key>.json.
+
+    A shard is written to a temporary file and published at its path once it
+    is full, along with an index of the offset and size of every member of
+    every sample, so that samples can be read without scanning the shard.
+    Samples are only safely stored once their shard is published, so each
+    sample can carry a payload that is handed back at that point, e.g. to
+    record that the segment is done.
+    """
+
+    def __init__(self, shard_dir, prefix, max_size=1 << 30, max_samples=None):
+        """
+        Args:
+            shard_dir:    Directory where shards are written
+                          (Type: str)
+
+            prefix:       Prefix of shard names, e.g. the subset name
+                          (Type: str)
+
+        Keyword Args:
+            max_size:     Number of bytes after which a shard is published
+                          (Type: int)
+
+            max_samples:  Number of samples after which a shard is published.
+                          If None, shards are only bounded by size.
+                          (Type: int or None)
+        """
+        self.shard_dir = shard_dir
+        self.max_size = max_size
+        self.max_samples = max_samples
+        # Shards are named uniquely for each writer, so that processes that
+        # share the shard directory never write to the same shard
+        self.name_prefix = '{}-{}'.format(prefix, uuid.uuid4().hex[:8])
+        self.num_shards = 0
+        os.makedirs(shard_dir, exist_ok=True)
+
+        self._tar = None
+        self._temp_path = None
+        self._samples = []
+        self._payloads = []
+
+    def _open(self):
+        self._temp_path = get_temp_path(self.shard_path)
+        self._tar = tarfile.open(self._temp_path, 'w', format=tarfile.USTAR_FORMAT)
+
+    @property
+    def shard_path(self):
+        """
+        Path of the shard that is being written
+        """
+        return os.path.join(self.shard_dir, '{}-{:06d}.tar'.format(self.name_prefix,
+                                                                   self.num_shards))
+
+    def _add_member(self, name, fileobj, size):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = time.time()
+        self._tar.addfile(tarinfo, fileobj)
+        # The data is padded to a whole number of blocks after the header
+        padded_size = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return {'offset': self._tar.offset - padded_size, 'size': size}
+
+    def add(self, key, filepaths, metadata, payload=None, data=None):
+        """
+        Add a sample to the current shard, and publish the shard if it is full
+
+        Args:
+            key:        Sample key, e.g. from `get_sample_key`
+                        (Type: str)
+
+            filepaths:  Paths to the files of the sample, by extension. The
+                        files can be removed once the sample is added.
+                        (Type: dict[str, str])
+
+            metadata:   JSON-serializable metadata of the sample, stored as
+                        <key>.json
+                        (Type: dict)
+
+        Keyword Args:
+            payload:    Object handed back once the shard is published
+                        (Type: *)
+
+            data:       Contents of the members of the sample that are not
+                        files, by extension
+                        (Type: dict[str, bytes] or None)
+
+        Returns:
+            payloads:  Payloads of the samples of the published shard, or an
+                       empty list if the shard is not full
+                       (Type: list)
+        """
+        if self._tar is None:
+            self._open()
+
+        members = {}
+        for ext, filepath in sorted(filepaths.items()):
+            with open(filepath, 'rb') as f:
+                members[ext] = self._add_member('{}.{}'.format(key, ext), f,
+                                                os.fstat(f.fileno()).st_size)
+        for ext, contents in sorted((data or {}).items()):
+            members[ext] = self._add_member('{}.{}'.format(key, ext), io.BytesIO(contents),
+                                            len(contents))
+        json_data = json.dumps(metadata, sort_keys=True).encode('utf-8')
+        members['json'] = self._add_member('{}.json'.format(key), io.BytesIO(json_data),
+                                           len(json_data))
+
+        self._samples.append({'key': key, 'members': members})
+        self._payloads.append(payload)
+
+        if self._tar.offset >= self.max_size \
+                or (self.max_samples and len(self._samples) >= self.max_samples):
+            return self.finalize()
+        return []
+
+    def finalize(self):
+        """
+        Publish the current shard and its index, even if it is not full
+
+        Returns:
+            payloads:  Payloads of the samples of the published shard
+                       (Type: list)
+        """
+        if self._tar is None:
+            return []
+
+        shard_path = self.shard_path
+        self._tar.close()
+        publish_file(self._temp_path, shard_path)
+
+        index = {'shard': os.path.basename(shard_path), 'samples': self._samples}
+        index_path = shard_path + INDEX_SUFFIX
+        temp_index_path = get_temp_path(index_path)
+        with open(temp_index_path, 'w') as f:
+            json.dump(index, f)
+        publish_file(temp_index_path, index_path)
+        LOGGER.info('Wrote {} samples to shard {}'.format(len(self._samples), shard_path))
+
+        payloads = self._payloads
+        self._tar = None
+        self._temp_path = None
+        self._samples = []
+        self._payloads = []
+        self.num_shards += 1
+        return payloads
@@ -0,0 +1,207 @@
+"""
+Source backends that resolve a YouTube ID to the media used to extract its segments
+"""
+import glob
+import json
+import os
+import re
+import urllib.error
+import urllib.request
+
+from cache import ResolvedStreams
+from errors import SourceUnavailableError
+from validation import ffprobe
+
+_BACKENDS = {}
+
+# Messages of the errors of pafy and youtube-dl for the cases listed in the
+# README where videos cannot be downloaded, which will not go away by trying
+# again
+PERMANENT_ERR_PATTERN = re.compile(
+    r'\bvideo unavailable|\bthis video is (?:unavailable|not available|private)'
+    r'|\bprivate video\b|\bthis video has been removed\b|\bthis video does not exist'
+    r'|\bthis video is no longer available because the (?:youtube account associated with '
+    r'this video has been terminated|uploader has closed their youtube account)'
+    r'|\bthis video is no longer available due to a copyright (?:claim|takedown)'
+    r'|\bwho has blocked it(?: in your country)? on copyright grounds'
+    r'|\bthe uploader has not made this video available in your country'
+    r'|\bsign in to (?:confirm your age|view this video)', re.IGNORECASE)
+
+
+class SourceBackend(object):
+    """
+    Interface of a source backend.
+
+    A backend resolves the YouTube ID of a video to the duration of the video
+    and to the locations (URLs or paths) of the inputs that ffmpeg reads the
+    audio and the video from.
+    """
+
+    def resolve(self, ytid, video_mode):
+        """
+        Resolve the streams of a video
+
+        Args:
+            ytid:        YouTube ID of a video
+                         (Type: str)
+
+            video_mode:  Name of the method in which video is downloaded
+                         (Type: str)
+
+        Returns:
+            streams:  Resolved streams
+                      (Type: cache.ResolvedStreams)
+        """
+        raise NotImplementedError()
+
+
+class PafySource(SourceBackend):
+    """
+    Resolves videos on YouTube with pafy
+    """
+
+    def __init__(self):
+        import pafy
+        self.pafy = pafy
+
+    def resolve(self, ytid, video_mode):
+        try:
+            return self._resolve(ytid, video_mode)
+        except Exception as e:
+            # Whether the video is gone is only told by the message
+            permanent = bool(PERMANENT_ERR_PATTERN.search(str(e)))
+            raise SourceUnavailableError(ytid, str(e), permanent=permanent) from e
+
+    def _resolve(self, ytid, video_mode):
+        video_page_url = 'https://www.youtube.com/watch?v={}'.format(ytid)
+        video = self.pafy.new(video_page_url)
+
+        if video_mode in ('bestvideo', 'bestvideowithaudio', 'novideo'):
+            best_video = video.getbestvideo()
+            # If there isn't a video only option, go with best video with audio
+            if best_video is None:
+                best_video = video.getbest()
+        else:
+            best_video = video.getbest()
+        best_audio = video.getbestaudio()
+
+        video_has_audio = best_video.mediatype == 'normal' or best_video.url == best_audio.url
+        return ResolvedStreams(ytid, video.length, best_video.url, best_audio.url,
+                               video_has_audio)
+
+
+class LocalSource(SourceBackend):
+    """
+    Serves pre-staged media files from a local directory or from an HTTP
+    server, e.g. a mirror of the source media.
+
+    The media of a video are looked up by YouTube ID:
+
+        <root>/<ytid>.json        (optional) sidecar with the keys 'duration',
+                                  'video', and optionally 'audio' and
+                                  'video_has_audio'; file names are relative
+                                  to <root>
+        <root>/<ytid>.audio.<ext> (optional) audio-only media
+        <root>/<ytid>.<ext>       video media, which may also contain audio
+
+    For an HTTP root, the sidecar is required. For a local directory, the
+    media files are found by name and probed with ffprobe if there is no
+    sidecar.
+    """
+
+    def __init__(self, root, ffprobe_path):
+        """
+        Args:
+            root:          Path to local directory or base URL of HTTP server
+                           (Type: str)
+
+            ffprobe_path:  Path to ffprobe executable
+                           (Type: str)
+        """
+        self.root = root.rstrip('/')
+        self.ffprobe_path = ffprobe_path
+        self.remote = root.startswith(('http://', 'https://'))
+
+    def _location(self, filename):
+        if self.remote:
+            return self.root + '/' + filename
+        return os.path.join(self.root, filename)
+
+    def _read_sidecar(self, ytid):
+        location = self._location(ytid + '.json')
+        try:
+            if self.remote:
+                with urllib.request.urlopen(location) as f:
+                    return json.loads(f.read().decode())
+            elif os.path.exists(location):
+                with open(location, 'r') as f:
+                    return json.load(f)
+        except urllib.error.HTTPError as e:
+            # The sidecar of a video that is not on the server is missing,
+            # while other errors may go away if tried again
+            raise SourceUnavailableError(ytid, 'could not read {}: {}'.format(location, e),
+                                         permanent=e.code in (404, 410))
+        except (urllib.error.URLError, ValueError) as e:
+            raise SourceUnavailableError(ytid, 'could not read {}: {}'.format(location, e),
+                                         permanent=False)
+
+        if self.remote:
+            raise SourceUnavailableError(ytid, 'no sidecar at {}'.format(location))
+        return None
+
+    def _probe(self, ytid):
+        media_paths = [path for path in glob.glob(self._location(glob.escape(ytid) + '.*'))
+                       if not path.endswith('.json')]
+        audio_paths = [path for path in media_paths
+                       if os.path.basename(path).startswith(ytid + '.audio.')]
+        video_paths = [path for path in media_paths if path not in audio_paths]
+        if not video_paths:
+            raise SourceUnavailableError(ytid, 'no media files in {}'.format(self.root))
+
+        video_path = video_paths[0]
+        info = ffprobe(self.ffprobe_path, video_path)
+        codec_types = {stream['codec_type'] for stream in info.get('streams', [])}
+        return {
+            'duration': float(info['format']['duration']),
+            'video': os.path.basename(video_path),
+            'audio': os.path.basename(audio_paths[0]) if audio_paths else None,
+            'video_has_audio': 'audio' in codec_types,
+        }
+
+    def resolve(self, ytid, video_mode):
+        sidecar = self._read_sidecar(ytid)
+        if sidecar is None:
+            sidecar = self._probe(ytid)
+
+        video_url = self._location(sidecar['video'])
+        audio_name = sidecar.get('audio')
+        video_has_audio = sidecar.get('video_has_audio', not audio_name)
+        audio_url = self._location(audio_name) if audio_name else video_url
+
+        return ResolvedStreams(ytid, float(sidecar['duration']), video_url, audio_url,
+                               bool(video_has_audio or audio_url == video_url))
+
+
+def get_source_backend(source, ffprobe_path):
+    """
+    Get the source backend for the given source specification
+
+    Args:
+        source:        'pafy' to resolve videos on YouTube, or a local
+                       directory or HTTP base URL with pre-staged media
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Returns:
+        backend:  Source backend
+                  (Type: sources.SourceBackend)
+    """
+    key = (source, ffprobe_path)
+    if key not in _BACKENDS:
+        if source == 'pafy':
+            _BACKENDS[key] = PafySource()
+        else:
+            _BACKENDS[key] = LocalSource(source, ffprobe_path)
+    return _BACKENDS[key]
@@ -0,0 +1,118 @@
+"""
+Fetches the streams of a video once for a span of nearby segments
+"""
+import os
+
+from transcode import ffmpeg
+
+# Number of seconds fetched past the end of a span of segments
+SPAN_END_PADDING = 1.0
+
+
+def get_segment_spans(segments, merge_gap=None):
+    """
+    Group the segments of a video into spans of time that are fetched together
+
+    Args:
+        segments:   List of (start time, end time) of segments (in seconds)
+                    (Type: list[tuple[float, float]])
+
+    Keyword Args:
+        merge_gap:  Maximum gap (in seconds) between segments of the same span.
+                    Overlapping segments have a negative gap. If None, every
+                    segment is its own span.
+                    (Type: float or None)
+
+    Returns:
+        spans:  List of (span start time, span end time, segments in span)
+                (Type: list[tuple[float, float, list[tuple[float, float]]]])
+    """
+    if merge_gap is None:
+        return [(ts_start, ts_end, [(ts_start, ts_end)]) for ts_start, ts_end in segments]
+
+    spans = []
+    for ts_start, ts_end in sorted(segments):
+        if spans and ts_start - spans[-1][1] <= merge_gap:
+            span_start, span_end, span_segments = spans[-1]
+            span_segments.append((ts_start, ts_end))
+            spans[-1] = (span_start, max(span_end, ts_end), span_segments)
+        else:
+            spans.append((ts_start, ts_end, [(ts_start, ts_end)]))
+    return spans
+
+
+def fetch_stream_span(ffmpeg_path, streams, video_mode, span_start, span_end, output_dir,
+                      num_retries=10, retry_backoff=1.0, retry_backoff_max=60.0,
+                      timings=None):
+    """
+    Fetch a span of time of the streams of a video into local files, without
+    re-encoding them, so that several segments can be cut from the span.
+
+    The packets are copied with their original timestamps, into the NUT
+    container which keeps them exact, so that segments can be cut from the
+    local files with the same start times as from the remote streams.
+
+    Args:
+        ffmpeg_path:        Path to ffmpeg executable
+                            (Type: str)
+
+        streams:            Resolved streams of the video
+                            (Type: cache.ResolvedStreams)
+
+        video_mode:         Name of the method in which video is downloaded
+                            (Type: str)
+
+        span_start:         Start time of the span (in seconds)
+                            (Type: float)
+
+        span_end:           End time of the span (in seconds)
+                            (Type: float)
+
+        output_dir:         Directory where the local files are saved
+                            (Type: str)
+
+    Keyword Args:
+        num_retries:        Number of attempts to fetch each stream
+                            (Type: int)
+
+        retry_backoff:      Maximum delay (in seconds) before retrying after
+                            the first failure, doubling after every failure
+                            (Type: float)
+
+        retry_backoff_max:  Maximum delay (in seconds) before any retry
+                            (Type: float)
+
+        timings:            If given, the time spent fetching is added to
+                            `timings['fetch_span']`
+                            (Type: dict[str, float] or None)
+
+    Returns:
+        local_streams:  Streams of the video, with the locations of the
+                        local files
+                        (Type: cache.ResolvedStreams)
+    """
+    urls = [streams.audio_url]
+    if video_mode != 'novideo':
+        urls.append(streams.video_url)
+
+    local_paths = {}
+    for url in urls:
+        if url in local_paths:
+            continue
+        local_path = os.path.join(output_dir, 'span{}.nut'.format(len(local_paths)))
+        # Packets are copied from the keyframe before the span start, and a
+        # bit past the span end so that the last audio frame is complete
+        ffmpeg(ffmpeg_path, url, local_path,
+               input_args=['-n', '-ss', str(span_start)],
+               output_args=['-to', str(span_end + SPAN_END_PADDING),
+                            '-map', '0:v?', '-map', '0:a?',
+                            '-c', 'copy', '-copyts', '-f', 'nut'],
+               num_retries=num_retries, retry_backoff=retry_backoff,
+               retry_backoff_max=retry_backoff_max, timings=timings,
+               timing_key='fetch_span')
+        if not os.path.exists(local_path):
+            raise FileNotFoundError('Could not fetch span to {}'.format(local_path))
+        local_paths[url] = local_path
+
+    return streams._replace(video_url=local_paths.get(streams.video_url, streams.video_url),
+                            audio_url=local_paths[streams.audio_url])
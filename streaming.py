@@ -0,0 +1,303 @@
+"""
+Streaming of decoded audio from ffmpeg into memory, and sinks that consume
+the audio of segments instead of files
+"""
+import io
+import logging
+import os
+import subprocess as sp
+import threading
+
+import numpy as np
+
+from errors import SubprocessError, CommandTimeoutError
+from shards import get_sample_key
+from utils import finish_command, get_command_executor, get_command_timeout, start_command
+
+LOGGER = logging.getLogger('audiosetdl')
+
+# Format of the samples written by ffmpeg to its standard output
+STREAM_DTYPE = np.dtype('<i2')
+STREAM_FORMAT = 's16le'
+
+# Number of bytes read from the pipe at a time
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+def read_stream(stream, buffer, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Read raw samples from a binary stream into a preallocated buffer, in
+    fixed-size chunks, until the end of the stream. Samples past the end of
+    the buffer are read and counted, but not kept.
+
+    Args:
+        stream:      Binary stream, e.g. the standard output of a process
+                     (Type: io.RawIOBase)
+
+        buffer:      Buffer of shape (frames, channels) to read into
+                     (Type: numpy.ndarray)
+
+    Keyword Args:
+        chunk_size:  Maximum number of bytes read at a time
+                     (Type: int)
+
+    Returns:
+        num_frames:  Number of whole frames in the stream, which may be more
+                     than fit in the buffer
+                     (Type: int)
+    """
+    view = memoryview(buffer).cast('B')
+    frame_size = buffer.itemsize * (buffer.shape[1] if buffer.ndim > 1 else 1)
+    scratch = bytearray(chunk_size)
+    num_bytes = 0
+    while True:
+        if num_bytes < len(view):
+            num_read = stream.readinto(view[num_bytes:num_bytes + chunk_size])
+        else:
+            num_read = stream.readinto(scratch)
+        if not num_read:
+            break
+        num_bytes += num_read
+    return num_bytes // frame_size
+
+
+class BufferWriter(object):
+    """
+    Writes chunks of raw samples into a preallocated buffer, as they are read
+    from the standard output of a command by an executor. Samples past the
+    end of the buffer are counted, but not kept.
+    """
+
+    def __init__(self, buffer):
+        """
+        Args:
+            buffer:  Buffer of shape (frames, channels) to write into
+                     (Type: numpy.ndarray)
+        """
+        self.view = memoryview(buffer).cast('B')
+        self.frame_size = buffer.itemsize * (buffer.shape[1] if buffer.ndim > 1 else 1)
+        self.num_bytes = 0
+
+    def __call__(self, chunk):
+        start = min(self.num_bytes, len(self.view))
+        end = min(self.num_bytes + len(chunk), len(self.view))
+        self.view[start:end] = chunk[:end - start]
+        self.num_bytes += len(chunk)
+
+    @property
+    def num_frames(self):
+        """
+        Number of whole frames written, which may be more than fit in the
+        buffer
+        """
+        return self.num_bytes // self.frame_size
+
+
+def stream_command(cmd, buffer, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Run a command that writes raw samples to its standard output, and read
+    them into a preallocated buffer without going through the filesystem.
+
+    The command is run by the executor set with `utils.configure_commands`,
+    if any, and killed if it does not complete within the timeout set with
+    it. Otherwise, the standard error is read by a separate thread, so that
+    the command never blocks on a full pipe.
+
+    Args:
+        cmd:         Command to run
+                     (Type: list[str])
+
+        buffer:      Buffer of shape (frames, channels) to read into
+                     (Type: numpy.ndarray)
+
+    Keyword Args:
+        chunk_size:  Maximum number of bytes read at a time
+                     (Type: int)
+
+    Returns:
+        num_frames:  Number of whole frames written by the command
+                     (Type: int)
+
+        stderr:      Standard error of the command
+                     (Type: bytes)
+    """
+    executor = get_command_executor()
+    timeout = get_command_timeout()
+    if executor is not None:
+        writer = BufferWriter(buffer)
+        _, stderr, _ = executor.run(cmd, timeout=timeout, on_stdout=writer)
+        return writer.num_frames, stderr
+
+    proc = start_command(cmd, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=0)
+    stderr_chunks = []
+    stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()))
+    stderr_thread.daemon = True
+    stderr_thread.start()
+    # Closing the pipes is not enough to stop a command that hangs
+    timer = None
+    timed_out = threading.Event()
+    if timeout is not None:
+        def kill():
+            timed_out.set()
+            proc.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        num_frames = read_stream(proc.stdout, buffer, chunk_size=chunk_size)
+    finally:
+        proc.stdout.close()
+        return_code = proc.wait()
+        stderr_thread.join()
+        proc.stderr.close()
+        if timer is not None:
+            timer.cancel()
+        finish_command(proc)
+
+    stderr = b''.join(stderr_chunks)
+    if timed_out.is_set():
+        raise CommandTimeoutError(cmd, timeout, '', stderr.decode())
+    if return_code != 0:
+        raise SubprocessError(cmd, return_code, '', stderr.decode())
+    return num_frames, stderr
+
+
+class SegmentSink(object):
+    """
+    Consumer of the audio of downloaded segments.
+
+    Segments are only safely stored once the sink says so, so each segment is
+    added with its result, which is handed back at that point so that it can
+    be recorded as done.
+    """
+
+    def add(self, result, metadata, samples=None):
+        """
+        Add a segment
+
+        Args:
+            result:    Download status of the segment
+                       (Type: scheduler.SegmentResult)
+
+            metadata:  Metadata of the segment, with the keys 'ytid',
+                       'ts_start', 'ts_end' and 'labels'
+                       (Type: dict)
+
+        Keyword Args:
+            samples:   Samples of the audio of the segment, of shape (frames,
+                       channels), if it was streamed instead of being written
+                       to a file
+                       (Type: numpy.ndarray or None)
+
+        Returns:
+            results:  Results of the segments that are now stored
+                      (Type: list[scheduler.SegmentResult])
+        """
+        raise NotImplementedError()
+
+    def finalize(self):
+        """
+        Store all the segments that were added
+
+        Returns:
+            results:  Results of the segments that are now stored
+                      (Type: list[scheduler.SegmentResult])
+        """
+        return []
+
+    def close(self):
+        """
+        Store all the segments that were added and release the resources of
+        the sink
+
+        Returns:
+            results:  Results of the segments that are now stored
+                      (Type: list[scheduler.SegmentResult])
+        """
+        return self.finalize()
+
+
+class ShardSink(SegmentSink):
+    """
+    Packs segments into tar shards. Streamed audio is stored as a NumPy
+    array in the <key>.npy member of the sample.
+    """
+
+    def __init__(self, shard_writer):
+        """
+        Args:
+            shard_writer:  Writer of the shards
+                           (Type: shards.ShardWriter)
+        """
+        self.shard_writer = shard_writer
+
+    def add(self, result, metadata, samples=None):
+        filepaths = {}
+        for filepath in (result.audio_filepath, result.video_filepath, result.feature_filepath):
+            if not filepath:
+                continue
+            if not os.path.exists(filepath):
+                raise FileNotFoundError('Output {} of video {} ({} - {}) is missing'.format(
+                    filepath, result.ytid, result.ts_start, result.ts_end))
+            # Files are named <segment key>.<extension>, e.g. the extension
+            # of features is <feature type>.npy
+            filepaths[os.path.basename(filepath).split('.', 1)[1]] = filepath
+        data = None
+        if samples is not None:
+            f = io.BytesIO()
+            np.save(f, samples)
+            data = {'npy': f.getvalue()}
+        return self.shard_writer.add(get_sample_key(result.ytid, result.ts_start, result.ts_end),
+                                     filepaths, metadata, payload=result, data=data)
+
+    def finalize(self):
+        return self.shard_writer.finalize()
+
+
+class PcmSink(SegmentSink):
+    """
+    Appends streamed segments to a PCM export (see `export_pcm.py`)
+    """
+
+    def __init__(self, pcm_writer):
+        """
+        Args:
+            pcm_writer:  Writer of the export
+                         (Type: export_pcm.PcmWriter)
+        """
+        self.pcm_writer = pcm_writer
+
+    def add(self, result, metadata, samples=None):
+        if samples is None:
+            raise ValueError('Only streamed audio can be exported as PCM')
+        if samples.ndim > 1 and samples.shape[1] > 1:
+            samples = np.round(samples.mean(axis=1)).astype(STREAM_DTYPE)
+        return self.pcm_writer.add(result.ytid, result.ts_start, metadata['labels'],
+                                   np.ascontiguousarray(samples), payload=result)
+
+    def finalize(self):
+        return self.pcm_writer.checkpoint()
+
+    def close(self):
+        return self.pcm_writer.close()
+
+
+class CallbackSink(SegmentSink):
+    """
+    Hands every segment to a function, e.g. a feature extractor, and considers
+    it stored as soon as the function returns
+    """
+
+    def __init__(self, func):
+        """
+        Args:
+            func:  Function called with the result, the metadata and the
+                   samples of each segment, which returns the result of the
+                   stored segment
+                   (Type: callable[[scheduler.SegmentResult, dict,
+                                    numpy.ndarray or None], scheduler.SegmentResult])
+        """
+        self.func = func
+
+    def add(self, result, metadata, samples=None):
+        return [self.func(result, metadata, samples)]
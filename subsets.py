@@ -0,0 +1,879 @@
+"""
+Downloads the segments of AudioSet subset files
+"""
+import collections
+import csv
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import random
+import sys
+import threading
+import urllib.request
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from cache import get_negative_cache
+from export_pcm import PCM_DIRNAME, PcmWriter, export_subset_pcm
+from features import extract_segment_features, get_segment_feature_extractor, \
+    read_feature_info, write_feature_info
+from scheduler import SegmentResult, imap_bounded, imap_pipelined, init_pool_worker, \
+    read_segments
+from shards import ShardWriter
+from streaming import CallbackSink, ShardSink, PcmSink
+from utils import is_url, get_filename, get_subset_name, get_media_filename, link_file, \
+    iter_bucket_dirs, get_layout, read_layout, write_layout, remove_temp_files, \
+    configure_commands, MEDIA_NAMING
+from workers import segment_mp_worker, video_resolve_worker, video_mp_worker
+
+LOGGER = logging.getLogger('audiosetdl')
+
+
+def init_subset_data_dir(dataset_dir, subset_name, num_buckets=None, bucket_levels=1):
+    """
+    Creates the data directories for the given subset
+
+    Args:
+        dataset_dir:    Path to dataset directory
+                        (Type: str)
+
+        subset_name:    Name of subset
+                        (Type: str)
+
+    Keyword Args:
+        num_buckets:    Number of buckets in each level. If None, files are
+                        not bucketed.
+                        (Type: int or None)
+
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+    Returns:
+        data_dir:  Path to subset data dir
+                   (Type: str)
+    """
+    # Derive audio and video directory names for this subset
+    data_dir = os.path.join(dataset_dir, 'data', subset_name)
+    audio_dir = os.path.join(data_dir, 'audio')
+    video_dir = os.path.join(data_dir, 'video')
+    has_files = os.path.isdir(audio_dir) and bool(os.listdir(audio_dir))
+    os.makedirs(audio_dir, exist_ok=True)
+    os.makedirs(video_dir, exist_ok=True)
+    if num_buckets:
+        for bucket_dir in iter_bucket_dirs(num_buckets, bucket_levels):
+            os.makedirs(os.path.join(audio_dir, bucket_dir), exist_ok=True)
+            os.makedirs(os.path.join(video_dir, bucket_dir), exist_ok=True)
+
+    # Files that were downloaded with another layout would not be found, and
+    # would be downloaded again
+    layout = read_layout(data_dir)
+    if layout is None and has_files:
+        warn_msg = 'The bucket layout of the files of subset "{}" is unknown. Files that ' \
+                   'are not found under the current layout are downloaded again, also ' \
+                   'with --no-manifest. Run migrate_buckets.py to move them to the ' \
+                   'current layout.'
+        LOGGER.warning(warn_msg.format(subset_name))
+    elif layout is not None and layout.get('naming') != MEDIA_NAMING:
+        warn_msg = 'Files of subset "{}" are named by YouTube ID only, so segments of ' \
+                   'the same video shared them. They are not found under the current ' \
+                   'names, and their segments are downloaded again, also with ' \
+                   '--no-manifest. Run migrate_buckets.py to rename them per segment.'
+        LOGGER.warning(warn_msg.format(subset_name))
+    elif layout is not None and layout != get_layout(num_buckets, bucket_levels):
+        warn_msg = 'Files of subset "{}" are stored with {} bucket(s) in {} level(s). ' \
+                   'Run migrate_buckets.py to move them to the current layout.'
+        LOGGER.warning(warn_msg.format(subset_name, layout['num_buckets'] or 0,
+                                       layout['bucket_levels'] or 0))
+    if layout is None and not has_files:
+        write_layout(data_dir, num_buckets, bucket_levels)
+
+    return data_dir
+
+
+def download_subset_file(subset_url, dataset_dir):
+    """
+    Download a subset segments file from the given url to the given directory.
+
+    Args:
+        subset_url:   URL to subset segments file
+                      (Type: str)
+
+        dataset_dir:  Dataset directory where subset segment file will be stored
+                      (Type: str)
+
+    Returns:
+        subset_path:  Path to subset segments file
+                      (Type: str)
+
+    """
+    # Get filename of the subset file
+    subset_filename = get_filename(subset_url)
+    subset_name = get_subset_name(subset_url)
+    subset_path = os.path.join(dataset_dir, subset_filename)
+
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    # Open subset file as a CSV
+    if not os.path.exists(subset_path):
+        LOGGER.info('Downloading subset file for "{}"'.format(subset_name))
+        with open(subset_path, 'w') as f:
+            subset_data = urllib.request.urlopen(subset_url).read().decode()
+            f.write(subset_data)
+
+    return subset_path
+
+
+def download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
+                           num_workers, num_buckets, max_in_flight=None,
+                           result_callback=None, manifest=None, max_attempts=None,
+                           num_resolvers=0, resolve_queue_size=None, metrics=None,
+                           concurrency=None, negative_cache_path=None,
+                           negative_cache_ttl=None, lease_owner=None, lease_batch_size=16,
+                           lease_timeout=300.0, sink=None, command_executor=None,
+                           command_timeout=None, stop_event=None, stop_timeout=5.0,
+                           **ffmpeg_cfg):
+    """
+    Download subset segment file and videos
+
+    The segments file is read as a stream and at most `max_in_flight` jobs are
+    submitted to the worker pool at any given time, so memory usage of the
+    parent process does not depend on the number of segments in the subset.
+
+    If `num_resolvers` is positive, the streams of each segment are resolved
+    by a separate pool of `num_resolvers` threads, so that the worker
+    processes only run ffmpeg and can be sized for the number of cores.
+
+    Segments of the same video are downloaded by a single job that resolves
+    the streams of the video once. Duplicate segments are only downloaded
+    once.
+
+    If a manifest is given, the segments are imported into it and only the
+    segments that are pending or can be retried are dispatched, without
+    checking the filesystem for existing outputs. Segments that were already
+    downloaded for another subset are linked instead of downloaded again.
+
+    If a concurrency controller is given, the pool has `concurrency.max_limit`
+    workers, and the number of jobs in flight follows the limit set by the
+    controller from the results of completed jobs, instead of `num_workers`
+    and `max_in_flight`.
+
+    If a negative cache is given, segments of videos that are known to be
+    unavailable are skipped, and videos that fail with a permanent error are
+    added to it.
+
+    If a lease owner is given, the videos are claimed in batches from the
+    manifest, which is shared with other processes, and the lease on each
+    video is released once the results of its segments are recorded.
+
+    If a sink is given, the segments that succeeded are handed to it, and are
+    only recorded as done once the sink stored them. Their files are then
+    removed. The sink is closed once the subset is downloaded.
+
+    If a command executor is given, the jobs run in a pool of `num_workers`
+    threads of this process instead of worker processes, and the ffmpeg and
+    ffprobe commands of all the jobs are run by the event loop of the
+    executor.
+
+    Once the stop event is set, e.g. by a `scheduler.ShutdownHandler` when
+    the process receives SIGTERM, no new jobs are dispatched, and the jobs
+    that do not complete within `stop_timeout` seconds are killed along with
+    the commands they run. Their segments, and those that failed in the
+    meantime, are recorded as pending in the manifest, without counting as
+    an attempt, so that the next run starts from where this one stopped.
+
+    Args:
+        subset_path:         Path to subset segments file
+                             (Type: str)
+
+        data_dir:            Directory where dataset files will be saved
+                             (Type: str)
+
+        ffmpeg_path:         Path to ffmpeg executable
+                             (Type: str)
+
+        ffprobe_path:        Path to ffprobe executable
+                             (Type: str)
+
+        num_workers:         Number of multiprocessing workers used to download videos
+                             (Type: int)
+
+    Keyword Args:
+        max_in_flight:       Maximum number of jobs submitted to the pool that
+                             have not completed yet. If None, twice the number
+                             of workers.
+                             (Type: int or None)
+
+        result_callback:     Function called with the status of each segment
+                             as its job completes
+                             (Type: callable[[scheduler.SegmentResult], None] or None)
+
+        manifest:            Manifest used to track the state of segments
+                             (Type: manifest.Manifest or None)
+
+        max_attempts:        Maximum number of attempts for a segment tracked
+                             in the manifest. If None, no maximum.
+                             (Type: int or None)
+
+        num_resolvers:       Number of threads resolving streams. If 0, streams
+                             are resolved by the worker processes.
+                             (Type: int)
+
+        resolve_queue_size:  Maximum number of resolved segments waiting for
+                             a worker process. If None, twice `max_in_flight`.
+                             (Type: int or None)
+
+        metrics:             Metrics updated as jobs are dispatched and complete
+                             (Type: metrics.Metrics or None)
+
+        concurrency:         Controller of the number of concurrent jobs
+                             (Type: concurrency.AdaptiveConcurrency or None)
+
+        negative_cache_path: Path to the negative cache database. If None,
+                             videos that failed permanently are tried again.
+                             (Type: str or None)
+
+        negative_cache_ttl:  Number of seconds after which a video that
+                             failed permanently is tried again. If None,
+                             never.
+                             (Type: float or None)
+
+        lease_owner:         Name under which this process claims videos from
+                             the manifest. If None, all the segments of the
+                             subset are downloaded by this process.
+                             (Type: str or None)
+
+        lease_batch_size:    Number of videos claimed at a time
+                             (Type: int)
+
+        lease_timeout:       Number of seconds after which a lease that was
+                             not renewed expires, and after which temporary
+                             files of processes of other hosts are removed
+                             (Type: float)
+
+        sink:                Consumer of the outputs of the segments, e.g.
+                             to pack them into shards, instead of keeping
+                             them as separate files. Requires the manifest.
+                             (Type: streaming.SegmentSink or None)
+
+        command_executor:    Executor that runs the commands of the jobs
+                             (Type: executor.CommandExecutor or None)
+
+        command_timeout:     Number of seconds after which a command is
+                             killed. If None, no timeout.
+                             (Type: float or None)
+
+        stop_event:          Event that stops the download when set
+                             (Type: threading.Event or None)
+
+        stop_timeout:        Number of seconds that running jobs are given to
+                             complete once `stop_event` is set
+                             (Type: float)
+
+        **ffmpeg_cfg:        Configuration for audio and video
+                             downloading and decoding done by ffmpeg
+                             (Type: dict[str, *])
+
+    Returns:
+        status_counts:  Number of segments that succeeded, failed, and
+                        were skipped
+                        (Type: collections.Counter)
+    """
+    subset_name = get_subset_name(subset_path)
+    status_counts = collections.Counter()
+    # Number of segments of each leased video that are still in flight
+    leased_segments = collections.Counter()
+    # Segments that were dispatched and whose result was not handled yet.
+    # Jobs are dispatched by the resolver thread when the pipeline is used.
+    in_flight = collections.Counter()
+    in_flight_lock = threading.Lock()
+    if concurrency is not None:
+        num_workers = concurrency.max_limit
+        max_in_flight = concurrency.current_limit
+    elif not max_in_flight:
+        max_in_flight = 2 * num_workers
+
+    def get_output_filepaths(ytid, ts_start, ts_end):
+        media_filename = get_media_filename(ytid, ts_start, ts_end, num_buckets,
+                                            ffmpeg_cfg.get('bucket_levels', 1))
+        audio_filepath = os.path.join(data_dir, 'audio', '{}.{}'.format(
+            media_filename, ffmpeg_cfg.get('audio_format', 'flac')))
+        video_filepath = os.path.join(data_dir, 'video', '{}.{}'.format(
+            media_filename, ffmpeg_cfg.get('video_format', 'mp4')))
+        return audio_filepath, video_filepath
+
+    def audio_exists(ytid, ts_start, ts_end):
+        return os.path.exists(get_output_filepaths(ytid, ts_start, ts_end)[0])
+
+    def is_dead(ytid):
+        # This runs in the resolver thread when the pipeline is used, so the
+        # cache is looked up for the current thread
+        if negative_cache_path is None:
+            return False
+        return get_negative_cache(negative_cache_path, ttl=negative_cache_ttl).is_dead(ytid)
+
+    def skip(ytid, ts_start, ts_end, reason):
+        LOGGER.info('{} {} ({} - {}). Skipping.'.format(reason, ytid, ts_start, ts_end))
+        status_counts['skipped'] += 1
+        if metrics is not None:
+            metrics.skipped(subset_name)
+
+    def iter_pending_segments():
+        if manifest is not None:
+            # Dead segments are left out while the negative cache remembers
+            # them, i.e. forever if it does not expire its entries. Without a
+            # negative cache, they are retried like failed segments.
+            retry_dead = negative_cache_path is None or bool(negative_cache_ttl)
+            if lease_owner is not None:
+                yield from manifest.iter_leased(subset_name, lease_owner,
+                                                batch_size=lease_batch_size,
+                                                lease_timeout=lease_timeout,
+                                                max_attempts=max_attempts,
+                                                retry_dead=retry_dead)
+            else:
+                yield from manifest.iter_pending(subset_name, max_attempts,
+                                                 retry_dead=retry_dead)
+            return
+
+        for ytid, ts_start, ts_end, _ in read_segments(subset_path):
+            # Skip files that already have been downloaded
+            if audio_exists(ytid, ts_start, ts_end):
+                skip(ytid, ts_start, ts_end, 'Already downloaded audio')
+                continue
+            yield ytid, ts_start, ts_end
+
+    def iter_worker_args():
+        # Segments of the same video are downloaded by a single job, so that
+        # the video is only resolved once. The manifest yields the segments
+        # of a video together; segments files are only grouped where rows of
+        # the same video are adjacent.
+        for ytid, group in itertools.groupby(iter_pending_segments(), key=lambda seg: seg[0]):
+            segments = []
+            for _, ts_start, ts_end in group:
+                if (ts_start, ts_end) in segments:
+                    skip(ytid, ts_start, ts_end, 'Duplicate segment')
+                    continue
+                segments.append((ts_start, ts_end))
+
+            # Skip videos that are known to be unavailable
+            if is_dead(ytid):
+                for ts_start, ts_end in segments:
+                    skip(ytid, ts_start, ts_end, 'Video is unavailable:')
+                if lease_owner is not None:
+                    manifest.release(subset_name, ytid, lease_owner)
+                continue
+
+            if metrics is not None:
+                for _ in segments:
+                    metrics.dispatched()
+            if lease_owner is not None:
+                leased_segments[ytid] += len(segments)
+            with in_flight_lock:
+                for ts_start, ts_end in segments:
+                    in_flight[(ytid, ts_start, ts_end)] += 1
+            yield [ytid, segments, data_dir, ffmpeg_path, ffprobe_path, num_buckets]
+
+    def record_result(result):
+        if manifest is not None:
+            manifest.record(subset_name, result)
+            if lease_owner is not None:
+                leased_segments[result.ytid] -= 1
+                if leased_segments[result.ytid] <= 0:
+                    del leased_segments[result.ytid]
+                    manifest.release(subset_name, result.ytid, lease_owner)
+
+    def add_to_sink(result):
+        metadata = {'ytid': result.ytid, 'ts_start': result.ts_start, 'ts_end': result.ts_end,
+                    'labels': manifest.get_labels(subset_name, result.ytid, result.ts_start,
+                                                  result.ts_end)}
+        if result.samples is not None:
+            metadata['sample_rate'] = ffmpeg_cfg.get('audio_sample_rate', 48000)
+        # The sink holds on to the result until the segment is stored, but
+        # not to its samples
+        return sink.add(result._replace(samples=None), metadata, samples=result.samples)
+
+    def record_published(results):
+        # Segments are only recorded as done, and their files removed, once
+        # the sink stored them, e.g. once their shard is published, so that
+        # they are handled again if the process stops before
+        for result in results:
+            if not isinstance(sink, ShardSink):
+                # Only shards hold the files of segments, e.g. the features
+                # are kept next to the PCM export
+                record_result(result)
+                continue
+            for filepath in (result.audio_filepath, result.video_filepath,
+                             result.feature_filepath):
+                if filepath and os.path.exists(filepath):
+                    os.remove(filepath)
+            record_result(result._replace(audio_filepath=None, video_filepath=None))
+
+    def is_stopped():
+        return stop_event is not None and stop_event.is_set()
+
+    def handle_result(result):
+        if is_stopped() and not result.succeeded and not result.permanent:
+            # The job was most likely killed by the stop, so the segment is
+            # left pending instead of counting as a failed attempt
+            return
+        with in_flight_lock:
+            in_flight[(result.ytid, result.ts_start, result.ts_end)] -= 1
+        if sink is not None and result.succeeded:
+            try:
+                published = add_to_sink(result)
+            except FileNotFoundError as e:
+                LOGGER.error('Could not store video {} ({} - {}): {}'.format(
+                    result.ytid, result.ts_start, result.ts_end, e))
+                result = result._replace(succeeded=False, error_class=type(e).__name__,
+                                         error_msg=str(e), permanent=False, samples=None)
+        status_counts['succeeded' if result.succeeded else 'failed'] += 1
+        if sink is not None and result.succeeded:
+            record_published(published)
+        else:
+            record_result(result._replace(samples=None))
+        if metrics is not None:
+            metrics.observe(subset_name, result)
+        if concurrency is not None:
+            concurrency.observe(result)
+        if negative_cache_path is not None:
+            negative_cache = get_negative_cache(negative_cache_path, ttl=negative_cache_ttl)
+            if result.permanent:
+                negative_cache.add(result.ytid, result.error_class, result.error_msg)
+            elif result.succeeded and negative_cache_ttl:
+                # The video may have been re-checked after it was dead
+                negative_cache.remove(result.ytid)
+        if result_callback is not None:
+            result_callback(result)
+
+    def link_duplicates():
+        # Segments that were already downloaded for another subset are
+        # linked instead of being downloaded again
+        num_linked = 0
+        for ytid, ts_start, ts_end, src_audio_path, src_video_path in \
+                manifest.find_duplicates(subset_name):
+            audio_filepath, video_filepath = get_output_filepaths(ytid, ts_start, ts_end)
+            if not src_video_path:
+                video_filepath = None
+            src_paths = [path for path in (src_audio_path, src_video_path) if path]
+            if not src_paths or not all(os.path.exists(path) for path in src_paths):
+                continue
+            for src_path, dst_path in ((src_audio_path, audio_filepath),
+                                       (src_video_path, video_filepath)):
+                if src_path and not os.path.exists(dst_path):
+                    link_file(src_path, dst_path)
+
+            manifest.record(subset_name, SegmentResult(ytid, ts_start, ts_end, True,
+                                                       audio_filepath=audio_filepath,
+                                                       video_filepath=video_filepath,
+                                                       num_bytes=0, elapsed=0.0))
+            status_counts['skipped'] += 1
+            if metrics is not None:
+                metrics.skipped(subset_name)
+            num_linked += 1
+        manifest.flush()
+        if num_linked:
+            LOGGER.info('Linked {} segments of subset "{}" that were downloaded for '
+                        'other subsets'.format(num_linked, subset_name))
+
+    if manifest is not None:
+        try:
+            num_imported = manifest.import_segments(subset_name, subset_path,
+                                                    read_segments(subset_path),
+                                                    is_done=audio_exists)
+        except csv.Error as e:
+            err_msg = 'Encountered error in {} at {}'.format(subset_path, e)
+            LOGGER.error(err_msg)
+            sys.exit(err_msg)
+        LOGGER.info('Imported {} new segments of subset "{}" into manifest'.format(
+            num_imported, subset_name))
+        link_duplicates()
+
+    # Temporary files of processes that were killed are removed. Other
+    # processes, e.g. of a coordinated run or of the tasks of a job array
+    # that share the subset directory, may still be writing theirs, so those
+    # of other hosts are only removed once they were not modified for a lease
+    # timeout.
+    num_removed = remove_temp_files(data_dir, min_age=lease_timeout)
+    if num_removed:
+        LOGGER.info('Removed {} temporary files of subset "{}" left by previous runs'.format(
+            num_removed, subset_name))
+
+    LOGGER.info('Starting download jobs for subset "{}"'.format(subset_name))
+
+    # Set up the pool. Jobs that only wait for the commands run by an
+    # executor do not need a process each.
+    if command_executor is not None:
+        configure_commands(executor=command_executor, timeout=command_timeout)
+        pool = ThreadPool(num_workers)
+    else:
+        pool = mp.Pool(num_workers, initializer=init_pool_worker,
+                       initargs=(command_timeout,))
+
+    def stop_pool():
+        # Running jobs are killed along with their commands
+        if command_executor is not None:
+            # Threads cannot be killed, but their jobs fail as soon as their
+            # commands are killed
+            command_executor.close()
+            pool.terminate()
+        else:
+            pool.terminate()
+            pool.join()
+
+    def requeue_interrupted():
+        with in_flight_lock:
+            segments = [segment for segment, count in in_flight.items() if count > 0]
+        if manifest is not None:
+            manifest.requeue(subset_name, segments, owner=lease_owner)
+        # The workers exited, but other processes may still be writing theirs
+        remove_temp_files(data_dir, min_age=lease_timeout, include_own=True)
+        LOGGER.warning('Stopped download jobs for subset "{}": {} interrupted segments are '
+                       'left pending for the next run'.format(subset_name, len(segments)))
+
+    try:
+        worker_func = partial(video_mp_worker, **ffmpeg_cfg)
+        if num_resolvers > 0:
+            if not resolve_queue_size:
+                resolve_queue_size = 2 * (num_workers if concurrency is not None
+                                          else max_in_flight)
+            resolve_func = partial(video_resolve_worker, **ffmpeg_cfg)
+
+        while True:
+            if num_resolvers > 0:
+                job_results = imap_pipelined(pool, resolve_func, worker_func, iter_worker_args(),
+                                             num_resolvers, max_in_flight, resolve_queue_size,
+                                             stop_event=stop_event, stop_timeout=stop_timeout)
+            else:
+                job_results = imap_bounded(pool, worker_func, iter_worker_args(), max_in_flight,
+                                           stop_event=stop_event, stop_timeout=stop_timeout)
+
+            for result in itertools.chain.from_iterable(job_results):
+                handle_result(result)
+            if sink is not None:
+                record_published(sink.finalize())
+
+            # Once its own leases are released, a coordinated process waits
+            # for the videos leased by other processes, and claims those whose
+            # leases expire
+            if is_stopped() or lease_owner is None \
+                    or not manifest.wait_for_leases(subset_name, lease_owner,
+                                                    stop_event=stop_event):
+                break
+        if is_stopped():
+            stop_pool()
+        if sink is not None:
+            record_published(sink.close())
+        if is_stopped():
+            requeue_interrupted()
+        else:
+            pool.close()
+            pool.join()
+    except csv.Error as e:
+        pool.terminate()
+        pool.join()
+        err_msg = 'Encountered error in {} at {}'.format(subset_path, e)
+        LOGGER.error(err_msg)
+        sys.exit(err_msg)
+    except KeyboardInterrupt:
+        stop_pool()
+        LOGGER.info("Forcing exit.")
+        exit()
+    finally:
+        # Jobs that are still running in threads once the pool is stopped
+        # fail on the closed executor, instead of running commands themselves
+        if command_executor is not None and not is_stopped():
+            configure_commands()
+        if manifest is not None:
+            manifest.flush()
+
+    info_msg = 'Finished download jobs for subset "{}": {} succeeded, {} failed, {} skipped'
+    LOGGER.info(info_msg.format(subset_name, status_counts['succeeded'],
+                                status_counts['failed'], status_counts['skipped']))
+    return status_counts
+
+
+def download_random_subset_files(subset_url, dataset_dir, ffmpeg_path, ffprobe_path,
+                                 num_workers, num_buckets, max_videos=None,  **ffmpeg_cfg):
+    """
+    Download a a random subset (of size `max_videos`) of subset segment file and videos
+
+    Args:
+        subset_path:   Path to subset segments file
+                       (Type: str)
+
+        dataset_dir:   Directory where dataset files will be saved
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+        num_workers:   Number of multiprocessing workers used to download videos
+                       (Type: int)
+
+    Keyword Args:
+        max_videos:    Maximum number of videos to download in this subset. If
+                       None, download all files in this subset.
+                       (Type int or None)
+
+        **ffmpeg_cfg:  Configuration for audio and video
+                       downloading and decoding done by ffmpeg
+                       (Type: dict[str, *])
+    """
+    # FIXME: This code is outdated and shouldn't be used
+    # Validate max_videos
+    if max_videos is not None and (max_videos < 1 or type(max_videos) != int):
+        err_msg = 'max_videos must be a positive integer, or None'
+        LOGGER.error(err_msg)
+        raise ValueError(err_msg)
+
+    # Get filename of the subset file
+    subset_filename = get_filename(subset_url)
+    subset_name = get_subset_name(subset_url)
+    subset_path = os.path.join(dataset_dir, subset_filename)
+    data_dir = init_subset_data_dir(dataset_dir, subset_name, num_buckets,
+                                    ffmpeg_cfg.get('bucket_levels', 1))
+
+    # Open subset file as a CSV
+    if not os.path.exists(subset_path):
+        LOGGER.info('Downloading subset file for "{}"'.format(subset_name))
+        with open(subset_path, 'w') as f:
+            subset_data = urllib.request.urlopen(subset_url).read().decode()
+            f.write(subset_data)
+
+    subset_data = []
+    LOGGER.info('Starting download jobs for random subset (of size {}) of subset "{}"'.format(max_videos, subset_name))
+    with open(subset_path, 'r') as f:
+        subset_data_reader = csv.reader(f)
+        try:
+            for row_idx, row in enumerate(subset_data_reader):
+                # Skip commented lines
+                if row[0][0] == '#':
+                    continue
+
+                subset_data.append(row[:3])
+        except csv.Error as e:
+            err_msg = 'Encountered error in {} at line {}: {}'
+            LOGGER.error(err_msg)
+            sys.exit(err_msg.format(subset_filename, row_idx+1, e))
+
+    # Shuffle data
+    random.shuffle(subset_data)
+
+    # Set up multiprocessing pool
+    pool = mp.Pool(num_workers)
+    try:
+        for idx, row in enumerate(subset_data):
+            worker_args = [row[0], float(row[1]), float(row[2]), data_dir, ffmpeg_path, ffprobe_path, num_buckets]
+            pool.apply_async(partial(segment_mp_worker, **ffmpeg_cfg), worker_args)
+            # Run serially
+            #segment_mp_worker(*worker_args, **ffmpeg_cfg)
+
+            if max_videos is not None:
+                if idx + 1 >= max_videos:
+                    info_msg = 'Reached maximum ({}) for subset {}'
+                    LOGGER.info(info_msg.format(max_videos, subset_name))
+                    break
+    except KeyboardInterrupt:
+        LOGGER.info("Forcing exit.")
+        exit()
+    finally:
+        try:
+            pool.close()
+            pool.join()
+        except KeyboardInterrupt:
+            LOGGER.info("Forcing exit.")
+            exit()
+
+    LOGGER.info('Finished download jobs for subset "{}"'.format(subset_name))
+
+
+def download_subset(subset_path, dataset_dir, ffmpeg_path, ffprobe_path,
+                    num_workers, num_buckets, max_in_flight=None, manifest=None,
+                    max_attempts=None, num_resolvers=0, resolve_queue_size=None,
+                    metrics=None, concurrency=None, negative_cache_path=None,
+                    negative_cache_ttl=None, lease_owner=None, lease_batch_size=16,
+                    lease_timeout=300.0, shard_size=None, export_pcm_rate=None,
+                    stream_sink='pcm', command_executor=None, command_timeout=None,
+                    stop_event=None, stop_timeout=5.0, **ffmpeg_cfg):
+    """
+    Download all files for a subset, including the segment file, and the audio and video files.
+
+    Args:
+        subset_path:    Path to subset segments file
+                        (Type: str)
+
+        dataset_dir:    Path to dataset directory where files are saved
+                        (Type: str)
+
+        ffmpeg_path:    Path to ffmpeg executable
+                        (Type: str)
+
+        ffprobe_path:   Path to ffprobe executable
+                        (Type: str)
+
+        num_workers:    Number of workers to download and process videos
+                        (Type: int)
+
+    Keyword Args:
+        max_in_flight:                  Maximum number of jobs submitted to
+                                        the worker pool at any time
+                                        (Type: int or None)
+
+        manifest:                       Manifest used to track the state of
+                                        segments
+                                        (Type: manifest.Manifest or None)
+
+        max_attempts:                   Maximum number of attempts for a
+                                        segment tracked in the manifest
+                                        (Type: int or None)
+
+        num_resolvers:                  Number of threads resolving streams.
+                                        If 0, streams are resolved by the
+                                        worker processes.
+                                        (Type: int)
+
+        resolve_queue_size:             Maximum number of resolved segments
+                                        waiting for a worker process
+                                        (Type: int or None)
+
+        metrics:                        Metrics updated as jobs are dispatched
+                                        and complete
+                                        (Type: metrics.Metrics or None)
+
+        concurrency:                    Controller of the number of concurrent
+                                        jobs
+                                        (Type: concurrency.AdaptiveConcurrency or None)
+
+        negative_cache_path:            Path to the negative cache database
+                                        (Type: str or None)
+
+        negative_cache_ttl:             Number of seconds after which a video
+                                        that failed permanently is tried again
+                                        (Type: float or None)
+
+        lease_owner:                    Name under which this process claims
+                                        videos from the manifest
+                                        (Type: str or None)
+
+        lease_batch_size:               Number of videos claimed at a time
+                                        (Type: int)
+
+        lease_timeout:                  Number of seconds after which a lease
+                                        that was not renewed expires, and
+                                        after which temporary files of
+                                        processes of other hosts are removed
+                                        (Type: float)
+
+        shard_size:                     If given, the outputs are packed into
+                                        tar shards of about this many bytes
+                                        (Type: int or None)
+
+        export_pcm_rate:                If given, the downloaded audio is
+                                        exported as PCM at this sample rate
+                                        once the subset is downloaded
+                                        (Type: int or None)
+
+        stream_sink:                    Where the audio is stored if it is
+                                        streamed: 'pcm' for the PCM export of
+                                        the subset, 'shards' for tar shards
+                                        of `shard_size` bytes, or 'features'
+                                        to only keep the features of the
+                                        segments
+                                        (Type: str)
+
+        command_executor:               Executor that runs the commands of
+                                        the download jobs, which then run in
+                                        threads instead of worker processes
+                                        (Type: executor.CommandExecutor or None)
+
+        command_timeout:                Number of seconds after which a
+                                        command is killed. If None, no
+                                        timeout.
+                                        (Type: float or None)
+
+        stop_event:                     Event that stops the download when
+                                        set, e.g. by a signal
+                                        (Type: threading.Event or None)
+
+        stop_timeout:                   Number of seconds that running jobs
+                                        are given to complete once
+                                        `stop_event` is set
+                                        (Type: float)
+
+        **ffmpeg_cfg:                   Configuration for audio and video
+                                        downloading and decoding done by ffmpeg
+                                        (Type: dict[str, *])
+
+    Returns:
+        status_counts:  Number of segments that succeeded, failed, and
+                        were skipped
+                        (Type: collections.Counter)
+    """
+    if is_url(subset_path):
+        subset_path = download_subset_file(subset_path, dataset_dir)
+
+    subset_name = get_subset_name(subset_path)
+    data_dir = init_subset_data_dir(dataset_dir, subset_name, num_buckets,
+                                    ffmpeg_cfg.get('bucket_levels', 1))
+
+    if ffmpeg_cfg.get('features'):
+        # Features computed with other parameters must not be mixed
+        params = get_segment_feature_extractor(**ffmpeg_cfg).params
+        feature_info = read_feature_info(data_dir)
+        if feature_info is not None and feature_info != params:
+            err_msg = 'Features in {} were computed with other parameters: {}'.format(
+                data_dir, feature_info)
+            LOGGER.error(err_msg)
+            sys.exit(err_msg)
+        write_feature_info(data_dir, params)
+
+    sink = None
+    if ffmpeg_cfg.get('stream_audio') and stream_sink == 'pcm':
+        try:
+            sink = PcmSink(PcmWriter(os.path.join(data_dir, PCM_DIRNAME),
+                                     ffmpeg_cfg.get('audio_sample_rate', 48000)))
+        except ValueError as e:
+            LOGGER.error(str(e))
+            sys.exit(str(e))
+    elif ffmpeg_cfg.get('stream_audio') and stream_sink == 'features':
+        # The workers compute the features of every video in a batch, and
+        # the sink computes those that are missing
+        extractor = get_segment_feature_extractor(**ffmpeg_cfg)
+        bucket_levels = ffmpeg_cfg.get('bucket_levels', 1)
+
+        def store_features(result, metadata, samples):
+            result = extract_segment_features([result._replace(samples=samples)], data_dir,
+                                              num_buckets, extractor,
+                                              bucket_levels=bucket_levels)[0]
+            return result._replace(samples=None)
+
+        sink = CallbackSink(store_features)
+    elif shard_size:
+        sink = ShardSink(ShardWriter(os.path.join(data_dir, 'shards'), subset_name,
+                                     max_size=shard_size))
+
+    status_counts = download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
+                                           num_workers, num_buckets,
+                                           max_in_flight=max_in_flight, manifest=manifest,
+                                           max_attempts=max_attempts, num_resolvers=num_resolvers,
+                                           resolve_queue_size=resolve_queue_size, metrics=metrics,
+                                           concurrency=concurrency,
+                                           negative_cache_path=negative_cache_path,
+                                           negative_cache_ttl=negative_cache_ttl,
+                                           lease_owner=lease_owner,
+                                           lease_batch_size=lease_batch_size,
+                                           lease_timeout=lease_timeout, sink=sink,
+                                           command_executor=command_executor,
+                                           command_timeout=command_timeout,
+                                           stop_event=stop_event, stop_timeout=stop_timeout,
+                                           **ffmpeg_cfg)
+
+    if export_pcm_rate and not (stop_event is not None and stop_event.is_set()):
+        export_subset_pcm(subset_path, data_dir, ffmpeg_path, sample_rate=export_pcm_rate,
+                          num_workers=num_workers,
+                          audio_format=ffmpeg_cfg.get('audio_format', 'flac'))
+
+    return status_counts
@@ -0,0 +1,36 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# The modules of the repository are not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FFMPEG_PATH = shutil.which('ffmpeg')
+FFPROBE_PATH = shutil.which('ffprobe')
+
+requires_ffmpeg = pytest.mark.skipif(FFMPEG_PATH is None or FFPROBE_PATH is None,
+                                     reason='ffmpeg and ffprobe are not installed')
+
+
+@pytest.fixture(scope='session')
+def media_dir(tmp_path_factory):
+    """
+    Directory of a local source (see `sources.LocalSource`) with a 10 second
+    video of YouTube ID 'video000001', whose audio is a chirp so that
+    segments cut at different times differ
+    """
+    if FFMPEG_PATH is None:
+        pytest.skip('ffmpeg is not installed')
+    from utils import run_command
+    media_dir = tmp_path_factory.mktemp('media')
+    run_command([FFMPEG_PATH, '-y',
+                 '-f', 'lavfi', '-i', 'testsrc=size=160x120:rate=30',
+                 '-f', 'lavfi', '-i', 'aevalsrc=sin(2*PI*(200+50*t)*t):sample_rate=44100',
+                 '-t', '10',
+                 '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                 '-c:a', 'aac', '-movflags', '+faststart',
+                 str(media_dir / 'video000001.mp4'),
+                 '-loglevel', 'error'])
+    return str(media_dir)
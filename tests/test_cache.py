@@ -0,0 +1,24 @@
+import sqlite3
+
+from cache import ResolvedStreams, StreamCache
+
+STREAMS = ResolvedStreams('abc', 10.0, 'http://host/video', 'http://host/audio', True)
+
+
+def get_last_used(cache):
+    conn = sqlite3.connect(cache.path)
+    last_used = conn.execute('SELECT last_used FROM streams').fetchone()[0]
+    conn.close()
+    return last_used
+
+
+def test_last_use_is_only_updated_past_the_touch_interval(tmp_path):
+    cache = StreamCache(str(tmp_path / 'streams.db'), touch_interval=60.0)
+    cache.put('bestvideoaudio', STREAMS)
+    last_used = get_last_used(cache)
+    assert cache.get('abc', 'bestvideoaudio') == STREAMS
+    assert get_last_used(cache) == last_used
+
+    cache.touch_interval = 0.0
+    assert cache.get('abc', 'bestvideoaudio') == STREAMS
+    assert get_last_used(cache) > last_used
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from errors import CommandTimeoutError, SubprocessError
+from executor import CommandExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = CommandExecutor(2)
+    yield executor
+    executor.close()
+
+
+def test_commands_return_their_output(executor):
+    stdout, stderr, return_code = executor.run(['sh', '-c', 'echo out; echo err >&2'])
+    assert (stdout, stderr, return_code) == (b'out\n', b'err\n', 0)
+    with pytest.raises(SubprocessError) as excinfo:
+        executor.run(['sh', '-c', 'echo failed >&2; exit 3'])
+    assert excinfo.value.cmd_return_code == 3
+    assert excinfo.value.cmd_stderr == 'failed\n'
+
+
+def test_commands_are_killed_after_their_timeout(executor):
+    start_time = time.time()
+    with pytest.raises(CommandTimeoutError) as excinfo:
+        executor.run(['sh', '-c', 'echo partial; sleep 10'], timeout=0.2)
+    assert time.time() - start_time < 5
+    assert excinfo.value.timeout == 0.2
+    assert excinfo.value.cmd_stdout == 'partial\n'
+    # The executor runs commands after a timeout
+    assert executor.run(['true'])[2] == 0
+
+
+def test_concurrent_commands_are_bounded(executor):
+    durations = []
+
+    def run():
+        start_time = time.time()
+        executor.run(['sleep', '0.3'])
+        durations.append(time.time() - start_time)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Two commands wait for the first two to complete
+    assert time.time() - start_time >= 0.6
+    assert len(durations) == 4
+
+
+def test_closed_executor_refuses_commands():
+    executor = CommandExecutor(1)
+    executor.close()
+    with pytest.raises(RuntimeError):
+        executor.run(['true'])
@@ -0,0 +1,64 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from export_pcm import JOURNAL_FILENAME, PCM_FILENAME, PcmDataset, PcmWriter
+
+
+def make_samples(num_samples, value):
+    return np.full(num_samples, value, dtype='<i2')
+
+
+def test_export_is_used_by_one_writer_at_a_time(tmp_path):
+    export_dir = str(tmp_path / 'pcm')
+    writer = PcmWriter(export_dir, 16000)
+    writer.add('abc', 0.0, [], make_samples(10, 1))
+    with pytest.raises(ValueError):
+        PcmWriter(export_dir, 16000)
+
+    # A waiting writer only loads the export once the first one is closed
+    opened = []
+    thread = threading.Thread(
+        target=lambda: opened.append(PcmWriter(export_dir, 16000, wait=True)))
+    thread.start()
+    thread.join(0.5)
+    assert not opened
+    writer.close()
+    thread.join()
+
+    waiting_writer = opened[0]
+    assert ('abc', 0.0) in waiting_writer
+    waiting_writer.add('def', 0.0, [], make_samples(20, 2))
+    waiting_writer.close()
+    writer = PcmWriter(export_dir, 16000)
+    assert writer.num_segments == 2
+    writer.close()
+
+
+def test_interrupted_export_is_resumed_from_its_last_checkpoint(tmp_path):
+    export_dir = str(tmp_path / 'pcm')
+    writer = PcmWriter(export_dir, 16000, checkpoint_interval=2)
+    assert writer.add('a', 0.0, [], make_samples(10, 1), payload='a') == []
+    assert writer.add('b', 0.0, [], make_samples(20, 2), payload='b') == ['a', 'b']
+    writer.add('c', 0.0, [], make_samples(30, 3), payload='c')
+    # Killed before the next checkpoint, in the middle of a journal record
+    writer._pcm_f.flush()
+    writer._journal_f.write(b'\0' * 7)
+    writer._journal_f.close()
+    writer._pcm_f.close()
+
+    writer = PcmWriter(export_dir, 16000, checkpoint_interval=2)
+    assert writer.num_segments == 2
+    assert ('c', 0.0) not in writer
+    assert os.path.getsize(os.path.join(export_dir, PCM_FILENAME)) == 30 * 2
+    assert os.path.getsize(os.path.join(export_dir, JOURNAL_FILENAME)) \
+        % writer._dtype.itemsize == 0
+    writer.add('c', 0.0, [], make_samples(30, 3))
+    writer.close()
+
+    dataset = PcmDataset(export_dir)
+    assert len(dataset) == 3
+    for idx, value in enumerate([1, 2, 3]):
+        assert (dataset[idx] == value).all()
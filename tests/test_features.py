@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from features import FEATURE_DTYPE, FeatureExtractor
+
+
+def make_tone(num_samples, sample_rate, frequency, num_channels=1):
+    t = np.arange(num_samples) / sample_rate
+    tone = (np.sin(2 * np.pi * frequency * t) * 16000).astype(np.int16)
+    return np.repeat(tone[:, None], num_channels, axis=1)
+
+
+@pytest.mark.parametrize('feature_type', ['logmel', 'stft'])
+def test_features_of_a_batch_have_the_shape_of_each_clip(feature_type):
+    extractor = FeatureExtractor(48000, feature_type=feature_type, sample_rate=16000,
+                                 num_mels=40)
+    clips = [make_tone(48000, 48000, 440), make_tone(24000, 48000, 440, num_channels=2),
+             make_tone(100, 48000, 440)]
+    features = extractor.compute(clips)
+    num_bins = 40 if feature_type == 'logmel' else extractor.n_fft // 2 + 1
+    for clip, clip_features in zip(clips, features):
+        assert clip_features.shape == (extractor.get_num_frames(len(clip)), num_bins)
+        assert clip_features.dtype == FEATURE_DTYPE
+    # One second at a hop of 10 ms
+    assert features[0].shape[0] == 98
+    assert features[2].shape[0] == 0
+
+
+def test_features_do_not_depend_on_the_batch():
+    extractor = FeatureExtractor(16000, sample_rate=16000)
+    short, long = make_tone(8000, 16000, 1000), make_tone(16000, 16000, 300)
+    alone = extractor.compute([short])[0]
+    batched = extractor.compute([short, long])[0]
+    np.testing.assert_array_equal(alone, batched)
+    # The peak of the tone is in the same band in every frame
+    assert len(set(np.argmax(alone, axis=1).tolist())) == 1
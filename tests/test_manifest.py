@@ -0,0 +1,98 @@
+import itertools
+import time
+
+import pytest
+
+from conftest import FFMPEG_PATH, FFPROBE_PATH, requires_ffmpeg
+from manifest import STATE_DEAD, Manifest
+from scheduler import SegmentResult
+from subsets import download_subset_videos, init_subset_data_dir
+
+SUBSET = 'test'
+SEGMENTS = [('a', 0.0, 10.0), ('a', 20.0, 30.0), ('b', 0.0, 10.0), ('c', 0.0, 10.0)]
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    subset_path = tmp_path / 'test.csv'
+    subset_path.write_text('')
+    path = str(tmp_path / 'manifest.db')
+    manifest = Manifest(path)
+    manifest.import_segments(SUBSET, str(subset_path), SEGMENTS)
+    manifest.close()
+    return path
+
+
+def claim_first_video(manifest, owner, lease_timeout):
+    # Only the first batch is claimed until the iteration goes on
+    segments = manifest.iter_leased(SUBSET, owner, batch_size=1, lease_timeout=lease_timeout)
+    assert list(itertools.islice(segments, 2)) == SEGMENTS[:2]
+    segments.close()
+
+
+def record_done(manifest, segments, owner):
+    for ytid, ts_start, ts_end in segments:
+        manifest.record(SUBSET, SegmentResult(ytid, ts_start, ts_end, True))
+        manifest.release(SUBSET, ytid, owner)
+    manifest.flush()
+
+
+def test_videos_are_claimed_once_per_pass(manifest_path):
+    first, second = Manifest(manifest_path), Manifest(manifest_path)
+    first_segments = first.iter_leased(SUBSET, 'first', batch_size=2)
+    # The segments of a video are claimed together
+    assert list(itertools.islice(first_segments, 3)) == SEGMENTS[:3]
+    assert list(second.iter_leased(SUBSET, 'second', batch_size=2)) == SEGMENTS[3:]
+    assert list(first_segments) == []
+
+
+def test_expired_leases_are_stolen(manifest_path):
+    first, second = Manifest(manifest_path), Manifest(manifest_path)
+    claim_first_video(first, 'first', lease_timeout=0.2)
+    segments = list(second.iter_leased(SUBSET, 'second'))
+    assert segments == SEGMENTS[2:]
+    record_done(second, segments, 'second')
+
+    # Waits for the lease of the first process to expire
+    start_time = time.time()
+    assert second.wait_for_leases(SUBSET, 'second', poll_interval=0.05)
+    assert time.time() - start_time > 0.1
+    assert list(second.iter_leased(SUBSET, 'second')) == SEGMENTS[:2]
+
+
+def test_recorded_segments_of_stolen_leases_are_skipped(manifest_path):
+    first, second = Manifest(manifest_path), Manifest(manifest_path)
+    claim_first_video(first, 'first', lease_timeout=0.1)
+    record_done(second, list(second.iter_leased(SUBSET, 'second')), 'second')
+    time.sleep(0.2)
+
+    # The first process recorded the video after its lease expired
+    for ytid, ts_start, ts_end in SEGMENTS[:2]:
+        first.record(SUBSET, SegmentResult(ytid, ts_start, ts_end, True))
+    first.flush()
+    assert list(second.iter_leased(SUBSET, 'second')) == []
+    # The stolen lease is released
+    assert not second.wait_for_leases(SUBSET, 'second')
+    assert second.counts(SUBSET) == {'done': 4}
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('use_negative_cache, state', [(True, 'dead'), (False, 'done')])
+def test_dead_segments_are_retried_without_a_negative_cache(tmp_path, media_dir,
+                                                            use_negative_cache, state):
+    subset_path = tmp_path / 'test.csv'
+    subset_path.write_text('video000001,1.0,3.0\n')
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+    manifest.import_segments(SUBSET, str(subset_path), [('video000001', 1.0, 3.0)])
+    manifest.record(SUBSET, SegmentResult('video000001', 1.0, 3.0, False, permanent=True))
+    manifest.flush()
+    assert manifest.counts(SUBSET) == {STATE_DEAD: 1}
+
+    # Dead segments are only left out if the negative cache remembers them
+    negative_cache_path = str(tmp_path / 'negative_cache.db') if use_negative_cache else None
+    data_dir = init_subset_data_dir(str(tmp_path), SUBSET)
+    download_subset_videos(str(subset_path), data_dir, FFMPEG_PATH, FFPROBE_PATH, 1, None,
+                           manifest=manifest, negative_cache_path=negative_cache_path,
+                           source=media_dir, num_retries=1)
+    assert manifest.counts(SUBSET) == {state: 1}
+    manifest.close()
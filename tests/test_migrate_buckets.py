@@ -0,0 +1,63 @@
+import os
+import sqlite3
+
+from manifest import STATE_DONE, STATE_PENDING, Manifest
+from migrate_buckets import migrate_buckets
+from scheduler import SegmentResult
+
+SUBSET = 'test'
+SEGMENTS = [('a', 0.0, 10.0), ('a', 20.0, 30.0), ('b', 0.0, 10.0)]
+
+
+def make_legacy_subset(tmp_path):
+    # Files named by YouTube ID only, without a recorded layout
+    audio_dir = tmp_path / 'data' / SUBSET / 'audio'
+    audio_dir.mkdir(parents=True)
+    for ytid in ('a', 'b'):
+        (audio_dir / (ytid + '.flac')).write_text(ytid)
+    subset_path = tmp_path / (SUBSET + '.csv')
+    subset_path.write_text(''.join('{},{},{}\n'.format(*segment) for segment in SEGMENTS))
+    return str(audio_dir), str(subset_path)
+
+
+def test_legacy_files_go_to_the_segment_recorded_first(tmp_path):
+    audio_dir, subset_path = make_legacy_subset(tmp_path)
+    manifest_path = str(tmp_path / 'manifest.db')
+    manifest = Manifest(manifest_path)
+    manifest.import_segments(SUBSET, subset_path, [segment + ([],) for segment in SEGMENTS])
+    for ytid, ts_start, ts_end in SEGMENTS:
+        audio_filepath = os.path.join(audio_dir, ytid + '.flac')
+        manifest.record(SUBSET, SegmentResult(ytid, ts_start, ts_end, True,
+                                              audio_filepath=audio_filepath))
+    manifest.close()
+    # The second segment of 'a' was recorded first, so ffmpeg wrote the file
+    # for it and skipped the first one
+    conn = sqlite3.connect(manifest_path)
+    with conn:
+        conn.executemany('UPDATE segments SET updated_at = ? WHERE ytid = ? AND ts_start = ?',
+                         [(2.0, 'a', 0.0), (1.0, 'a', 20.0)])
+    conn.close()
+    os.remove(subset_path)
+
+    migrate_buckets(str(tmp_path), num_workers=1)
+
+    assert sorted(os.listdir(audio_dir)) == ['a_20000_30000.flac', 'b_0_10000.flac']
+    with open(os.path.join(audio_dir, 'a_20000_30000.flac')) as f:
+        assert f.read() == 'a'
+    conn = sqlite3.connect(manifest_path)
+    rows = conn.execute('SELECT ytid, ts_start, state, audio_path FROM segments '
+                        'ORDER BY ytid, ts_start').fetchall()
+    conn.close()
+    assert rows == [
+        ('a', 0.0, STATE_PENDING, None),
+        ('a', 20.0, STATE_DONE, os.path.join(audio_dir, 'a_20000_30000.flac')),
+        ('b', 0.0, STATE_DONE, os.path.join(audio_dir, 'b_0_10000.flac'))]
+
+
+def test_legacy_files_are_never_removed_without_a_manifest(tmp_path):
+    audio_dir, subset_path = make_legacy_subset(tmp_path)
+
+    migrate_buckets(str(tmp_path), num_workers=1)
+
+    # Only the file of the video with a single segment can be attributed
+    assert sorted(os.listdir(audio_dir)) == ['a.flac', 'b_0_10000.flac']
@@ -0,0 +1,125 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from scheduler import CompletedTask, imap_bounded
+
+
+@pytest.fixture
+def pool():
+    pool = ThreadPool(4)
+    yield pool
+    pool.terminate()
+    pool.join()
+
+
+def test_tasks_in_flight_are_bounded(pool):
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def task(value):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return value
+
+    consumed = []
+
+    def iter_args():
+        for value in range(20):
+            consumed.append(value)
+            yield [value]
+
+    results = []
+    for result in imap_bounded(pool, task, iter_args(), 2):
+        # The iterable is only consumed as tasks complete
+        assert len(consumed) <= len(results) + 3
+        results.append(result)
+    assert sorted(results) == list(range(20))
+    assert running[1] <= 2
+
+
+def test_completed_tasks_are_not_submitted(pool):
+    tasks = [CompletedTask('done'), [1], CompletedTask('also done')]
+    results = list(imap_bounded(pool, lambda value: value, tasks, 1))
+    assert sorted(results, key=str) == [1, 'also done', 'done']
+
+
+def test_task_errors_are_raised(pool):
+    def task(value):
+        raise ValueError(value)
+
+    with pytest.raises(ValueError):
+        list(imap_bounded(pool, task, [[1]], 1))
+
+
+def test_stop_event_stops_submitting_tasks(pool):
+    stop_event = threading.Event()
+    release = threading.Event()
+    submitted = []
+
+    def task(value):
+        submitted.append(value)
+        if value > 0:
+            # Keeps running until the end of the test
+            release.wait(5)
+        return value
+
+    results = []
+    start_time = time.time()
+    try:
+        for result in imap_bounded(pool, task, ([value] for value in range(10)), 3,
+                                   stop_event=stop_event, stop_timeout=0.2):
+            results.append(result)
+            stop_event.set()
+    finally:
+        release.set()
+    # The iteration ends once the running tasks were waited for long enough
+    assert results == [0]
+    assert time.time() - start_time < 2
+    assert sorted(submitted) == [0, 1, 2]
+
+
+def test_stopped_pipeline_lets_the_process_exit():
+    # More jobs are resolved than fit into the queue between the stages, so
+    # that resolver threads are waiting on the full queue when it stops
+    script = textwrap.dedent("""
+        import threading
+        import time
+        from multiprocessing.pool import ThreadPool
+
+        from scheduler import imap_pipelined
+
+        def resolve(value):
+            return [value]
+
+        def transcode(value):
+            time.sleep(0.5)
+            return value
+
+        stop_event = threading.Event()
+        pool = ThreadPool(2)
+        results = imap_pipelined(pool, resolve, transcode, ([value] for value in range(100)),
+                                 num_resolvers=8, max_in_flight=2, queue_size=1,
+                                 stop_event=stop_event, stop_timeout=0.1)
+        for result in results:
+            # Lets the resolver threads fill the queue
+            time.sleep(0.2)
+            stop_event.set()
+        pool.terminate()
+        pool.join()
+    """)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start_time = time.time()
+    proc = subprocess.run([sys.executable, '-c', script], cwd=repo_dir, timeout=30)
+    assert proc.returncode == 0
+    assert time.time() - start_time < 10
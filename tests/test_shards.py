@@ -0,0 +1,45 @@
+import glob
+import json
+import os
+
+from shards import INDEX_SUFFIX, ShardWriter
+
+
+def read_member(shard_path, member):
+    with open(shard_path, 'rb') as f:
+        f.seek(member['offset'])
+        return f.read(member['size'])
+
+
+def test_index_gives_the_offset_of_every_member(tmp_path):
+    writer = ShardWriter(str(tmp_path / 'shards'), 'test', max_samples=2)
+    contents = {}
+    payloads = []
+    for idx in range(3):
+        key = 'abc_{}_{}'.format(idx * 10000, idx * 10000 + 10000)
+        audio_filepath = tmp_path / '{}.flac'.format(key)
+        # Sizes that are not a whole number of tar blocks
+        audio_filepath.write_bytes(os.urandom(1000 + idx * 700))
+        contents[key] = audio_filepath.read_bytes()
+        payloads += writer.add(key, {'flac': str(audio_filepath)}, {'index': idx},
+                               payload=idx, data={'txt': key.encode()})
+    # The first shard is published once full, with the payloads of its samples
+    assert payloads == [0, 1]
+    assert writer.finalize() == [2]
+
+    index_paths = sorted(glob.glob(str(tmp_path / 'shards' / ('*' + INDEX_SUFFIX))))
+    assert len(index_paths) == 2
+    keys = []
+    for index_path in index_paths:
+        with open(index_path) as f:
+            index = json.load(f)
+        shard_path = str(tmp_path / 'shards' / index['shard'])
+        for sample in index['samples']:
+            key = sample['key']
+            keys.append(key)
+            members = sample['members']
+            assert read_member(shard_path, members['flac']) == contents[key]
+            assert read_member(shard_path, members['txt']) == key.encode()
+            assert json.loads(read_member(shard_path, members['json'])) \
+                == {'index': len(keys) - 1}
+    assert keys == sorted(contents)
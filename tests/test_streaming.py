@@ -0,0 +1,57 @@
+import glob
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from conftest import FFMPEG_PATH, FFPROBE_PATH, requires_ffmpeg
+from scheduler import SegmentResult
+from shards import ShardWriter
+from streaming import ShardSink
+
+
+def test_shard_sink_packs_the_files_of_each_segment(tmp_path):
+    sink = ShardSink(ShardWriter(str(tmp_path / 'shards'), 'test'))
+    for ts_start in (0.0, 10.0):
+        audio_filepath = tmp_path / 'abc_{}_{}.flac'.format(int(ts_start * 1000),
+                                                           int(ts_start * 1000) + 10000)
+        audio_filepath.write_bytes(b'audio')
+        result = SegmentResult('abc', ts_start, ts_start + 10.0, True,
+                               audio_filepath=str(audio_filepath))
+        assert sink.add(result, {'ytid': 'abc'}) == []
+    payloads = sink.close()
+    assert [(result.ts_start, result.ts_end) for result in payloads] == [(0.0, 10.0),
+                                                                         (10.0, 20.0)]
+
+
+def test_shard_sink_rejects_a_segment_whose_file_is_missing(tmp_path):
+    sink = ShardSink(ShardWriter(str(tmp_path / 'shards'), 'test'))
+    result = SegmentResult('abc', 0.0, 10.0, True,
+                           audio_filepath=str(tmp_path / 'abc_0_10000.flac'))
+    with pytest.raises(FileNotFoundError):
+        sink.add(result, {'ytid': 'abc'})
+
+
+@requires_ffmpeg
+def test_features_sink_only_keeps_the_features_of_streamed_audio(tmp_path, media_dir):
+    subset_path = tmp_path / 'test.csv'
+    subset_path.write_text('video000001,1.0,3.0\nvideo000001,5.0,7.0\n')
+    data_dir = tmp_path / 'data'
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, os.path.join(repo_dir, 'download_audioset.py'),
+                    '-f', FFMPEG_PATH, '-fp', FFPROBE_PATH, '-src', media_dir,
+                    '-e', str(subset_path), '-b', '', '-u', '', '-n', '1',
+                    '--stream-audio', '--stream-sink', 'features', '--features', 'logmel',
+                    str(data_dir)], cwd=str(tmp_path), check=True, timeout=120)
+
+    subset_dir = str(data_dir / 'data' / 'test')
+    feature_filepaths = glob.glob(os.path.join(subset_dir, 'audio', '**', '*.logmel.npy'),
+                                  recursive=True)
+    assert len(feature_filepaths) == 2
+    assert not glob.glob(os.path.join(subset_dir, 'audio', '**', '*.flac'), recursive=True)
+    conn = sqlite3.connect(str(data_dir / 'manifest.db'))
+    rows = conn.execute('SELECT state, audio_path FROM segments').fetchall()
+    conn.close()
+    assert rows == [('done', None), ('done', None)]
@@ -0,0 +1,39 @@
+import collections
+
+import pytest
+
+from errors import FfmpegIncorrectDurationError, SubprocessError
+from transcode import retry_ffmpeg
+
+
+def test_ffmpeg_is_retried_with_the_duration_adjusted():
+    durations = [9.5, 10.0]
+    adjustments = []
+
+    def run_once():
+        duration = durations.pop(0)
+        if duration != 10.0:
+            raise FfmpegIncorrectDurationError('a.flac', 10.0, duration)
+        return duration
+
+    retries, errors = collections.Counter(), collections.Counter()
+    assert retry_ffmpeg(run_once, 'a.mp4', adjust_duration=adjustments.append,
+                        retries=retries, errors=errors) == 10.0
+    assert [e.actual_duration for e in adjustments] == [9.5]
+    assert retries == {'ffmpeg': 1}
+    assert errors == {'FfmpegIncorrectDurationError': 1}
+
+
+def test_ffmpeg_raises_the_last_error_once_out_of_retries():
+    removed = []
+
+    def run_once():
+        raise SubprocessError(['ffmpeg'], 1, b'', 'Server returned 503 Service Unavailable')
+
+    errors = collections.Counter()
+    with pytest.raises(SubprocessError):
+        retry_ffmpeg(run_once, 'a.mp4', num_retries=3,
+                     remove_outputs=lambda: removed.append(True), errors=errors)
+    # HTTP errors leave the outputs of the attempt alone until the last one
+    assert errors == {'http': 3}
+    assert removed == [True]
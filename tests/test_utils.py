@@ -0,0 +1,115 @@
+import os
+import socket
+import subprocess as sp
+import time
+
+import pytest
+
+from errors import FfmpegValidationError, SourceUnavailableError, SubprocessError
+from sources import PafySource
+from utils import TEMP_PREFIX, get_bucket_dir, get_temp_path, is_permanent_error, \
+    iter_bucket_dirs, remove_temp_files
+
+
+class FailingPafy(object):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def new(self, url):
+        raise OSError(self.msg)
+
+
+def resolve_error(msg):
+    source = PafySource()
+    source.pafy = FailingPafy(msg)
+    with pytest.raises(SourceUnavailableError) as excinfo:
+        source.resolve('abcdefghijk', 'bestvideoaudio')
+    return excinfo.value
+
+
+@pytest.mark.parametrize('msg', [
+    'ERROR: Video unavailable',
+    'YouTube said: This video does not exist.',
+    'ERROR: This video has been removed by the user',
+    'ERROR: This video is no longer available because the YouTube account associated '
+    'with this video has been terminated.',
+    'ERROR: The uploader has not made this video available in your country.',
+    'ERROR: This video contains content from X, who has blocked it in your country on '
+    'copyright grounds.',
+    'ERROR: Sign in to confirm your age',
+    'ERROR: Private video',
+])
+def test_videos_that_are_gone_are_permanent_errors(msg):
+    assert is_permanent_error(resolve_error(msg))
+
+
+@pytest.mark.parametrize('msg', [
+    'HTTP Error 429: Too Many Requests',
+    '<urlopen error [Errno -3] Temporary failure in name resolution>',
+    'ERROR: Unable to download webpage: the copyright notice could not be parsed',
+])
+def test_resolver_errors_are_transient_by_default(msg):
+    assert not is_permanent_error(resolve_error(msg))
+
+
+def test_output_errors_are_transient():
+    assert not is_permanent_error(FfmpegValidationError('Output file x.flac does not exist.'))
+    assert not is_permanent_error(SubprocessError(['ffmpeg'], 1, '', 'Video unavailable'))
+    assert not is_permanent_error(OSError('[Errno 2] No such file: the file does not exist'))
+
+
+def get_exited_pid():
+    proc = sp.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+
+def make_temp_file(dirpath, owner, age=0):
+    path = dirpath / '{}{}-a.flac'.format(TEMP_PREFIX, owner)
+    path.write_bytes(b'')
+    mtime = time.time() - age
+    os.utime(str(path), (mtime, mtime))
+    return path
+
+
+def test_temp_files_are_removed_once_their_process_exited(tmp_path):
+    hostname = socket.gethostname()
+    own = tmp_path / os.path.basename(get_temp_path(str(tmp_path / 'a.flac')))
+    own.write_bytes(b'')
+    exited = make_temp_file(tmp_path, '{}~{}~0'.format(hostname, get_exited_pid()))
+    # Another task of a job array on the same host
+    running = make_temp_file(tmp_path, '{}~{}~0'.format(hostname, os.getppid()), age=3600)
+
+    assert remove_temp_files(str(tmp_path), min_age=300) == 1
+    assert not exited.exists()
+    assert own.exists() and running.exists()
+    assert remove_temp_files(str(tmp_path), min_age=300, include_own=True) == 1
+    assert not own.exists() and running.exists()
+
+
+def test_temp_files_of_unknown_processes_are_removed_by_age(tmp_path):
+    other_host = make_temp_file(tmp_path, 'otherhost~1~0', age=60)
+    old_version = make_temp_file(tmp_path, '0123456789ab', age=3600)
+    span_dir = tmp_path / '{}otherhost~1~span-0'.format(TEMP_PREFIX)
+    span_dir.mkdir()
+    os.utime(str(span_dir), (0, 0))
+    # Files written into the directory keep it from looking abandoned
+    (span_dir / 'span0.nut').write_bytes(b'')
+
+    assert remove_temp_files(str(tmp_path)) == 0
+    assert remove_temp_files(str(tmp_path), min_age=300) == 1
+    assert not old_version.exists()
+    assert other_host.exists() and span_dir.exists()
+
+
+def test_bucket_of_a_video_is_stable():
+    # Buckets must never change, or downloaded files would be looked up in
+    # the wrong directories
+    assert get_bucket_dir('--PJHxphWEs', 1000) == '694'
+    assert get_bucket_dir('--PJHxphWEs', 1000, 2) == '694/545'
+    assert get_bucket_dir('--PJHxphWEs', 16) == '014'
+
+
+def test_buckets_are_spread_over_the_layout():
+    bucket_dirs = [get_bucket_dir('video{:06d}'.format(idx), 4, 2) for idx in range(1000)]
+    assert set(bucket_dirs) == set(iter_bucket_dirs(4, 2))
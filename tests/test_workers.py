@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import soundfile as sf
+
+from conftest import FFMPEG_PATH, FFPROBE_PATH, requires_ffmpeg
+from subsets import init_subset_data_dir
+from utils import get_media_filename, run_command
+from validation import ffprobe
+from workers import video_mp_worker
+
+YTID = 'video000001'
+SAMPLE_RATE = 16000
+
+
+def test_segments_of_a_video_have_their_own_files():
+    assert get_media_filename('abc', 0, 10) == 'abc_0_10000'
+    assert get_media_filename('abc', 0, 10, 8) != get_media_filename('abc', 30, 40, 8)
+    # Segments of the same video share a bucket
+    assert get_media_filename('abc', 0, 10, 8).split('/')[0] \
+        == get_media_filename('abc', 30, 40, 8).split('/')[0]
+
+
+def download_segments(tmp_path, media_dir, segments, **ffmpeg_cfg):
+    data_dir = init_subset_data_dir(str(tmp_path), 'test', num_buckets=4)
+    return video_mp_worker(YTID, segments, data_dir, FFMPEG_PATH, FFPROBE_PATH, 4,
+                           source=media_dir, audio_sample_rate=SAMPLE_RATE,
+                           num_retries=1, **ffmpeg_cfg)
+
+
+def check_segment_outputs(results, segments, distinct_audio=True):
+    assert [(result.ts_start, result.ts_end) for result in results] == segments
+    assert all(result.succeeded for result in results)
+    audio_filepaths = [result.audio_filepath for result in results]
+    video_filepaths = [result.video_filepath for result in results]
+    assert len(set(audio_filepaths)) == len(segments)
+    assert len(set(video_filepaths)) == len(segments)
+    for (ts_start, ts_end), audio_filepath, video_filepath in \
+            zip(segments, audio_filepaths, video_filepaths):
+        assert os.path.exists(video_filepath)
+        info = sf.info(audio_filepath)
+        assert info.samplerate == SAMPLE_RATE
+        assert info.frames == round((ts_end - ts_start) * SAMPLE_RATE)
+    if distinct_audio:
+        first, second = (sf.read(path, dtype='int16')[0] for path in audio_filepaths)
+        assert (first != second).any()
+
+
+@requires_ffmpeg
+def test_segments_of_a_video_are_downloaded_separately(tmp_path, media_dir):
+    segments = [(1.0, 3.0), (5.0, 7.0)]
+    check_segment_outputs(download_segments(tmp_path, media_dir, segments), segments)
+
+
+@requires_ffmpeg
+def test_segments_cut_from_a_span_have_their_own_files(tmp_path, media_dir):
+    segments = [(1.0, 3.0), (4.0, 6.0)]
+    results = download_segments(tmp_path, media_dir, segments, merge_gap=2.0)
+    check_segment_outputs(results, segments)
+    assert 'fetch_span' in results[0].timings
+
+
+@requires_ffmpeg
+def test_segments_of_a_video_have_their_own_features(tmp_path, media_dir):
+    segments = [(1.0, 3.0), (5.0, 7.0)]
+    results = download_segments(tmp_path, media_dir, segments, features='logmel')
+    feature_filepaths = [result.feature_filepath for result in results]
+    assert len(set(feature_filepaths)) == len(segments)
+    first, second = (np.load(path) for path in feature_filepaths)
+    assert first.shape == second.shape
+    assert (first != second).any()
+
+
+@requires_ffmpeg
+def test_fused_outputs_take_the_best_audio_stream(tmp_path, media_dir):
+    # A silent audio-only stream next to the video, whose own audio is a chirp
+    source_dir = tmp_path / 'media'
+    source_dir.mkdir()
+    os.symlink(os.path.join(media_dir, YTID + '.mp4'), str(source_dir / (YTID + '.mp4')))
+    run_command([FFMPEG_PATH, '-f', 'lavfi', '-i', 'anullsrc=sample_rate=44100',
+                 '-t', '10', '-c:a', 'aac', str(source_dir / (YTID + '.audio.m4a')),
+                 '-loglevel', 'error'])
+
+    segments = [(1.0, 3.0), (5.0, 7.0)]
+    results = download_segments(tmp_path, str(source_dir), segments)
+    check_segment_outputs(results, segments, distinct_audio=False)
+    assert all('audio_video' in result.timings for result in results)
+    for result in results:
+        samples, _ = sf.read(result.audio_filepath, dtype='int16')
+        assert not samples.any()
+        assert 'audio' in {stream['codec_type'] for stream in
+                           ffprobe(FFPROBE_PATH, result.video_filepath)['streams']}
@@ -0,0 +1,451 @@
+"""
+Runs ffmpeg on the inputs of a segment, validating its outputs and retrying
+the attempts that failed
+"""
+import collections
+import collections.abc
+import logging
+import os
+import random
+import time
+
+import numpy as np
+
+from errors import SubprocessError, FfmpegValidationError, \
+                   FfmpegIncorrectDurationError, FfmpegUnopenableFileError
+from streaming import STREAM_DTYPE, STREAM_FORMAT, stream_command
+from utils import run_command, is_http_error, get_backoff_delay, filter_ffmpeg_log, \
+    parse_ffmpeg_stats, get_temp_path, publish_file
+from validation import STATS_VALIDATORS, check_duration
+
+LOGGER = logging.getLogger('audiosetdl')
+
+
+def retry_ffmpeg(run_once, input_path, output_path=None, num_retries=10,
+                 adjust_duration=None, remove_outputs=None, retry_key='ffmpeg',
+                 retries=None, errors=None, retry_backoff=0.0, retry_backoff_max=60.0):
+    """
+    Run ffmpeg until it succeeds, retrying after failures the way `ffmpeg`
+    and `ffmpeg_pcm` do
+
+    Args:
+        run_once:           Function that runs ffmpeg once and validates its
+                            outputs, raising a SubprocessError or an
+                            FfmpegValidationError if the attempt failed
+                            (Type: function() -> *)
+
+        input_path:         Path/URL to input file(s), for error messages
+                            (Type: str or iterable)
+
+    Keyword Args:
+        output_path:        Path/URL to output file, for error messages
+                            (Type: str or None)
+
+        num_retries:        Number of attempts to run ffmpeg
+                            (Type: int)
+
+        adjust_duration:    Function called with an
+                            FfmpegIncorrectDurationError to alter the
+                            duration arguments of the next attempt
+                            (Type: function(FfmpegIncorrectDurationError) or None)
+
+        remove_outputs:     Function that removes the outputs of a failed
+                            attempt
+                            (Type: function() or None)
+
+        retry_key:          Key under which retries are counted in `retries`
+                            (Type: str)
+
+        retries:            If given, the number of times ffmpeg was run again
+                            after a failed attempt is added to
+                            `retries[retry_key]`
+                            (Type: collections.Counter or None)
+
+        errors:             If given, the number of failed attempts is added to
+                            it, under 'http' for HTTP error responses and under
+                            the name of the exception class otherwise
+                            (Type: collections.Counter or None)
+
+        retry_backoff:      Maximum delay (in seconds) before retrying after
+                            ffmpeg failed for the first time, doubling after
+                            every failure
+                            (Type: float)
+
+        retry_backoff_max:  Maximum delay (in seconds) before any retry
+                            (Type: float)
+
+    Returns:
+        result:  Return value of `run_once`, or None if no attempt succeeded
+                 and no error was raised
+                 (Type: *)
+
+    Raises the last error encountered if ffmpeg did not succeed within the
+    maximum number of retries.
+    """
+    def cleanup():
+        if remove_outputs is not None:
+            remove_outputs()
+
+    last_err = None
+    for attempt in range(num_retries):
+        if attempt > 0 and retries is not None:
+            retries[retry_key] += 1
+        try:
+            return run_once()
+        except SubprocessError as e:
+            last_err = e
+            if is_http_error(e):
+                # Retry if we got a 4XX or 5XX, in case it was just a network
+                # issue, but back off so that throttling is not made worse
+                if errors is not None:
+                    errors['http'] += 1
+            else:
+                if errors is not None:
+                    errors[type(e).__name__] += 1
+
+                LOGGER.error(str(e) + '. Retrying...')
+                cleanup()
+
+            if retry_backoff > 0 and attempt < num_retries - 1:
+                time.sleep(get_backoff_delay(attempt, retry_backoff, retry_backoff_max))
+
+        except FfmpegIncorrectDurationError as e:
+            last_err = e
+            if errors is not None:
+                errors[type(e).__name__] += 1
+            if attempt < num_retries - 1:
+                cleanup()
+            # If the duration of the output audio is different, alter the
+            # duration argument to account for this difference and try again
+            if adjust_duration is not None:
+                adjust_duration(e)
+            LOGGER.warning(str(e) + '; Retrying...')
+
+        except FfmpegUnopenableFileError as e:
+            last_err = e
+            if errors is not None:
+                errors[type(e).__name__] += 1
+            # Always remove unopenable files
+            cleanup()
+            # Retry if the output did not validate
+            LOGGER.info('ffmpeg output file "{}" could not be opened: {}. '
+                        'Retrying...'.format(e.filepath, e.open_error))
+
+        except FfmpegValidationError as e:
+            last_err = e
+            if errors is not None:
+                errors[type(e).__name__] += 1
+            if attempt < num_retries - 1:
+                cleanup()
+            # Retry if the output did not validate
+            LOGGER.info('ffmpeg output file "{}" did not validate: {}. '
+                        'Retrying...'.format(output_path, e))
+
+    cleanup()
+    error_msg = 'Maximum number of retries ({}) reached. Could not obtain inputs at {}. ' \
+                'Error: {}'
+    LOGGER.error(error_msg.format(num_retries, input_path, str(last_err)))
+    if last_err is not None:
+        raise last_err
+
+
+def ffmpeg(ffmpeg_path, input_path, output_path, input_args=None,
+           output_args=None, log_level='error', num_retries=10,
+           validation_callback=None, validation_args=None, extra_outputs=None,
+           timings=None, timing_key='ffmpeg', retries=None, errors=None,
+           retry_backoff=0.0, retry_backoff_max=60.0, validate_from_stats=False,
+           spot_check_rate=0.1):
+    """
+    Transform an input file using `ffmpeg`
+
+    The outputs are written to temporary files next to them, and moved to
+    their paths once they are validated.
+
+    Args:
+        ffmpeg_path:        Path to ffmpeg executable
+                            (Type: str)
+
+        input_path:         Path/URL to input file(s)
+                            (Type: str or iterable)
+
+        output_path:        Path/URL to output file
+                            (Type: str)
+
+        input_args:         Options/flags for each input file
+                            (Type: list[str])
+
+        output_args:        Options/flags for output files
+                            (Type: list[str])
+
+        log_level:          ffmpeg logging level
+                            (Type: str)
+
+        num_retries:        Number of retries if ffmpeg encounters an HTTP issue
+                            (Type: int)
+
+        extra_outputs:      Additional outputs written by the same ffmpeg process,
+                            each given as a tuple of (output path, output args,
+                            validation callback, validation args)
+                            (Type: list[tuple] or None)
+
+        timings:            If given, the time spent running ffmpeg is added to
+                            `timings[timing_key]` and the time spent in each
+                            validation callback to the entry named after the
+                            callback
+                            (Type: dict[str, float] or None)
+
+        timing_key:         Key under which the ffmpeg running time is recorded
+                            (Type: str)
+
+        retries:            If given, the number of times ffmpeg was run again
+                            after a failed attempt is added to
+                            `retries[timing_key]`
+                            (Type: collections.Counter or None)
+
+        errors:             If given, the number of failed attempts is added to
+                            it, under 'http' for HTTP error responses and under
+                            the name of the exception class otherwise
+                            (Type: collections.Counter or None)
+
+        retry_backoff:      Maximum delay (in seconds) before retrying after
+                            ffmpeg failed for the first time. The delay is
+                            random and its maximum doubles after every
+                            failure. If 0, ffmpeg is retried right away.
+                            (Type: float)
+
+        retry_backoff_max:  Maximum delay (in seconds) before any retry
+                            (Type: float)
+
+        validate_from_stats:
+                            If True, validate outputs from the number of
+                            frames and samples that ffmpeg reports encoding,
+                            with the callbacks in
+                            `validation.STATS_VALIDATORS`, instead of
+                            analysing the output files
+                            (Type: bool)
+
+        spot_check_rate:    If validating outputs from the ffmpeg statistics,
+                            fraction of the outputs that are also analysed
+                            by their validation callback
+                            (Type: float)
+
+    Raises the last error encountered if the output could not be obtained
+    within the maximum number of retries.
+    """
+
+    if type(input_path) == str:
+        input_paths = [input_path]
+    elif isinstance(input_path, collections.abc.Iterable):
+        input_paths = list(input_path)
+    else:
+        error_msg = '"input_path" must be a str or an iterable, but got type {}'
+        raise ValueError(error_msg.format(str(type(input_path))))
+
+    if not input_args:
+        input_args = []
+    outputs = [(output_path, output_args, validation_callback, validation_args)]
+    outputs += list(extra_outputs or [])
+
+    # With `-n`, existing outputs are not overwritten
+    if '-n' in input_args:
+        existing_paths = [path for path, _, _, _ in outputs if os.path.exists(path)]
+        if existing_paths:
+            LOGGER.info('ffmpeg output file "{}" already exists.'.format(existing_paths[0]))
+            return
+
+    # Outputs are written to temporary files and only published at their
+    # paths once they are validated, so that a process that is killed never
+    # leaves a partial output that looks complete
+    publish_paths = collections.OrderedDict()
+    for path, _, _, _ in outputs:
+        publish_paths[get_temp_path(path)] = path
+    outputs = [(temp_path, list(args or []), callback, cb_args or {})
+               for temp_path, (_, args, callback, cb_args) in zip(publish_paths, outputs)]
+
+    def remove_outputs():
+        for path, _, _, _ in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def validate(callback, *args, **kwargs):
+        start_time = time.time()
+        try:
+            callback(*args, **kwargs)
+        finally:
+            if timings is not None:
+                key = callback.__name__
+                timings[key] = timings.get(key, 0.0) + time.time() - start_time
+
+    def run_once():
+        args = [ffmpeg_path]
+        for path in input_paths:
+            # Input options, e.g. seeking, only apply to the next input
+            args += input_args + ['-i', path]
+        for path, out_args, _, _ in outputs:
+            args += out_args + [path]
+        if validate_from_stats:
+            # The number of frames and samples encoded in each output are
+            # only logged at the verbose level, so the log is filtered
+            # back to the requested level for error messages
+            args += ['-nostats', '-loglevel', 'level+verbose']
+        else:
+            args += ['-loglevel', log_level]
+        start_time = time.time()
+        try:
+            stdout, stderr, _ = run_command(args)
+        except SubprocessError as e:
+            if not validate_from_stats:
+                raise
+            raise SubprocessError(e.cmd, e.cmd_return_code, e.cmd_stdout,
+                                  filter_ffmpeg_log(e.cmd_stderr, log_level))
+        finally:
+            if timings is not None:
+                timings[timing_key] = timings.get(timing_key, 0.0) + time.time() - start_time
+
+        stats = parse_ffmpeg_stats(stderr.decode()) if validate_from_stats else {}
+
+        # Validate if a callback was passed in
+        for path, _, callback, cb_args in outputs:
+            if callback is None:
+                continue
+            stats_callback = STATS_VALIDATORS.get(callback)
+            if stats_callback is not None and path in stats:
+                validate(stats_callback, path, stats[path], **cb_args)
+                # Analyse a sample of the outputs to catch the issues
+                # that the statistics do not reveal
+                if random.random() < spot_check_rate:
+                    validate(callback, path, **cb_args)
+            else:
+                validate(callback, path, **cb_args)
+
+        for temp_path, path in publish_paths.items():
+            publish_file(temp_path, path)
+
+    def adjust_duration(e):
+        duration_diff = e.target_duration - e.actual_duration
+        out_args = next((out_args for path, out_args, _, _ in outputs
+                         if path == e.filepath), outputs[0][1])
+        try:
+            duration_idx = input_args.index('-t') + 1
+            input_args[duration_idx] = str(float(input_args[duration_idx]) + duration_diff)
+        except ValueError:
+            duration_idx = out_args.index('-t') + 1
+            out_args[duration_idx] = str(float(out_args[duration_idx]) + duration_diff)
+
+    retry_ffmpeg(run_once, input_path, output_path=output_path, num_retries=num_retries,
+                 adjust_duration=adjust_duration, remove_outputs=remove_outputs,
+                 retry_key=timing_key, retries=retries, errors=errors,
+                 retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max)
+
+
+def ffmpeg_pcm(ffmpeg_path, input_path, num_frames, sample_rate, input_args=None,
+               num_channels=1, log_level='error', num_retries=10, end_past_video_end=False,
+               timings=None, timing_key='audio', retries=None, errors=None,
+               retry_backoff=0.0, retry_backoff_max=60.0):
+    """
+    Decode the audio of an input with `ffmpeg` into memory
+
+    ffmpeg writes raw 16-bit samples to its standard output, which are read
+    in chunks into a preallocated buffer, so nothing is written to the
+    filesystem. The number of samples is checked from the stream itself, and
+    failures are retried like in `ffmpeg` (see `retry_ffmpeg`).
+
+    Args:
+        ffmpeg_path:         Path to ffmpeg executable
+                             (Type: str)
+
+        input_path:          Path/URL to input file
+                             (Type: str)
+
+        num_frames:          Number of frames (samples per channel) expected
+                             (Type: int)
+
+        sample_rate:         Sample rate of the decoded audio (in Hz)
+                             (Type: int)
+
+    Keyword Args:
+        input_args:          Options/flags for the input file
+                             (Type: list[str] or None)
+
+        num_channels:        Number of channels of the decoded audio
+                             (Type: int)
+
+        log_level:           ffmpeg logging level
+                             (Type: str)
+
+        num_retries:         Number of attempts to decode the audio
+                             (Type: int)
+
+        end_past_video_end:  If True, the audio may be shorter than expected
+                             (Type: bool)
+
+        timings:             If given, the time spent running ffmpeg is added
+                             to `timings[timing_key]`
+                             (Type: dict[str, float] or None)
+
+        timing_key:          Key under which the ffmpeg running time is
+                             recorded
+                             (Type: str)
+
+        retries:             If given, the number of times ffmpeg was run
+                             again after a failed attempt is added to
+                             `retries[timing_key]`
+                             (Type: collections.Counter or None)
+
+        errors:              If given, the number of failed attempts is added
+                             to it, under 'http' for HTTP error responses and
+                             under the name of the exception class otherwise
+                             (Type: collections.Counter or None)
+
+        retry_backoff:       Maximum delay (in seconds) before retrying after
+                             ffmpeg failed for the first time, doubling after
+                             every failure
+                             (Type: float)
+
+        retry_backoff_max:   Maximum delay (in seconds) before any retry
+                             (Type: float)
+
+    Returns:
+        samples:  Decoded samples, of shape (frames, channels)
+                  (Type: numpy.ndarray)
+
+    Raises the last error encountered if the audio could not be obtained
+    within the maximum number of retries.
+    """
+    buffer = np.empty((num_frames, num_channels), dtype=STREAM_DTYPE)
+    input_args = list(input_args or [])
+    duration = num_frames / sample_rate
+    # The audio is cut after the expected number of samples, so that it
+    # always fits in the buffer
+    output_args = ['-t', str(duration),
+                   '-vn',
+                   '-ac', str(num_channels),
+                   '-af', 'aresample={},atrim=end_sample={}'.format(sample_rate, num_frames),
+                   '-ar', str(sample_rate),
+                   '-f', STREAM_FORMAT,
+                   '-acodec', 'pcm_' + STREAM_FORMAT]
+
+    def run_once():
+        args = [ffmpeg_path, '-nostdin'] + input_args + ['-i', input_path] + output_args \
+            + ['-loglevel', log_level, 'pipe:1']
+        start_time = time.time()
+        try:
+            count, _ = stream_command(args, buffer)
+        finally:
+            if timings is not None:
+                timings[timing_key] = timings.get(timing_key, 0.0) + time.time() - start_time
+
+        check_duration(input_path, duration, count, sample_rate, end_past_video_end)
+        return buffer[:count]
+
+    def adjust_duration(e):
+        # Read further into the input, the audio is still cut after the
+        # expected number of samples
+        duration_idx = output_args.index('-t') + 1
+        output_args[duration_idx] = str(float(output_args[duration_idx])
+                                        + e.target_duration - e.actual_duration)
+
+    return retry_ffmpeg(run_once, input_path, num_retries=num_retries,
+                        adjust_duration=adjust_duration, retry_key=timing_key,
+                        retries=retries, errors=errors, retry_backoff=retry_backoff,
+                        retry_backoff_max=retry_backoff_max)
@@ -1,22 +1,151 @@
+import hashlib
+import itertools
+import json
 import os
+import random
 import re
+import shutil
+import signal
+import socket
 import subprocess as sp
+import time
+import uuid
 
-from errors import SubprocessError
+from errors import SubprocessError, SourceUnavailableError, CommandTimeoutError
 
 URL_PATTERN = re.compile(r'https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)')
 HTTP_ERR_PATTERN = re.compile(r'Server returned (4|5)(X|[0-9])(X|[0-9])')
+RESOLVE_HTTP_ERR_PATTERN = re.compile(r'HTTP Error (4|5)[0-9][0-9]')
+# ffmpeg log levels, from the least to the most verbose
+FFMPEG_LOG_LEVELS = ('quiet', 'panic', 'fatal', 'error', 'warning', 'info', 'verbose',
+                     'debug', 'trace')
+FFMPEG_LOG_LEVEL_PATTERN = re.compile(r'^(?:\[[^\]]+ @ [^\]]+\] )?\[(\w+)\] ')
+FFMPEG_OUTPUT_FILE_PATTERN = re.compile(r'\[\w+\] Output file #\d+ \((.*)\):$')
+FFMPEG_OUTPUT_STREAM_PATTERN = re.compile(
+    r'\[\w+\]\s+Output stream #\d+:\d+ \((\w+)\): (\d+) frames encoded(?: \((\d+) samples\))?')
+# File in a subset data directory that records the bucket layout
+LAYOUT_FILENAME = 'layout.json'
+# Naming scheme of media files recorded in the layout. Files used to be named
+# by YouTube ID only, which the layouts written then do not record.
+MEDIA_NAMING = 'segment'
+MEDIA_KEY_PATTERN = re.compile(r'^(.+)_(\d+)_(\d+)$')
+# Prefix of the temporary files and directories that outputs are written to
+# before they are published. It is followed by the host and the process ID of
+# the process that writes them, e.g. .tmp-node01~1234~<name>.
+TEMP_PREFIX = '.tmp-'
+
+
+# Executor and timeout of the commands run by the current process, set with
+# `configure_commands`
+_COMMAND_CONFIG = {'executor': None, 'timeout': None}
+# Commands that the current process is running without an executor. They are
+# not guarded by a lock, since `kill_running_commands` is called from signal
+# handlers.
+_RUNNING_COMMANDS = set()
+
+
+def configure_commands(executor=None, timeout=None):
+    """
+    Set how the commands of the current process are run by `run_command`
+
+    Keyword Args:
+        executor:  Executor that runs the commands as subprocesses of its
+                   event loop. If None, every command is run by the calling
+                   thread.
+                   (Type: executor.CommandExecutor or None)
+
+        timeout:   Number of seconds after which a command is killed. If
+                   None, no timeout.
+                   (Type: float or None)
+    """
+    _COMMAND_CONFIG['executor'] = executor
+    _COMMAND_CONFIG['timeout'] = timeout
+
+
+def get_command_executor():
+    """
+    Get the executor of the commands of the current process, if any
+
+    Returns:
+        executor:  Executor set with `configure_commands`
+                   (Type: executor.CommandExecutor or None)
+    """
+    return _COMMAND_CONFIG['executor']
+
+
+def get_command_timeout():
+    """
+    Get the timeout of the commands of the current process, if any
+
+    Returns:
+        timeout:  Timeout set with `configure_commands` (in seconds)
+                  (Type: float or None)
+    """
+    return _COMMAND_CONFIG['timeout']
+
+
+def start_command(cmd, **kwargs):
+    """
+    Start a command in its own process group, so that it never receives the
+    signals of the terminal and can be killed by `kill_running_commands`. It
+    must be passed to `finish_command` once it completed.
+
+    Args:
+        cmd:       List of strings used in the command
+                   (Type: list[str])
+
+        **kwargs:  Keyword arguments to be passed to subprocess.Popen()
+
+    Returns:
+        proc:  Process of the command
+               (Type: subprocess.Popen)
+    """
+    # Commands never read the terminal, e.g. ffmpeg would otherwise change
+    # its settings and leave them changed if it is killed
+    kwargs.setdefault('stdin', sp.DEVNULL)
+    kwargs.setdefault('start_new_session', True)
+    proc = sp.Popen(cmd, **kwargs)
+    _RUNNING_COMMANDS.add(proc)
+    return proc
+
+
+def finish_command(proc):
+    """
+    Forget a command started with `start_command` that completed
+
+    Args:
+        proc:  Process of the command
+               (Type: subprocess.Popen)
+    """
+    _RUNNING_COMMANDS.discard(proc)
+
+
+def kill_running_commands():
+    """
+    Kill the process groups of the commands started with `start_command` that
+    are still running in the current process
+    """
+    for proc in list(_RUNNING_COMMANDS):
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
 
 
 def run_command(cmd, **kwargs):
     """
     Run a command line command
 
+    The command is run by the executor set with `configure_commands`, if any,
+    and killed if it does not complete within the timeout set with it.
+
     Args:
         cmd:       List of strings used in the command
                    (Type: list[str])
 
-        **kwargs:  Keyword arguments to be passed to subprocess.Popen()
+        **kwargs:  Keyword arguments to be passed to subprocess.Popen(). The
+                   command is then run by the calling thread.
 
     Returns:
         stdout:       stdout string produced by running command
@@ -28,9 +157,21 @@ def run_command(cmd, **kwargs):
         return_code:  Exit/return code from running command
                       (Type: int)
     """
+    executor = get_command_executor()
+    timeout = get_command_timeout()
+    if executor is not None and not kwargs:
+        return executor.run(cmd, timeout=timeout)
+
     # print("RUN: " + " ".join(cmd), kwargs)
-    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, **kwargs)
-    stdout, stderr = proc.communicate()
+    proc = start_command(cmd, stdout=sp.PIPE, stderr=sp.PIPE, **kwargs)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except sp.TimeoutExpired:
+        proc.kill()
+        stdout, stderr = proc.communicate()
+        raise CommandTimeoutError(cmd, timeout, stdout.decode(), stderr.decode())
+    finally:
+        finish_command(proc)
 
     return_code = proc.returncode
 
@@ -40,6 +181,355 @@ def run_command(cmd, **kwargs):
     return stdout, stderr, return_code
 
 
+def is_http_error(e):
+    """
+    Returns True if the given error was caused by an HTTP 4XX or 5XX response,
+    either to ffmpeg or while resolving a video
+
+    Args:
+        e:  Error
+            (Type: Exception)
+
+    Returns:
+        is_http_error:  True, if the error was caused by an HTTP error response
+                        (Type: bool)
+    """
+    if isinstance(e, SubprocessError):
+        return bool(HTTP_ERR_PATTERN.search(e.cmd_stderr))
+    return bool(RESOLVE_HTTP_ERR_PATTERN.search(str(e)))
+
+
+def is_permanent_error(e):
+    """
+    Returns True if the given error means that a video cannot be downloaded
+    at all, e.g. because it was removed or is blocked, as opposed to a
+    transient error, such as a network issue or throttling, after which the
+    download can be tried again.
+
+    Args:
+        e:  Error
+            (Type: Exception)
+
+    Returns:
+        is_permanent:  True, if the error is permanent
+                       (Type: bool)
+    """
+    # Only the source knows whether a video is gone. Other errors, such as
+    # those of ffmpeg on a stream that was resolved successfully (e.g. because
+    # its URL expired) or of the validation of its outputs, are transient.
+    return isinstance(e, SourceUnavailableError) and e.permanent
+
+
+def get_backoff_delay(attempt, base_delay, max_delay):
+    """
+    Get the delay before retrying after a failed attempt, using exponential
+    backoff with full jitter, so that concurrent workers hitting the same
+    issue do not retry in lockstep
+
+    Args:
+        attempt:     Index of the failed attempt, starting at 0
+                     (Type: int)
+
+        base_delay:  Maximum delay (in seconds) after the first attempt
+                     (Type: float)
+
+        max_delay:   Maximum delay (in seconds) after any attempt
+                     (Type: float)
+
+    Returns:
+        delay:  Delay (in seconds)
+                (Type: float)
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def filter_ffmpeg_log(log, log_level):
+    """
+    Keep the messages of an ffmpeg log that was written with
+    `-loglevel level+<level>` up to the given level, without the level tags
+
+    Args:
+        log:        ffmpeg log
+                    (Type: str)
+
+        log_level:  Most verbose level that is kept
+                    (Type: str)
+
+    Returns:
+        filtered_log:  Filtered log
+                       (Type: str)
+    """
+    max_idx = FFMPEG_LOG_LEVELS.index(log_level)
+    lines = []
+    keep = True
+    for line in log.splitlines():
+        match = FFMPEG_LOG_LEVEL_PATTERN.match(line)
+        # Lines without a level tag continue the previous message
+        if match and match.group(1) in FFMPEG_LOG_LEVELS:
+            keep = FFMPEG_LOG_LEVELS.index(match.group(1)) <= max_idx
+            line = line[:match.start(1) - 1] + line[match.end():]
+        if keep:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_ffmpeg_stats(log):
+    """
+    Get the number of frames and samples encoded in each output from the
+    final statistics of an ffmpeg log written with `-loglevel level+verbose`
+
+    Args:
+        log:  ffmpeg log
+              (Type: str)
+
+    Returns:
+        stats:  List of stream statistics by output path, each a dict with
+                the keys 'type' ('audio', 'video', ...), 'frames' and
+                'samples' (None for non-audio streams)
+                (Type: dict[str, list[dict]])
+    """
+    stats = {}
+    streams = None
+    for line in log.splitlines():
+        match = FFMPEG_OUTPUT_FILE_PATTERN.match(line)
+        if match:
+            streams = stats.setdefault(match.group(1), [])
+            continue
+        match = FFMPEG_OUTPUT_STREAM_PATTERN.match(line)
+        if match and streams is not None:
+            samples = match.group(3)
+            streams.append({
+                'type': match.group(1),
+                'frames': int(match.group(2)),
+                'samples': int(samples) if samples is not None else None,
+            })
+    return stats
+
+
+def get_temp_prefix():
+    """
+    Get the prefix of the temporary files and directories of the current
+    process, which records its host and process ID so that they are only
+    removed once it exited (see `remove_temp_files`)
+
+    Returns:
+        temp_prefix:  Prefix of temporary file names
+                      (Type: str)
+    """
+    return '{}{}~{}~'.format(TEMP_PREFIX, socket.gethostname(), os.getpid())
+
+
+def get_temp_owner(name):
+    """
+    Get the host and the process ID of the process that wrote a temporary
+    file or directory
+
+    Args:
+        name:  Name of temporary file or directory
+               (Type: str)
+
+    Returns:
+        host:  Host name, or None if the name does not record it, e.g. if it
+               was written by an older version
+               (Type: str or None)
+
+        pid:   Process ID, or None if the name does not record it
+               (Type: int or None)
+    """
+    owner = name[len(TEMP_PREFIX):].split('~', 2)
+    if len(owner) < 3 or not owner[1].isdigit():
+        return None, None
+    return owner[0], int(owner[1])
+
+
+def is_process_running(pid):
+    """
+    Returns True if a process of the current host is running
+
+    Args:
+        pid:  Process ID
+              (Type: int)
+
+    Returns:
+        is_running:  True, if the process is running
+                     (Type: bool)
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user
+        return True
+    return True
+
+
+def get_temp_path(path):
+    """
+    Get a unique path for a temporary file next to the given path, with the
+    same extension, that is skipped when looking for outputs
+
+    Args:
+        path:  Path to output file
+               (Type: str)
+
+    Returns:
+        temp_path:  Path to temporary file
+                    (Type: str)
+    """
+    dirname, filename = os.path.split(path)
+    return os.path.join(dirname, '{}{}-{}'.format(get_temp_prefix(), uuid.uuid4().hex[:12],
+                                                  filename))
+
+
+def publish_file(temp_path, path):
+    """
+    Move a complete temporary file to its final path, so that readers either
+    see the whole file or no file at all, even if the host crashes
+
+    Args:
+        temp_path:  Path to temporary file
+                    (Type: str)
+
+        path:       Path to output file
+                    (Type: str)
+    """
+    fd = os.open(temp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(temp_path, path)
+    try:
+        dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on some platforms, e.g. Windows
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_atomic(path, data):
+    """
+    Write a file so that readers never observe it partially written
+
+    Args:
+        path:  Path to output file
+               (Type: str)
+
+        data:  Contents of the file
+               (Type: str)
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    temp_path = get_temp_path(path)
+    with open(temp_path, 'w') as f:
+        f.write(data)
+    publish_file(temp_path, path)
+
+
+def _get_mtime(entry, is_dir):
+    mtime = entry.stat(follow_symlinks=False).st_mtime
+    if is_dir:
+        # Files are written into temporary directories without modifying them
+        for child in os.scandir(entry.path):
+            mtime = max(mtime, child.stat(follow_symlinks=False).st_mtime)
+    return mtime
+
+
+def remove_temp_files(root_dir, min_age=None, include_own=False):
+    """
+    Remove the temporary files and directories under a directory that were
+    left behind by processes that exited, e.g. because they were killed.
+
+    Those of processes of the current host are removed once the processes
+    exited, since other processes, e.g. other tasks of a job array, may be
+    writing to the same directory. Whether the processes of other hosts, or
+    of older versions that did not record them, exited is unknown, so their
+    files are only removed once they were not modified for `min_age` seconds.
+
+    Args:
+        root_dir:     Path to directory
+                      (Type: str)
+
+    Keyword Args:
+        min_age:      Number of seconds after which the files and directories
+                      of processes that may be running elsewhere are removed.
+                      If None, they are kept.
+                      (Type: float or None)
+
+        include_own:  If True, also remove the files and directories of the
+                      current process, e.g. once it stopped its jobs
+                      (Type: bool)
+
+    Returns:
+        num_removed:  Number of removed files and directories
+                      (Type: int)
+    """
+    now = time.time()
+    hostname = socket.gethostname()
+    own_pid = os.getpid()
+    num_removed = 0
+    dirs = [root_dir]
+    while dirs:
+        try:
+            entries = list(os.scandir(dirs.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not entry.name.startswith(TEMP_PREFIX):
+                if is_dir:
+                    dirs.append(entry.path)
+                continue
+            try:
+                host, pid = get_temp_owner(entry.name)
+                if host == hostname:
+                    if pid == own_pid and not include_own:
+                        continue
+                    if pid != own_pid and is_process_running(pid):
+                        continue
+                elif min_age is None or now - _get_mtime(entry, is_dir) < min_age:
+                    continue
+                if is_dir:
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+                num_removed += 1
+            except FileNotFoundError:
+                # Removed by another process in the meantime
+                pass
+    return num_removed
+
+
+def link_file(src_path, dst_path):
+    """
+    Make a file available at another path without downloading it again, with
+    a hard link if possible and a copy otherwise, e.g. across filesystems
+
+    Args:
+        src_path:  Path to existing file
+                   (Type: str)
+
+        dst_path:  Path where the file is made available
+                   (Type: str)
+    """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        temp_path = get_temp_path(dst_path)
+        try:
+            shutil.copy2(src_path, temp_path)
+            publish_file(temp_path, dst_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
 def is_url(path):
     """
     Returns True if the given path is a URL.
@@ -72,29 +562,201 @@ def get_filename(path):
     return os.path.basename(path).split('?')[0]
 
 
-def get_media_filename(ytid, ts_start, ts_end, num_buckets=None):
+def get_bucket_dir(ytid, num_buckets, bucket_levels=1):
     """
-    Get the filename (without extension) for a media file (audio or video) for a YouTube video segment
+    Get the bucket directory of the media files of a YouTube video.
+
+    Buckets are derived from an MD5 digest of the YouTube ID, so that a video
+    is placed in the same bucket by every process and every run.
+
+    Args:
+        ytid:           YouTube ID of a video
+                        (Type: str)
+
+        num_buckets:    Number of buckets in each level
+                        (Type: int)
+
+    Keyword Args:
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+    Returns:
+        bucket_dir:  Relative path of the bucket directory, e.g. '012/345'
+                     (Type: str)
+    """
+    key = int.from_bytes(hashlib.md5(ytid.encode('utf-8')).digest()[:8], 'big')
+    indices = []
+    for _ in range(bucket_levels):
+        key, idx = divmod(key, num_buckets)
+        indices.append(idx)
+    return '/'.join('%03d' % idx for idx in indices)
+
+
+def iter_bucket_dirs(num_buckets, bucket_levels=1):
+    """
+    Iterate over all the bucket directories of a layout
+
+    Args:
+        num_buckets:    Number of buckets in each level
+                        (Type: int)
+
+    Keyword Args:
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+    Yields:
+        bucket_dir:  Relative path of a bucket directory
+                     (Type: str)
+    """
+    for indices in itertools.product(range(num_buckets), repeat=bucket_levels):
+        yield '/'.join('%03d' % idx for idx in indices)
+
+
+def read_layout(data_dir):
+    """
+    Read the bucket layout of the media files of a subset
+
+    Args:
+        data_dir:  Path to subset data directory
+                   (Type: str)
+
+    Returns:
+        layout:  Dictionary with the keys 'num_buckets', 'bucket_levels' and
+                 'naming' (missing if files are named by YouTube ID only), or
+                 None if the layout was never recorded
+                 (Type: dict or None)
+    """
+    layout_path = os.path.join(data_dir, LAYOUT_FILENAME)
+    if not os.path.exists(layout_path):
+        return None
+    with open(layout_path, 'r') as f:
+        return json.load(f)
+
+
+def get_layout(num_buckets, bucket_levels=1):
+    """
+    Get the description of a bucket layout
+
+    Args:
+        num_buckets:    Number of buckets in each level, or None if files
+                        are not bucketed
+                        (Type: int or None)
+
+    Keyword Args:
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+
+    Returns:
+        layout:  Dictionary with the keys 'num_buckets', 'bucket_levels' and
+                 'naming'
+                 (Type: dict)
+    """
+    return {'num_buckets': num_buckets or None,
+            'bucket_levels': bucket_levels if num_buckets else None,
+            'naming': MEDIA_NAMING}
+
+
+def write_layout(data_dir, num_buckets, bucket_levels=1):
+    """
+    Record the bucket layout of the media files of a subset
+
+    Args:
+        data_dir:       Path to subset data directory
+                        (Type: str)
+
+        num_buckets:    Number of buckets in each level, or None if files
+                        are not bucketed
+                        (Type: int or None)
+
+    Keyword Args:
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
+    """
+    layout = get_layout(num_buckets, bucket_levels)
+    write_atomic(os.path.join(data_dir, LAYOUT_FILENAME), json.dumps(layout) + '\n')
+
+
+def get_segment_key(ytid, ts_start, ts_end):
+    """
+    Get the key that identifies a segment in file and sample names
 
     Args:
         ytid:      YouTube ID of a video
                    (Type: str)
 
         ts_start:  Segment start time (in seconds)
-                   (Type: float or int)
+                   (Type: float)
 
         ts_end:    Segment end time (in seconds)
-                   (Type: float or int)
+                   (Type: float)
+
+    Returns:
+        key:  Segment key, of the format
+              <YouTube ID>_<start time in ms>_<end time in ms>
+              (Type: str)
+    """
+    return '{}_{}_{}'.format(ytid, int(round(ts_start * 1000)), int(round(ts_end * 1000)))
+
+
+def parse_segment_key(key):
+    """
+    Get the YouTube ID and times of a segment from its key
+
+    Args:
+        key:  Segment key, e.g. the name of a media file without extension
+              (Type: str)
+
+    Returns:
+        ytid:      YouTube ID of the video
+                   (Type: str)
+
+        ts_start:  Segment start time (in seconds), or None if the key is
+                   only a YouTube ID, as in the names of older files
+                   (Type: float or None)
+
+        ts_end:    Segment end time (in seconds), or None if the key is only
+                   a YouTube ID
+                   (Type: float or None)
+    """
+    match = MEDIA_KEY_PATTERN.match(key)
+    if not match:
+        return key, None, None
+    return match.group(1), int(match.group(2)) / 1000, int(match.group(3)) / 1000
+
+
+def get_media_filename(ytid, ts_start, ts_end, num_buckets=None, bucket_levels=1):
+    """
+    Get the filename (without extension) for a media file (audio or video) for a YouTube video segment
+
+    Every segment has its own files, even if it is cut from the same video as
+    other segments, while the bucket only depends on the YouTube ID.
+
+    Args:
+        ytid:           YouTube ID of a video
+                        (Type: str)
+
+        ts_start:       Segment start time (in seconds)
+                        (Type: float or int)
+
+        ts_end:         Segment end time (in seconds)
+                        (Type: float or int)
+
+    Keyword Args:
+        num_buckets:    Number of buckets in each level. If None, files are
+                        not bucketed.
+                        (Type: int or None)
+
+        bucket_levels:  Number of levels of nested buckets
+                        (Type: int)
 
     Returns:
         media_filename:  Filename (without extension) for segment media file
                          (Type: str)
     """
-    # tms_start, tms_end = int(ts_start * 1000), int(ts_end * 1000)
-    # return '{}_{}_{}'.format(ytid, tms_start, tms_end)
+    media_filename = get_segment_key(ytid, ts_start, ts_end)
     if num_buckets:
-        return "%03d/%s" % (hash(ytid) % num_buckets, ytid)
-    return ytid
+        return "%s/%s" % (get_bucket_dir(ytid, num_buckets, bucket_levels), media_filename)
+    return media_filename
 
 
 def get_subset_name(subset_path):
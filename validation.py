@@ -1,11 +1,18 @@
 import json
 import os.path
-import sox
+import re
 import soundfile as sf
 
-from errors import FfmpegValidationError, FfmpegIncorrectDurationError, FfmpegUnopenableFileError
+from errors import FfmpegValidationError, FfmpegIncorrectDurationError, \
+                   FfmpegUnopenableFileError, SubprocessError
 from utils import run_command
 
+# Number of frames decoded at the start and at the end of an audio file to
+# check that it can be decoded
+AUDIO_CHECK_FRAMES = 8192
+
+PCM_SUBTYPE_PATTERN = re.compile(r'PCM_S?(\d+)$')
+
 
 def ffprobe(ffprobe_path, filepath):
     """
@@ -28,10 +35,135 @@ def ffprobe(ffprobe_path, filepath):
     return json.loads(stdout)
 
 
-def validate_audio(audio_filepath, audio_info, end_past_video_end=False):
+def probe_video_stream(ffprobe_path, filepath):
+    """
+    Decode the first video stream of a file with ffprobe, counting its frames.
+
+    Frames are decoded one at a time and discarded, so memory use does not
+    depend on the length or resolution of the video.
+
+    Args:
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+        filepath:      Path to video file to analyse
+                       (Type: str)
+
+    Returns:
+        stream_info:    Stream info returned by ffprobe, including the number
+                        of decoded frames ('nb_read_frames'), or None if the
+                        file has no video stream
+                        (Type: dict or None)
+
+        decode_errors:  Errors reported while decoding the stream
+                        (Type: str)
+    """
+    cmd = [ffprobe_path, '-v', 'error', '-count_frames', '-select_streams', 'v:0',
+           '-print_format', 'json', '-show_streams', filepath]
+    stdout, stderr, retcode = run_command(cmd)
+    streams = json.loads(stdout.decode()).get('streams')
+    return (streams[0] if streams else None), stderr.decode().strip()
+
+
+def get_audio_info(audio_filepath, num_check_frames=AUDIO_CHECK_FRAMES):
+    """
+    Get basic info of an audio file in-process with libsndfile, and check
+    that it can be decoded by reading a few blocks at its start and its end.
+
+    The keys of the returned dict are the same as in the output of
+    `sox.file_info.info`, except that 'bitrate' is None for non-PCM
+    encodings and 'silent' is not included.
+
+    Args:
+        audio_filepath:    Path to audio file
+                           (Type: str)
+
+    Keyword Args:
+        num_check_frames:  Number of frames decoded at the start and at the
+                           end of the file
+                           (Type: int)
+
+    Returns:
+        info:  Audio info dict
+               (Type: dict[str, *])
+    """
+    with sf.SoundFile(audio_filepath) as f:
+        start_frames = min(f.frames, num_check_frames)
+        num_read = len(f.read(start_frames))
+        if f.frames > start_frames:
+            end_frames = min(f.frames - start_frames, num_check_frames)
+            f.seek(f.frames - end_frames)
+            num_read += len(f.read(end_frames))
+            start_frames += end_frames
+        if num_read < start_frames:
+            raise ValueError('Read {} frames instead of {}'.format(num_read, start_frames))
+
+        match = PCM_SUBTYPE_PATTERN.match(f.subtype)
+        return {
+            'bitrate': int(match.group(1)) if match else None,
+            'channels': f.channels,
+            'duration': f.frames / f.samplerate,
+            'encoding': f.format,
+            'num_samples': f.frames,
+            'sample_rate': float(f.samplerate),
+        }
+
+
+def check_duration(filepath, target_duration, count, rate, end_past_video_end=False):
+    """
+    Check the duration of an output from its number of samples or frames.
+
+    The counts are compared rather than the durations, which are not exact
+    when the segment boundaries are not multiples of the sample or frame
+    period.
+
+    Args:
+        filepath:         Path to output file
+                          (Type: str)
+
+        target_duration:  Expected duration (in seconds)
+                          (Type: float)
+
+        count:            Number of samples or frames of the output
+                          (Type: int)
+
+        rate:             Number of samples or frames per second
+                          (Type: float)
+
+    Keyword Args:
+        end_past_video_end:  If True, the output may be shorter than the
+                             target duration
+                             (Type: bool)
+    """
+    target_count = int(round(target_duration * rate))
+    if count != target_count:
+        if not(end_past_video_end and count < target_count):
+            raise FfmpegIncorrectDurationError(filepath, target_duration, count / rate)
+
+
+def can_validate_audio(audio_format):
+    """
+    Check whether audio files of the given format can be validated
+
+    Args:
+        audio_format:  Name of audio container format
+                       (Type: str)
+
+    Returns:
+        supported:  True if libsndfile can read the format
+                    (Type: bool)
+    """
+    return audio_format.upper() in sf.available_formats()
+
+
+def validate_audio(audio_filepath, audio_info, end_past_video_end=False, strict=False):
     """
     Take audio file and sanity check basic info.
 
+    By default, the info is read in-process with libsndfile and only a few
+    blocks of the file are decoded. In strict mode, the whole file is decoded
+    and the info is obtained with sox.
+
         Sample output from sox:
             {
                 'bitrate': 16,
@@ -50,6 +182,15 @@ def validate_audio(audio_filepath, audio_info, end_past_video_end=False):
         audio_info:       Audio info dict
                           (Type: dict[str, *])
 
+    Keyword Args:
+        end_past_video_end:  If True, the output may be shorter than the
+                             target duration
+                             (Type: bool)
+
+        strict:              If True, decode the whole file and get the info
+                             with sox
+                             (Type: bool)
+
     Returns:
         check_passed:  True if sanity check passed
                        (Type: bool)
@@ -58,27 +199,39 @@ def validate_audio(audio_filepath, audio_info, end_past_video_end=False):
         error_msg = 'Output file {} does not exist.'.format(audio_filepath)
         raise FfmpegValidationError(error_msg)
 
-    # Check to see if we can open the file
-    try:
-        sf.read(audio_filepath)
-    except Exception as e:
-        raise FfmpegUnopenableFileError(audio_filepath, e)
+    if strict:
+        import sox
 
-    sox_info = sox.file_info.info(audio_filepath)
+        # Check to see if we can open the file
+        try:
+            sf.read(audio_filepath)
+        except Exception as e:
+            raise FfmpegUnopenableFileError(audio_filepath, e)
+
+        file_info = sox.file_info.info(audio_filepath)
+    else:
+        # Check to see if we can open and decode the file
+        try:
+            file_info = get_audio_info(audio_filepath)
+        except Exception as e:
+            raise FfmpegUnopenableFileError(audio_filepath, e)
 
     # If duration specifically doesn't match, catch that separately so we can
     # retry with a different duration
-    target_duration = audio_info['duration']
-    actual_duration = sox_info['num_samples'] / audio_info['sample_rate']
-    if target_duration != actual_duration:
-        if not(end_past_video_end and actual_duration < target_duration):
-            raise FfmpegIncorrectDurationError(audio_filepath, target_duration,
-                                               actual_duration)
+    check_duration(audio_filepath, audio_info['duration'], file_info['num_samples'],
+                   audio_info['sample_rate'], end_past_video_end)
     for k, v in audio_info.items():
-        if k == 'duration' and (end_past_video_end and actual_duration < target_duration):
+        # The duration was checked from the number of samples
+        if k == 'duration':
             continue
 
-        output_v = sox_info[k]
+        output_v = file_info[k]
+        # libsndfile does not report the bit depth of compressed encodings,
+        # and names the container instead of the encoding, which are only
+        # comparable when they are the same, e.g. for FLAC
+        if not strict and (output_v is None
+                           or (k == 'encoding' and v not in sf.available_formats())):
+            continue
         if v != output_v:
             error_msg = 'Output audio {} should have {} = {}, but got {}.'.format(audio_filepath, k, v, output_v)
             raise FfmpegValidationError(error_msg)
@@ -88,6 +241,9 @@ def validate_video(video_filepath, ffprobe_path, video_info, end_past_video_end=
     """
     Take video file and sanity check basic info.
 
+    The video stream is decoded with a single ffprobe pass, which streams the
+    frames instead of loading them into memory.
+
     Args:
         video_filepath:  Path to output video file
                          (Type: str)
@@ -98,35 +254,28 @@ def validate_video(video_filepath, ffprobe_path, video_info, end_past_video_end=
         video_info:      Video info dictionary
                          (Type: str)
     """
-    import skvideo
-    import skvideo.io
-
     if not os.path.exists(video_filepath):
         error_msg = 'Output file {} does not exist.'.format(video_filepath)
         raise FfmpegValidationError(error_msg)
 
-    skvideo.setFFmpegPath(os.path.dirname(ffprobe_path))
-
-    # Check to see if we can open the file
+    # Check to see if we can open and decode the file
     try:
-        skvideo.io.vread(video_filepath)
-    except Exception as e:
+        ffprobe_info, decode_errors = probe_video_stream(ffprobe_path, video_filepath)
+    except (SubprocessError, ValueError) as e:
         raise FfmpegUnopenableFileError(video_filepath, e)
 
-    ffprobe_info = ffprobe(ffprobe_path, video_filepath)
-    if not ffprobe_info:
-        error_msg = 'Could not analyse {} with ffprobe'
-        raise FfmpegValidationError(error_msg.format(video_filepath))
-
     # Get the video stream data
-    if not ffprobe_info.get('streams'):
+    if not ffprobe_info:
         error_msg = '{} has no video streams!'
         raise FfmpegValidationError(error_msg.format(video_filepath))
-    ffprobe_info = next(stream for stream in ffprobe_info['streams'] if stream['codec_type'] == 'video')
 
-    # If duration specifically doesn't match, catch that separately so we can
-    # retry with a different duration
-    target_duration = video_info['duration']
+    num_read_frames = int(ffprobe_info.get('nb_read_frames', 0))
+    num_frames = int(ffprobe_info.get('nb_frames', num_read_frames))
+    if decode_errors or num_read_frames < num_frames:
+        error_msg = 'decoded {} of {} frames. {}'.format(num_read_frames, num_frames,
+                                                         decode_errors)
+        raise FfmpegUnopenableFileError(video_filepath, error_msg.strip())
+
     try:
         actual_fr_ratio = ffprobe_info.get('r_frame_rate',
                                            ffprobe_info['avg_frame_rate'])
@@ -135,14 +284,14 @@ def validate_video(video_filepath, ffprobe_path, video_info, end_past_video_end=
     except KeyError:
         error_msg = 'Could not get frame rate from {}'
         raise FfmpegValidationError(error_msg.format(video_filepath))
-    actual_duration = float(ffprobe_info['nb_frames']) / actual_framerate
-    if target_duration != actual_duration:
-        if not(end_past_video_end and actual_duration < target_duration):
-            raise FfmpegIncorrectDurationError(video_filepath, target_duration,
-                                               actual_duration)
+    # If duration specifically doesn't match, catch that separately so we can
+    # retry with a different duration
+    check_duration(video_filepath, video_info['duration'], num_frames, actual_framerate,
+                   end_past_video_end)
 
     for k, v in video_info.items():
-        if k == 'duration' and (end_past_video_end and actual_duration < target_duration):
+        # The duration was checked from the number of frames
+        if k == 'duration':
             continue
 
         output_v = ffprobe_info[k]
@@ -161,3 +310,87 @@ def validate_video(video_filepath, ffprobe_path, video_info, end_past_video_end=
             error_msg = 'Output video {} should have {} = {}, but got {}.'.format(video_filepath, k, v, output_v)
             raise FfmpegValidationError(error_msg)
 
+
+def _get_stream_stats(filepath, stats, stream_type):
+    if not os.path.exists(filepath):
+        error_msg = 'Output file {} does not exist.'.format(filepath)
+        raise FfmpegValidationError(error_msg)
+
+    stream_stats = next((stream for stream in stats if stream['type'] == stream_type), None)
+    if stream_stats is None or not stream_stats['frames']:
+        error_msg = 'ffmpeg did not encode any {} frames in {}'
+        raise FfmpegValidationError(error_msg.format(stream_type, filepath))
+    return stream_stats
+
+
+def validate_audio_stats(audio_filepath, stats, audio_info, end_past_video_end=False,
+                         **kwargs):
+    """
+    Sanity check the duration of an audio output from the number of samples
+    that ffmpeg reported encoding, without opening the file.
+
+    Args:
+        audio_filepath:  Path to output audio
+                         (Type: str)
+
+        stats:           Statistics of the streams of the output, as returned
+                         by `utils.parse_ffmpeg_stats`
+                         (Type: list[dict])
+
+        audio_info:      Audio info dict
+                         (Type: dict[str, *])
+
+    Keyword Args:
+        end_past_video_end:  If True, the output may be shorter than the
+                             target duration
+                             (Type: bool)
+
+        **kwargs:            Other arguments of `validate_audio`, which are
+                             ignored
+    """
+    stream_stats = _get_stream_stats(audio_filepath, stats, 'audio')
+    if stream_stats['samples'] is None:
+        error_msg = 'ffmpeg did not report the number of samples encoded in {}'
+        raise FfmpegValidationError(error_msg.format(audio_filepath))
+
+    check_duration(audio_filepath, audio_info['duration'], stream_stats['samples'],
+                   audio_info['sample_rate'], end_past_video_end)
+
+
+def validate_video_stats(video_filepath, stats, video_info, end_past_video_end=False,
+                         **kwargs):
+    """
+    Sanity check the duration of a video output from the number of frames
+    that ffmpeg reported encoding, without opening the file.
+
+    Args:
+        video_filepath:  Path to output video file
+                         (Type: str)
+
+        stats:           Statistics of the streams of the output, as returned
+                         by `utils.parse_ffmpeg_stats`
+                         (Type: list[dict])
+
+        video_info:      Video info dictionary
+                         (Type: dict[str, *])
+
+    Keyword Args:
+        end_past_video_end:  If True, the output may be shorter than the
+                             target duration
+                             (Type: bool)
+
+        **kwargs:            Other arguments of `validate_video`, which are
+                             ignored
+    """
+    stream_stats = _get_stream_stats(video_filepath, stats, 'video')
+    fr_num, fr_den = video_info['r_frame_rate'].split('/')
+    check_duration(video_filepath, video_info['duration'], stream_stats['frames'],
+                   float(fr_num) / float(fr_den), end_past_video_end)
+
+
+# Validation callbacks that check the statistics reported by ffmpeg in place
+# of each callback that analyses the output file
+STATS_VALIDATORS = {
+    validate_audio: validate_audio_stats,
+    validate_video: validate_video_stats,
+}
@@ -0,0 +1,561 @@
+"""
+Downloads the audio and video of a segment of a YouTube video
+"""
+import logging
+import os
+import time
+
+from cache import get_stream_cache
+from sources import get_source_backend
+from transcode import ffmpeg, ffmpeg_pcm
+from utils import get_media_filename, is_permanent_error, get_backoff_delay, get_temp_path
+from validation import can_validate_audio, validate_audio, validate_video
+
+LOGGER = logging.getLogger('audiosetdl')
+
+# Number of attempts to resolve the streams of a video
+NUM_RESOLVE_RETRIES = 3
+
+
+def resolve_video(ytid, ffprobe_path, video_mode='bestvideoaudio', source='pafy',
+                  stream_cache_path=None, stream_cache_ttl=14400, stream_cache_size=100000,
+                  retry_backoff=1.0, retry_backoff_max=60.0):
+    """
+    Resolve the streams of a YouTube video with the source backend, through
+    the stream cache if one is given
+
+    Args:
+        ytid:               Youtube ID string
+                            (Type: str)
+
+        ffprobe_path:       Path to ffprobe executable
+                            (Type: str)
+
+    Keyword Args:
+        video_mode:         Name of the method in which video is downloaded
+                            (Type: str)
+
+        source:             'pafy' to resolve videos on YouTube, or a local
+                            directory or HTTP base URL with pre-staged media
+                            (Type: str)
+
+        stream_cache_path:  Path to the stream cache database. If None, the
+                            streams are always resolved.
+                            (Type: str or None)
+
+        stream_cache_ttl:   Maximum number of seconds resolved stream URLs
+                            are cached
+                            (Type: float)
+
+        stream_cache_size:  Maximum number of videos in the stream cache
+                            (Type: int)
+
+        retry_backoff:      Maximum delay (in seconds) before retrying after
+                            the first failure, doubling after every failure
+                            (Type: float)
+
+        retry_backoff_max:  Maximum delay (in seconds) before any retry
+                            (Type: float)
+
+    Returns:
+        streams:  Resolved streams
+                  (Type: cache.ResolvedStreams)
+    """
+    stream_cache = None
+    if stream_cache_path:
+        stream_cache = get_stream_cache(stream_cache_path, ttl=stream_cache_ttl,
+                                        max_entries=stream_cache_size)
+    return resolve_yt_streams(ytid, video_mode, get_source_backend(source, ffprobe_path),
+                              stream_cache=stream_cache, num_retries=NUM_RESOLVE_RETRIES,
+                              retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max)
+
+
+def resolve_yt_streams(ytid, video_mode, source, stream_cache=None, num_retries=1,
+                       retry_backoff=0.0, retry_backoff_max=60.0):
+    """
+    Get the length of a YouTube video and the locations of the streams used
+    to obtain its audio and video.
+
+    Args:
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        video_mode:    Name of the method in which video is downloaded
+                       (Type: str)
+
+        source:        Source backend used to resolve the video
+                       (Type: sources.SourceBackend)
+
+    Keyword Args:
+        stream_cache:       Cache of resolved streams. If given, the streams
+                            are only resolved if they are not in the cache.
+                            (Type: cache.StreamCache or None)
+
+        num_retries:        Number of attempts to resolve the streams. Errors
+                            that are permanent are not retried.
+                            (Type: int)
+
+        retry_backoff:      Maximum delay (in seconds) before retrying after
+                            the first failure, doubling after every failure
+                            (Type: float)
+
+        retry_backoff_max:  Maximum delay (in seconds) before any retry
+                            (Type: float)
+
+    Returns:
+        streams:  Resolved streams
+                  (Type: cache.ResolvedStreams)
+    """
+    if video_mode not in ('bestvideo', 'bestvideowithaudio', 'novideo',
+                          'bestvideoaudio', 'bestvideoaudionoaudio'):
+        raise ValueError('Invalid video mode: {}'.format(video_mode))
+
+    if stream_cache is not None:
+        streams = stream_cache.get(ytid, video_mode)
+        if streams is not None:
+            return streams
+
+    for attempt in range(num_retries):
+        try:
+            streams = source.resolve(ytid, video_mode)
+            break
+        except Exception as e:
+            if is_permanent_error(e) or attempt == num_retries - 1:
+                raise
+            delay = get_backoff_delay(attempt, retry_backoff, retry_backoff_max)
+            LOGGER.info('Could not resolve video {}: {}. Retrying in {:.1f} seconds...'.format(
+                ytid, e, delay))
+            time.sleep(delay)
+
+    if stream_cache is not None:
+        stream_cache.put(video_mode, streams)
+
+    return streams
+
+
+def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_path, num_buckets,
+                      audio_codec='flac', audio_format='flac',
+                      audio_sample_rate=48000, audio_bit_depth=16,
+                      video_codec='h264', video_format='mp4',
+                      video_mode='bestvideoaudio', video_frame_rate=30,
+                      num_retries=10, fuse_outputs=True, stream_cache_path=None,
+                      stream_cache_ttl=14400, stream_cache_size=100000, source='pafy',
+                      retry_backoff=1.0, retry_backoff_max=60.0, streams=None,
+                      absolute_seek=False, exact_trim=False, strict_validation=False,
+                      validate_from_stats=False, spot_check_rate=0.1, bucket_levels=1,
+                      timings=None, retries=None, errors=None):
+    """
+    Download a Youtube video (with the audio and video separated).
+
+    The audio will be saved in <output_dir>/audio and the video will be saved in
+    <output_dir>/video.
+
+    The output filename is of the format:
+        <YouTube ID>_<start time in ms>_<end time in ms>.<extension>
+
+    Args:
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        ts_start:      Segment start time (in seconds)
+                       (Type: float)
+
+        ts_start:      Segment end time (in seconds)
+                       (Type: float)
+
+        output_dir:    Output directory where video will be saved
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Keyword Args:
+        audio_codec:        Name of audio codec used by ffmpeg to encode
+                            output audio
+                            (Type: str)
+
+        audio_format:       Name of audio container format used for output audio
+                            (Type: str)
+
+        audio_sample_rate:  Target audio sample rate (in Hz)
+                            (Type: int)
+
+        audio_bit_depth:    Target audio sample bit depth
+                            (Type: int)
+
+        video_codec:        Name of video codec used by ffmpeg to encode
+                            output video
+                            (Type: str)
+
+        video_format:       Name of video container format used for output video
+                            (Type: str)
+
+        video_mode:         Name of the method in which video is downloaded.
+                            'bestvideo' obtains the best quality video that does not
+                            contain an audio stream. 'bestvideoaudio' obtains the
+                            best quality video that contains an audio stream.
+                            'bestvideowithaudio' obtains the best quality video
+                            without an audio stream and merges it with audio stream.
+                            (Type: bool)
+
+        video_frame_rate:   Target video frame rate (in fps)
+                            (Type: int)
+
+        num_retries:        Number of attempts to download and process an audio
+                            or video file with ffmpeg
+                            (Type: int)
+
+        fuse_outputs:       If True, extract the audio and the video with a
+                            single ffmpeg process that reads both the best
+                            audio stream and the video stream, except in the
+                            'bestvideowithaudio' mode. Otherwise, each output
+                            is obtained in a separate pass.
+                            (Type: bool)
+
+        stream_cache_path:  Path to the stream cache database. If None,
+                            stream URLs are resolved for every segment.
+                            (Type: str or None)
+
+        stream_cache_ttl:   Maximum number of seconds resolved stream URLs
+                            are cached
+                            (Type: float)
+
+        stream_cache_size:  Maximum number of videos in the stream cache
+                            (Type: int)
+
+        source:             'pafy' to resolve videos on YouTube, or a local
+                            directory or HTTP base URL with pre-staged media
+                            (Type: str)
+
+        retry_backoff:      Maximum delay (in seconds) before retrying after
+                            the first transient failure to resolve the video
+                            or to run ffmpeg, doubling after every failure
+                            (Type: float)
+
+        retry_backoff_max:  Maximum delay (in seconds) before any retry
+                            (Type: float)
+
+        streams:            Streams of the video if they were already
+                            resolved. If None, they are resolved here.
+                            (Type: cache.ResolvedStreams or None)
+
+        absolute_seek:      If True, the segment start time is a timestamp of
+                            the inputs instead of an offset from their start,
+                            e.g. for spans fetched with `fetch_stream_span`
+                            (Type: bool)
+
+        exact_trim:         If True, stop the outputs after the number of
+                            samples and frames in the segment, instead of
+                            only relying on its duration
+                            (Type: bool)
+
+        strict_validation:  If True, decode the whole audio output and get its
+                            info with sox to validate it
+                            (Type: bool)
+
+        validate_from_stats:
+                            If True, validate the outputs from the number of
+                            frames and samples that ffmpeg reports encoding
+                            (Type: bool)
+
+        spot_check_rate:    If validating the outputs from the ffmpeg
+                            statistics, fraction of the outputs that are also
+                            analysed by the full validation
+                            (Type: float)
+
+        bucket_levels:      Number of levels of nested buckets of the
+                            outputs, if they are bucketed
+                            (Type: int)
+
+        timings:            If given, the number of seconds spent in each
+                            stage ('resolve', 'audio', 'video', 'audio_video',
+                            'merge' and validation) is added to it
+                            (Type: dict[str, float] or None)
+
+        retries:            If given, the number of ffmpeg retries in each
+                            stage is added to it
+                            (Type: collections.Counter or None)
+
+        errors:             If given, the number of failed ffmpeg attempts
+                            is added to it, by kind of error
+                            (Type: collections.Counter or None)
+
+    Returns:
+        video_filepath:  Filepath to video file
+                         (Type: str)
+
+        audio_filepath:  Filepath to audio file
+                         (Type: str)
+    """
+    # Compute some things from the segment boundaries
+    duration = ts_end - ts_start
+
+    # Make the output format and video URL
+    # Output format is in the format:
+    #   <YouTube ID>_<start time in ms>_<end time in ms>.<extension>
+    media_filename = get_media_filename(ytid, ts_start, ts_end, num_buckets, bucket_levels)
+    video_filepath = os.path.join(output_dir, 'video', media_filename + '.' + video_format)
+    audio_filepath = os.path.join(output_dir, 'audio', media_filename + '.' + audio_format)
+
+    # Get the direct URLs to the videos with best audio and with best video (with audio)
+    if timings is None:
+        timings = {}
+
+    if streams is None:
+        start_time = time.time()
+        streams = resolve_video(ytid, ffprobe_path, video_mode=video_mode, source=source,
+                                stream_cache_path=stream_cache_path,
+                                stream_cache_ttl=stream_cache_ttl,
+                                stream_cache_size=stream_cache_size,
+                                retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max)
+        timings['resolve'] = time.time() - start_time
+    video_duration = streams.duration
+    end_past_video_end = False
+    if ts_end > video_duration:
+        warn_msg = "End time for segment ({} - {}) of video {} extends past end of video (length {} sec)"
+        LOGGER.warning(warn_msg.format(ts_start, ts_end, ytid, video_duration))
+        duration = video_duration - ts_start
+        ts_end = ts_start + duration
+        end_past_video_end = True
+
+    best_video_url = streams.video_url
+    best_audio_url = streams.audio_url
+
+    audio_info = {
+        'sample_rate': audio_sample_rate,
+        'channels': 1,  # 2,
+        'bitrate': audio_bit_depth,
+        'encoding': audio_codec.upper(),
+        'duration': duration
+    }
+    video_info = {
+        "r_frame_rate": "{}/1".format(video_frame_rate),
+        "avg_frame_rate": "{}/1".format(video_frame_rate),
+        'codec_name': video_codec.lower(),
+        'duration': duration
+    }
+    seek_args = ['-seek_timestamp', '1'] if absolute_seek else []
+    audio_input_args = ['-n'] + seek_args + ['-ss', str(ts_start)]
+    audio_output_args = ['-t', str(duration),
+                         '-ar', str(audio_sample_rate),
+                         '-vn',
+                         '-ac', str(audio_info['channels']),
+                         # '-sample_fmt', 's{}'.format(audio_bit_depth),
+                         '-f', audio_format,
+                         '-acodec', audio_codec]
+    if audio_codec == 'flac':
+        # The FLAC encoder keeps 16 bits of s16 samples and 24 bits of s32
+        # samples, and would otherwise write 24 bits for decoded float audio
+        audio_output_args += ['-sample_fmt', 's16' if audio_bit_depth <= 16 else 's32']
+    if exact_trim:
+        # Cut the audio after the number of samples that the validation
+        # expects. It is resampled first, since the sample rate set with
+        # `-ar` only applies after the filters.
+        num_samples = int(round(duration * audio_sample_rate))
+        audio_output_args += ['-af', 'aresample={},atrim=end_sample={}'.format(
+            audio_sample_rate, num_samples)]
+    audio_validation_args = {'audio_info': audio_info,
+                             'end_past_video_end': end_past_video_end,
+                             'strict': strict_validation}
+    # The audio is validated in-process with libsndfile, which cannot read
+    # every container format
+    audio_validation_callback = validate_audio if can_validate_audio(audio_format) else None
+
+    video_input_args = ['-n'] + seek_args + ['-ss', str(ts_start)]
+    video_output_args = ['-t', str(duration),
+                         '-f', video_format,
+                         '-r', str(video_frame_rate),
+                         '-vcodec', video_codec]
+    # Suppress audio stream if we don't want to audio in the video
+    if video_mode in ('bestvideo', 'bestvideoaudionoaudio'):
+        video_output_args.append('-an')
+    elif exact_trim:
+        video_output_args += ['-af', 'atrim=duration={}'.format(duration)]
+    if exact_trim:
+        # Stop after the number of frames that the validation expects
+        num_frames = int(round(duration * video_frame_rate))
+        video_output_args += ['-frames:v', str(num_frames)]
+    video_validation_args = {'ffprobe_path': ffprobe_path,
+                             'video_info': video_info,
+                             'end_past_video_end': end_past_video_end}
+
+    # Both outputs are written by one ffmpeg process, which reads the best
+    # audio stream and the video stream as two inputs (or one, if they are
+    # the same) and maps each to its output. If one of the outputs already
+    # exists, fall back to separate passes so that `-n` only skips the output
+    # that exists.
+    fused = fuse_outputs \
+        and video_mode in ('bestvideo', 'bestvideoaudio', 'bestvideoaudionoaudio') \
+        and not os.path.exists(audio_filepath) \
+        and not os.path.exists(video_filepath)
+
+    if fused:
+        if best_audio_url == best_video_url:
+            fused_input = best_video_url
+            audio_map_args, video_map_args = [], []
+        else:
+            fused_input = [best_video_url, best_audio_url]
+            audio_map_args = ['-map', '1:a:0']
+            video_map_args = ['-map', '0:v:0']
+            if video_mode == 'bestvideoaudio':
+                # The video keeps the audio of its own stream, if it has any
+                video_map_args += ['-map', '0:a:0?']
+
+        # Download the audio and the video
+        ffmpeg(ffmpeg_path, fused_input, audio_filepath,
+               input_args=audio_input_args, output_args=audio_map_args + audio_output_args,
+               num_retries=num_retries, validation_callback=audio_validation_callback,
+               validation_args=audio_validation_args,
+               extra_outputs=[(video_filepath, video_map_args + video_output_args,
+                               validate_video, video_validation_args)],
+               timings=timings, timing_key='audio_video',
+               retries=retries, errors=errors, retry_backoff=retry_backoff,
+               retry_backoff_max=retry_backoff_max,
+               validate_from_stats=validate_from_stats, spot_check_rate=spot_check_rate)
+    else:
+        # Download the audio
+        ffmpeg(ffmpeg_path, best_audio_url, audio_filepath,
+               input_args=audio_input_args, output_args=audio_output_args,
+               num_retries=num_retries, validation_callback=audio_validation_callback,
+               validation_args=audio_validation_args,
+               timings=timings, timing_key='audio',
+               retries=retries, errors=errors, retry_backoff=retry_backoff,
+               retry_backoff_max=retry_backoff_max,
+               validate_from_stats=validate_from_stats, spot_check_rate=spot_check_rate)
+
+    if video_mode == 'novideo':
+        video_filepath = None
+    elif fused:
+        pass
+    elif video_mode != 'bestvideowithaudio':
+        # Download the video
+        ffmpeg(ffmpeg_path, best_video_url, video_filepath,
+               input_args=video_input_args, output_args=video_output_args,
+               num_retries=num_retries, validation_callback=validate_video,
+               validation_args=video_validation_args,
+               timings=timings, timing_key='video',
+               retries=retries, errors=errors, retry_backoff=retry_backoff,
+               retry_backoff_max=retry_backoff_max,
+               validate_from_stats=validate_from_stats, spot_check_rate=spot_check_rate)
+    elif os.path.exists(video_filepath):
+        LOGGER.info('ffmpeg output file "{}" already exists.'.format(video_filepath))
+    else:
+        # Download the best quality video, in lossless encoding
+        if video_codec != 'h264':
+            error_msg = 'Not currently supporting merging of best quality video with video for codec: {}'
+            raise NotImplementedError(error_msg.format(video_codec))
+        video_input_args = ['-n'] + seek_args + ['-ss', str(ts_start)]
+        video_output_args = ['-t', str(duration),
+                             '-f', video_format,
+                             '-crf', '0',
+                             '-preset', 'medium',
+                             '-r', str(video_frame_rate),
+                             '-an',
+                             '-vcodec', video_codec]
+        if exact_trim:
+            video_output_args += ['-frames:v', str(num_frames)]
+
+        # The lossless video is only an input of the merge, so it is kept in
+        # a temporary file, and the merged video is published at the output
+        # path
+        lossless_video_filepath = get_temp_path(video_filepath)
+        try:
+            ffmpeg(ffmpeg_path, best_video_url, lossless_video_filepath,
+                   input_args=video_input_args, output_args=video_output_args,
+                   num_retries=num_retries, timings=timings, timing_key='video',
+                   retries=retries, errors=errors, retry_backoff=retry_backoff,
+                   retry_backoff_max=retry_backoff_max)
+
+            # Merge the best lossless video with the lossless audio, and compress
+            video_input_args = ['-n']
+            video_output_args = ['-f', video_format,
+                                 '-r', str(video_frame_rate),
+                                 '-vcodec', video_codec,
+                                 '-acodec', 'aac',
+                                 '-ar', str(audio_sample_rate),
+                                 '-ac', str(audio_info['channels']),
+                                 '-strict', 'experimental']
+
+            ffmpeg(ffmpeg_path, [lossless_video_filepath, audio_filepath], video_filepath,
+                   input_args=video_input_args, output_args=video_output_args,
+                   num_retries=num_retries, validation_callback=validate_video,
+                   validation_args=video_validation_args,
+                   timings=timings, timing_key='merge',
+                   retries=retries, errors=errors, retry_backoff=retry_backoff,
+                   retry_backoff_max=retry_backoff_max,
+                   validate_from_stats=validate_from_stats, spot_check_rate=spot_check_rate)
+        finally:
+            if os.path.exists(lossless_video_filepath):
+                os.remove(lossless_video_filepath)
+
+    LOGGER.info('Downloaded video {} ({} - {})'.format(ytid, ts_start, ts_end))
+
+    return video_filepath, audio_filepath
+
+
+def stream_yt_audio(ytid, ts_start, ts_end, ffmpeg_path, ffprobe_path,
+                    audio_sample_rate=48000, video_mode='bestvideoaudio', num_retries=10,
+                    stream_cache_path=None, stream_cache_ttl=14400, stream_cache_size=100000,
+                    source='pafy', retry_backoff=1.0, retry_backoff_max=60.0, streams=None,
+                    absolute_seek=False, timings=None, retries=None, errors=None,
+                    **ffmpeg_cfg):
+    """
+    Decode the mono audio of a segment of a YouTube video into memory, without
+    writing any file
+
+    Args:
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        ts_start:      Segment start time (in seconds)
+                       (Type: float)
+
+        ts_end:        Segment end time (in seconds)
+                       (Type: float)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Keyword Args:
+        The same as `download_yt_video`. The options of the audio and video
+        files are ignored.
+
+    Returns:
+        samples:  16-bit samples of the segment, of shape (frames, 1)
+                  (Type: numpy.ndarray)
+    """
+    if timings is None:
+        timings = {}
+
+    if streams is None:
+        start_time = time.time()
+        streams = resolve_video(ytid, ffprobe_path, video_mode=video_mode, source=source,
+                                stream_cache_path=stream_cache_path,
+                                stream_cache_ttl=stream_cache_ttl,
+                                stream_cache_size=stream_cache_size,
+                                retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max)
+        timings['resolve'] = time.time() - start_time
+
+    end_past_video_end = ts_end > streams.duration
+    if end_past_video_end:
+        warn_msg = "End time for segment ({} - {}) of video {} extends past end of video " \
+                   "(length {} sec)"
+        LOGGER.warning(warn_msg.format(ts_start, ts_end, ytid, streams.duration))
+        ts_end = streams.duration
+
+    seek_args = ['-seek_timestamp', '1'] if absolute_seek else []
+    samples = ffmpeg_pcm(ffmpeg_path, streams.audio_url,
+                         int(round((ts_end - ts_start) * audio_sample_rate)), audio_sample_rate,
+                         input_args=seek_args + ['-ss', str(ts_start)],
+                         num_retries=num_retries, end_past_video_end=end_past_video_end,
+                         timings=timings, timing_key='audio', retries=retries, errors=errors,
+                         retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max)
+
+    LOGGER.info('Streamed audio of video {} ({} - {})'.format(ytid, ts_start, ts_end))
+    return samples
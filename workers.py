@@ -0,0 +1,360 @@
+"""
+Pool workers that download the segments of a video
+"""
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import time
+import traceback as tb
+
+from cache import get_stream_cache
+from errors import SubprocessError
+from features import get_segment_feature_extractor, extract_segment_features
+from scheduler import SegmentResult, CompletedTask
+from spans import get_segment_spans, fetch_stream_span
+from utils import is_http_error, is_permanent_error, get_temp_prefix
+from videos import resolve_video, download_yt_video, stream_yt_audio
+
+LOGGER = logging.getLogger('audiosetdl')
+
+
+def segment_resolve_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
+                           ffprobe_path, num_buckets, video_mode='bestvideoaudio',
+                           stream_cache_path=None, stream_cache_ttl=14400,
+                           stream_cache_size=100000, source='pafy', retry_backoff=1.0,
+                           retry_backoff_max=60.0, **ffmpeg_cfg):
+    """
+    Resolver stage worker that resolves the streams of a video segment.
+
+    Args:
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        ts_start:      Segment start time (in seconds)
+                       (Type: float)
+
+        ts_end:        Segment end time (in seconds)
+                       (Type: float)
+
+        data_dir:      Directory where videos will be saved
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Keyword Args:
+        **ffmpeg_cfg:  Configuration for audio and video
+                       downloading and decoding done by ffmpeg
+                       (Type: dict[str, *])
+
+    Returns:
+        worker_args:  Arguments for `segment_mp_worker`, or the failed status
+                      of the segment if its streams could not be resolved
+                      (Type: list or scheduler.CompletedTask)
+    """
+    start_time = time.time()
+    try:
+        streams = resolve_video(ytid, ffprobe_path, video_mode=video_mode, source=source,
+                                stream_cache_path=stream_cache_path,
+                                stream_cache_ttl=stream_cache_ttl,
+                                stream_cache_size=stream_cache_size,
+                                retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max)
+    except Exception as e:
+        err_msg = 'Error while resolving video {}: {}; {}'.format(ytid, e, tb.format_exc())
+        LOGGER.error(err_msg)
+        elapsed = time.time() - start_time
+        return CompletedTask(SegmentResult(ytid, ts_start, ts_end, False,
+                                           type(e).__name__, str(e), elapsed=elapsed,
+                                           timings={'resolve': elapsed},
+                                           http_errors=int(is_http_error(e)),
+                                           permanent=is_permanent_error(e)))
+
+    return [ytid, ts_start, ts_end, data_dir, ffmpeg_path, ffprobe_path,
+            num_buckets, streams, {'resolve': time.time() - start_time}]
+
+
+def segment_mp_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
+                      ffprobe_path, num_buckets, streams=None, timings=None,
+                      stream_audio=False, **ffmpeg_cfg):
+    """
+    Pool worker that downloads video segments.o
+
+    Wraps around the download_yt_video function to catch errors and log them.
+
+    Args:
+
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        ts_start:      Segment start time (in seconds)
+                       (Type: float)
+
+        ts_end:        Segment end time (in seconds)
+                       (Type: float)
+
+        data_dir:      Directory where videos will be saved
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Keyword Args:
+        streams:       Streams of the video if they were already resolved
+                       (Type: cache.ResolvedStreams or None)
+
+        timings:       Time spent in stages that already ran for this segment
+                       (Type: dict[str, float] or None)
+
+        stream_audio:  If True, the audio is decoded into memory and returned
+                       in the result instead of being written to a file, and
+                       the video is not downloaded
+                       (Type: bool)
+
+        **ffmpeg_cfg:  Configuration for audio and video
+                       downloading and decoding done by ffmpeg
+                       (Type: dict[str, *])
+
+    Returns:
+        result:  Download status of the segment
+                 (Type: scheduler.SegmentResult)
+    """
+    LOGGER.info('Attempting to download video {} ({} - {})'.format(ytid, ts_start, ts_end))
+    start_time = time.time()
+    timings = dict(timings or {})
+    retries = collections.Counter()
+    errors = collections.Counter()
+
+    # Download the video
+    samples = None
+    try:
+        if stream_audio:
+            samples = stream_yt_audio(ytid, ts_start, ts_end, ffmpeg_path, ffprobe_path,
+                                      streams=streams, timings=timings, retries=retries,
+                                      errors=errors, **ffmpeg_cfg)
+            video_filepath, audio_filepath = None, None
+        else:
+            video_filepath, audio_filepath = download_yt_video(
+                ytid, ts_start, ts_end, data_dir, ffmpeg_path, ffprobe_path,
+                num_buckets, streams=streams, timings=timings, retries=retries,
+                errors=errors, **ffmpeg_cfg)
+    except SubprocessError as e:
+        err_msg = 'Error while downloading video {}: {}; {}'.format(ytid, e, tb.format_exc())
+        LOGGER.error(err_msg)
+        # The cached stream URLs may have been rejected, so resolve them again
+        # next time
+        if ffmpeg_cfg.get('stream_cache_path') and is_http_error(e):
+            get_stream_cache(ffmpeg_cfg['stream_cache_path']).invalidate(ytid)
+        return SegmentResult(ytid, ts_start, ts_end, False, type(e).__name__, str(e),
+                             elapsed=time.time() - start_time, timings=timings,
+                             retries=sum(retries.values()), http_errors=errors['http'],
+                             permanent=False)
+    except Exception as e:
+        err_msg = 'Error while processing video {}: {}; {}'.format(ytid, e, tb.format_exc())
+        LOGGER.error(err_msg)
+        # Errors raised while resolving the video are not counted by ffmpeg()
+        if is_http_error(e):
+            errors['http'] += 1
+        return SegmentResult(ytid, ts_start, ts_end, False, type(e).__name__, str(e),
+                             elapsed=time.time() - start_time, timings=timings,
+                             retries=sum(retries.values()), http_errors=errors['http'],
+                             permanent=is_permanent_error(e))
+
+    num_bytes = sum(os.path.getsize(path) for path in (audio_filepath, video_filepath)
+                    if path and os.path.exists(path))
+    if samples is not None:
+        num_bytes += samples.nbytes
+    return SegmentResult(ytid, ts_start, ts_end, True,
+                         audio_filepath=audio_filepath, video_filepath=video_filepath,
+                         num_bytes=num_bytes, elapsed=time.time() - start_time,
+                         timings=timings, retries=sum(retries.values()),
+                         http_errors=errors['http'], samples=samples)
+
+
+def fail_segments(result, segments):
+    """
+    Get the failed status of all segments of a video from the status of the
+    first segment, e.g. when the video could not be resolved
+
+    Args:
+        result:    Failed status of the first segment
+                   (Type: scheduler.SegmentResult)
+
+        segments:  List of (start time, end time) of the segments of the video
+                   (Type: list[tuple[float, float]])
+
+    Returns:
+        results:  Status of each segment
+                  (Type: list[scheduler.SegmentResult])
+    """
+    # Only the first segment carries the time spent, so that it is counted once
+    return [result] + [result._replace(ts_start=ts_start, ts_end=ts_end, elapsed=None,
+                                       timings=None, retries=0, http_errors=0)
+                       for ts_start, ts_end in segments[1:]]
+
+
+def video_resolve_worker(ytid, segments, data_dir, ffmpeg_path, ffprobe_path,
+                         num_buckets, **ffmpeg_cfg):
+    """
+    Resolver stage worker that resolves the streams of a video once for all
+    of its segments.
+
+    Args:
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        segments:      List of (start time, end time) of the segments to
+                       download (in seconds)
+                       (Type: list[tuple[float, float]])
+
+        data_dir:      Directory where videos will be saved
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Keyword Args:
+        **ffmpeg_cfg:  Configuration for audio and video
+                       downloading and decoding done by ffmpeg
+                       (Type: dict[str, *])
+
+    Returns:
+        worker_args:  Arguments for `video_mp_worker`, or the failed status
+                      of the segments if the streams could not be resolved
+                      (Type: list or scheduler.CompletedTask)
+    """
+    ts_start, ts_end = segments[0]
+    resolved = segment_resolve_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
+                                      ffprobe_path, num_buckets, **ffmpeg_cfg)
+    if isinstance(resolved, CompletedTask):
+        return CompletedTask(fail_segments(resolved.result, segments))
+
+    streams, timings = resolved[-2:]
+    return [ytid, segments, data_dir, ffmpeg_path, ffprobe_path, num_buckets,
+            streams, timings]
+
+
+def video_mp_worker(ytid, segments, data_dir, ffmpeg_path, ffprobe_path,
+                    num_buckets, streams=None, timings=None, merge_gap=None,
+                    features=None, feature_sample_rate=16000, feature_window=0.025,
+                    feature_hop=0.010, num_mels=64, **ffmpeg_cfg):
+    """
+    Pool worker that downloads all segments of a video, resolving its streams
+    only once.
+
+    If `merge_gap` is given, segments that overlap or are at most `merge_gap`
+    seconds apart are fetched as a single span of the streams, which is saved
+    locally, and the segments are then cut from the local copy. If a span
+    cannot be fetched, its segments are fetched separately.
+
+    If `features` is given, the features of all segments are then computed
+    in a single batch.
+
+    Args:
+        ytid:          Youtube ID string
+                       (Type: str)
+
+        segments:      List of (start time, end time) of the segments to
+                       download (in seconds)
+                       (Type: list[tuple[float, float]])
+
+        data_dir:      Directory where videos will be saved
+                       (Type: str)
+
+        ffmpeg_path:   Path to ffmpeg executable
+                       (Type: str)
+
+        ffprobe_path:  Path to ffprobe executable
+                       (Type: str)
+
+    Keyword Args:
+        streams:       Streams of the video if they were already resolved
+                       (Type: cache.ResolvedStreams or None)
+
+        timings:       Time spent in stages that already ran for this video
+                       (Type: dict[str, float] or None)
+
+        merge_gap:     Maximum gap (in seconds) between segments that are
+                       fetched together. If None, each segment is fetched
+                       separately.
+                       (Type: float or None)
+
+        features:      'logmel' or 'stft' to compute features of the audio of
+                       the segments, with the parameters `feature_sample_rate`,
+                       `feature_window`, `feature_hop` and `num_mels` (see
+                       `get_segment_feature_extractor`). If None, no features
+                       are computed.
+                       (Type: str or None)
+
+        **ffmpeg_cfg:  Configuration for audio and video
+                       downloading and decoding done by ffmpeg
+                       (Type: dict[str, *])
+
+    Returns:
+        results:  Download status of each segment
+                  (Type: list[scheduler.SegmentResult])
+    """
+    if streams is None:
+        resolved = video_resolve_worker(ytid, segments, data_dir, ffmpeg_path,
+                                        ffprobe_path, num_buckets, **ffmpeg_cfg)
+        if isinstance(resolved, CompletedTask):
+            return resolved.result
+        streams, timings = resolved[-2:]
+
+    results = []
+    for span_idx, (span_start, span_end, span_segments) in \
+            enumerate(get_segment_spans(segments, merge_gap)):
+        # Stages that run once for the video or the span are only accounted
+        # for in its first segment
+        span_timings = dict(timings or {}) if span_idx == 0 else {}
+        span_streams = streams
+        segment_cfg = ffmpeg_cfg
+        span_dir = None
+        try:
+            if len(span_segments) > 1:
+                span_dir = tempfile.mkdtemp(prefix=get_temp_prefix() + 'span-', dir=data_dir)
+                try:
+                    span_streams = fetch_stream_span(
+                        ffmpeg_path, streams, ffmpeg_cfg.get('video_mode', 'bestvideoaudio'),
+                        span_start, span_end, span_dir,
+                        num_retries=ffmpeg_cfg.get('num_retries', 10),
+                        retry_backoff=ffmpeg_cfg.get('retry_backoff', 1.0),
+                        retry_backoff_max=ffmpeg_cfg.get('retry_backoff_max', 60.0),
+                        timings=span_timings)
+                    segment_cfg = dict(ffmpeg_cfg, absolute_seek=True)
+                except Exception as e:
+                    warn_msg = 'Could not fetch span ({} - {}) of video {}: {}. ' \
+                               'Fetching its segments separately.'
+                    LOGGER.warning(warn_msg.format(span_start, span_end, ytid, e))
+
+            for idx, (ts_start, ts_end) in enumerate(span_segments):
+                if span_dir is not None:
+                    # Keep the span from looking abandoned to the cleanup of
+                    # temporary files by other processes
+                    os.utime(span_dir)
+                results.append(segment_mp_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
+                                                 ffprobe_path, num_buckets, streams=span_streams,
+                                                 timings=span_timings if idx == 0 else None,
+                                                 **segment_cfg))
+        finally:
+            if span_dir is not None:
+                shutil.rmtree(span_dir, ignore_errors=True)
+
+    if features:
+        extractor = get_segment_feature_extractor(
+            features, audio_sample_rate=ffmpeg_cfg.get('audio_sample_rate', 48000),
+            feature_sample_rate=feature_sample_rate, feature_window=feature_window,
+            feature_hop=feature_hop, num_mels=num_mels)
+        results = extract_segment_features(results, data_dir, num_buckets, extractor,
+                                           bucket_levels=ffmpeg_cfg.get('bucket_levels', 1))
+    return results